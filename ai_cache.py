@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+import pytz
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# プロンプトに入れる会話履歴の件数（extract_dates_and_times と同じ）
+PROMPT_HISTORY_SIZE = 5
+# 会話の流れを参照する表現（model_router でも大きいモデルに送る目印にする）
+CONTEXT_REFERENCE_PATTERN = r'それ|その|あの|この|さっき|前の|同じ|やっぱり|変更|キャンセル'
+_CONTEXT_REFERENCE_RE = re.compile(CONTEXT_REFERENCE_PATTERN)
+# 日付を自分で指定している表現（今日・明日・来週・4/6・4月6日・月曜 など）
+_EXPLICIT_DAY_RE = re.compile(
+    r'今日|本日|明日|明後日|今週|来週|再来週|今月|来月|\d{1,2}/\d{1,2}|\d{1,2}月\d{1,2}日|[月火水木金土日]曜'
+)
+
+
+def normalize_text(text):
+    """全角・半角の揺れ（NFKC）と前後・連続する空白を揃えます"""
+    return ' '.join(unicodedata.normalize('NFKC', text or '').split())
+
+
+def is_self_contained(text):
+    """会話履歴がなくても解釈が決まる入力か（日付を指定していて、前の発言を参照する表現がない）"""
+    normalized = normalize_text(text)
+    return bool(_EXPLICIT_DAY_RE.search(normalized)) and not _CONTEXT_REFERENCE_RE.search(normalized)
+
+
+def history_fingerprint(conversation_history):
+    """プロンプトに入る直近の会話履歴（role と content）のハッシュ"""
+    recent = [
+        (msg.get('role'), normalize_text(msg.get('content')))
+        for msg in (conversation_history or [])[-PROMPT_HISTORY_SIZE:]
+    ]
+    if not recent:
+        return ''
+    return hashlib.sha256(json.dumps(recent, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+
+class AIResponseCache:
+    """extract_dates_and_times のLLM応答（パース済みJSON）のキャッシュ（TTL + LRU）
+
+    プロンプトはユーザーのテキスト・JSTの日付・直近の会話履歴で決まるので、
+    正規化したテキスト + JSTの日付 + 会話履歴のハッシュをキーにする。
+    ただし日付を指定していて前の発言を参照しない入力（「明日の空き時間」など）は会話履歴で解釈が変わらないので、
+    履歴を含めずテキスト + 日付だけをキーにし、ユーザーや会話をまたいで使い回す。
+    それ以外で会話履歴が max_history 件を超えるときは、同じキーが再び来ることはほぼないのでキャッシュしない。
+    保存するのはLLMの応答だけで、現在時刻を使う補完処理は取り出すたびに行う。
+    store（DBHelper）を渡すとDBにも保存し、再起動後や別プロセスでも使える。
+    """
+
+    def __init__(self, max_size=512, ttl_seconds=3600, max_history=2, store=None):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.max_history = max_history
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.history_independent = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def make_key(self, text, conversation_history=None, today=None):
+        """キャッシュキーを返します。会話履歴が多くキャッシュしない場合は None"""
+        recent = (conversation_history or [])[-PROMPT_HISTORY_SIZE:]
+        if recent and is_self_contained(text):
+            with self._lock:
+                self.history_independent += 1
+            recent = []
+        elif len(recent) > self.max_history:
+            with self._lock:
+                self.bypassed += 1
+            return None
+        if today is None:
+            today = datetime.now(pytz.timezone('Asia/Tokyo')).date()
+        raw = f"{today.isoformat()}\n{history_fingerprint(recent)}\n{normalize_text(text)}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """キャッシュ済みの応答のコピーを返します（なければ None）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry['expires_at'] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(entry['response'])
+                del self._entries[key]
+                self.expired += 1
+        if self.store is not None:
+            try:
+                response = self.store.get_ai_response(key)
+            except Exception as e:
+                logger.warning(f"AI応答キャッシュの読み込みに失敗: {e}")
+                response = None
+            if response is not None:
+                with self._lock:
+                    self.db_hits += 1
+                    self._remember(key, response)
+                return json.loads(response)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, parsed):
+        """応答を保存します（呼び出し側が後で書き換えても影響しないようJSON文字列で持つ）"""
+        response = json.dumps(parsed, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, response)
+        if self.store is not None:
+            expires_at = (datetime.utcnow() + timedelta(seconds=self.ttl)).isoformat()
+            try:
+                self.store.save_ai_response(key, response, expires_at)
+            except Exception as e:
+                logger.warning(f"AI応答キャッシュの保存に失敗: {e}")
+
+    def _remember(self, key, response):
+        self._entries[key] = {'response': response, 'expires_at': time.monotonic() + self.ttl}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.db_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'persistent': self.store is not None,
+                'hits': self.hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'history_independent': self.history_independent,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_ratio': round((self.hits + self.db_hits) / total, 3) if total else 0.0,
+            }
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def shared_ai_response_cache():
+    """プロセス内で共有するキャッシュ（AI_CACHE_ENABLED=false なら None）"""
+    global _shared_cache
+    if not Config.AI_CACHE_ENABLED:
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            store = None
+            if Config.AI_CACHE_PERSIST:
+                from db import DBHelper
+                store = DBHelper()
+            _shared_cache = AIResponseCache(
+                max_size=Config.AI_CACHE_SIZE,
+                ttl_seconds=Config.AI_CACHE_TTL,
+                max_history=Config.AI_CACHE_MAX_HISTORY,
+                store=store,
+            )
+        return _shared_cache
+
+def ai_response_cache_stats():
+    cache = shared_ai_response_cache()
+    return cache.stats() if cache else None
@@ -0,0 +1,72 @@
+"""
+AIServiceがOpenAIに返させるJSONのスキーマ（Structured Outputs の strict モード）
+
+strict モードではすべてのキーが必須になるので、省略可能な値は null を許す型にし、
+受け取った後に drop_nulls で null のキーを取り除いて従来の dict と同じ形にする。
+"""
+
+
+def _nullable(type_name):
+    return {"type": [type_name, "null"]}
+
+
+def _object(properties):
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def response_format(name, schema):
+    """chat.completions.create の response_format 引数"""
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def drop_nulls(value):
+    """dict の null の値を再帰的に取り除きます"""
+    if isinstance(value, dict):
+        return {k: drop_nulls(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [drop_nulls(v) for v in value]
+    return value
+
+
+# extract_dates_and_times
+DATES_AND_TIMES_SCHEMA = _object({
+    "task_type": {"type": "string", "enum": ["availability_check", "show_schedule", "add_event"]},
+    "dates": {"type": "array", "items": _object({
+        "date": {"type": "string"},
+        "time": _nullable("string"),
+        "end_time": _nullable("string"),
+        "title": _nullable("string"),
+        "description": _nullable("string"),
+    })},
+    "ranges": {"type": "array", "items": _object({
+        "start_date": {"type": "string"},
+        "end_date": {"type": "string"},
+        "weekdays": {"type": ["array", "null"], "items": {"type": "integer"}},
+        "time": _nullable("string"),
+        "end_time": _nullable("string"),
+    })},
+    "required_duration_minutes": _nullable("integer"),
+    "travel_time_minutes": _nullable("integer"),
+    "location": _nullable("string"),
+})
+
+# extract_event_info
+EVENT_INFO_SCHEMA = _object({
+    "title": {"type": "string"},
+    "start_datetime": {"type": "string"},
+    "end_datetime": {"type": "string"},
+    "description": _nullable("string"),
+})
+
+# check_multiple_dates_availability
+DATES_AVAILABILITY_SCHEMA = _object({
+    "dates": {"type": "array", "items": _object({
+        "date": {"type": "string"},
+        "time_range": {"type": "string"},
+    })},
+})
@@ -4,9 +4,17 @@ from dateutil import parser
 import re
 import json
 from config import Config
+from ai_cache import shared_ai_response_cache
+from intent_rules import match_intent
+from model_router import shared_model_router, validate_dates_response
+from ai_schemas import (
+    DATES_AND_TIMES_SCHEMA, EVENT_INFO_SCHEMA, DATES_AVAILABILITY_SCHEMA, response_format, drop_nulls,
+)
 import calendar
 import pytz
 import logging
+import threading
+import time
 
 logger = logging.getLogger("ai_service")
 logger.setLevel(logging.INFO)
@@ -16,55 +24,92 @@ if not logger.hasHandlers():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-class AIService:
-    def __init__(self):
-        self.client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
-    
-    def _get_jst_now_str(self):
-        now = datetime.now(pytz.timezone('Asia/Tokyo'))
-        return now.strftime('%Y-%m-%dT%H:%M:%S%z')
-    
-    def extract_dates_and_times(self, text, conversation_history=None):
-        """テキストから日時を抽出し、タスクの種類を判定します
+# ranges（範囲指定）1件で展開する最大日数
+MAX_RANGE_DAYS = 92
+WEEKDAY_NAMES = "月火水木金土日"
+
+
+def _parse_weekdays(weekdays):
+    """weekdays（0=月〜6=日 の数値、または「月」などの曜日名のリスト）を数値の集合にします。省略時は None"""
+    if weekdays is None or weekdays == []:
+        return None
+    result = set()
+    for w in weekdays:
+        if isinstance(w, str) and w[:1] in WEEKDAY_NAMES:
+            result.add(WEEKDAY_NAMES.index(w[:1]))
+        elif isinstance(w, int) and 0 <= w <= 6:
+            result.add(w)
+        else:
+            raise ValueError(f"曜日を解釈できません: {w}")
+    return result
+
+
+def _dates_in_range(start, end, weekdays=None):
+    """start〜end（両端含む）の日付を返します。weekdays があればその曜日だけ"""
+    days = []
+    cur = start
+    while cur <= end:
+        if weekdays is None or cur.weekday() in weekdays:
+            days.append(cur)
+        cur += timedelta(days=1)
+    return days
+
+
+# OpenAI呼び出しごとのトークン使用量（プロンプトキャッシュに載った入力トークン数を含む）
+_usage_stats = {}
+_usage_stats_lock = threading.Lock()
+
+
+def _record_usage(name, response):
+    """response.usage の prompt_tokens / cached_tokens / completion_tokens を呼び出し名ごとに集計します"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+    with _usage_stats_lock:
+        stats = _usage_stats.setdefault(name, {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0})
+        stats['calls'] += 1
+        stats['prompt_tokens'] += getattr(usage, 'prompt_tokens', 0) or 0
+        stats['cached_tokens'] += cached
+        stats['completion_tokens'] += getattr(usage, 'completion_tokens', 0) or 0
+
+
+def ai_usage_stats():
+    with _usage_stats_lock:
+        result = {}
+        for name, stats in _usage_stats.items():
+            prompt_tokens = stats['prompt_tokens']
+            result[name] = dict(stats, cached_ratio=round(stats['cached_tokens'] / prompt_tokens, 3) if prompt_tokens else 0.0)
+        return result
 
-        Args:
-            text: ユーザーのメッセージ
-            conversation_history: 会話履歴 [{'role': 'user'/'assistant', 'content': '...'}]
-        """
-        try:
-            logger.info(f"[DEBUG] ===== extract_dates_and_times開始 =====")
-            logger.info(f"[DEBUG] ユーザー入力テキスト: '{text}'")
-            now_jst = self._get_jst_now_str()
-            system_prompt = f"""あなたはスケジュール管理アシスタントです。現在は {now_jst} です。
+
+# extract_dates_and_times のシステムプロンプト（毎回同じ内容にして、プロバイダ側のプロンプトキャッシュを効かせる）
+# 現在日時・会話履歴・ユーザーの入力など毎回変わる内容は、このあとのメッセージに入れる
+DATES_AND_TIMES_PROMPT = """あなたはスケジュール管理アシスタントです。現在日時はユーザーの入力の直前に示します。
 
 ユーザーの入力をJSON形式で返してください。以下の例に従ってください。
 
-## 例
+## 例（今日が 2026-03-28 の場合）
 
 ユーザー: 「4/15までの9:00〜18:00が空いている日程出して」
-あなた:
-\`\`\`json
-{{
-  "task_type": "availability_check",
-  "dates": [
-    {{"date": "2026-03-28", "time": "09:00", "end_time": "18:00"}},
-    {{"date": "2026-03-29", "time": "09:00", "end_time": "18:00"}},
-    ...4/15まで
-  ]
-}}
-\`\`\`
-↑ 時間帯（9:00〜18:00）は検索範囲。required_duration_minutesは不要
+あなた: {"task_type": "availability_check", "ranges": [{"start_date": "2026-03-28", "end_date": "2026-04-15", "time": "09:00", "end_time": "18:00"}]}
+↑ 時間帯（9:00〜18:00）は検索範囲。required_duration_minutesは不要。複数日は1日ずつ並べずrangesで返す
 
 ユーザー: 「3月で2時間打ち合わせできる日」
-あなた: {{"task_type": "availability_check", "dates": [...3月全日...], "required_duration_minutes": 120}}
+あなた: {"task_type": "availability_check", "ranges": [{"start_date": "2026-03-01", "end_date": "2026-03-31", "time": "08:00", "end_time": "22:00"}], "required_duration_minutes": 120}
 ↑ 2時間 = 120分が必要
 
+ユーザー: 「4月の平日10時〜17時で空いているところ」
+あなた: {"task_type": "availability_check", "ranges": [{"start_date": "2026-04-01", "end_date": "2026-04-30", "weekdays": [0, 1, 2, 3, 4], "time": "10:00", "end_time": "17:00"}]}
+↑ weekdaysは曜日の絞り込み（0=月〜6=日）。平日=[0,1,2,3,4]、土日=[5,6]
+
 ユーザー: 「明日の午後に1時間打ち合わせ 移動30分」
-あなた: {{"task_type": "availability_check", "dates": [{{"date": "2026-03-28", "time": "12:00", "end_time": "18:00"}}], "required_duration_minutes": 120, "travel_time_minutes": 30}}
+あなた: {"task_type": "availability_check", "dates": [{"date": "2026-03-29", "time": "12:00", "end_time": "18:00"}], "required_duration_minutes": 120, "travel_time_minutes": 30}
 ↑ 1時間(60分) + 移動往復(60分) = 120分、移動片道30分
 
 ユーザー: 「4/6 15:00 なみさん」
-あなた: {{"task_type": "add_event", "dates": [{{"date": "2026-04-06", "time": "15:00", "end_time": "16:00", "title": "なみさん"}}]}}
+あなた: {"task_type": "add_event", "dates": [{"date": "2026-04-06", "time": "15:00", "end_time": "16:00", "title": "なみさん"}]}
 ↑ 月/日と時刻と相手・件名。終了がなければ1時間後。必ずYYYY-MM-DD・time・end_time・titleを入れる
 
 ## ルール
@@ -90,37 +135,92 @@ class AIService:
 
 6. **date**: YYYY-MM-DD形式、必ず今日以降
 
+7. **ranges**: 連続する複数日（「〜まで」「X月」「来週」など）は dates に列挙せず、
+   start_date・end_date（YYYY-MM-DD）・weekdays（省略可）・time・end_time の範囲指定で返す。
+   1日だけ・とびとびの日付は dates で返す
+
+8. **title/description** (add_eventのみ): titleは相手の名前や会議名も含めて具体的に、補足はdescriptionへ
+   例:『田中さんとMTG 新作アプリの件』→ title『田中さんとMTG』、description『新作アプリの件』
+
 JSON形式のみで返答。説明不要。"""
 
-            # メッセージ構築（会話履歴を含める）
-            messages = [{"role": "system", "content": system_prompt}]
-
-            # 会話履歴を追加（最新5件まで）
-            if conversation_history:
-                logger.info(f"[DEBUG] 会話履歴を追加: {len(conversation_history)}件（最新5件まで使用）")
-                for i, msg in enumerate(conversation_history[-5:]):
-                    logger.info(f"[DEBUG] 会話履歴[{i}]: role={msg['role']}, content={msg['content'][:50]}...")
-                    messages.append({
-                        "role": msg['role'],
-                        "content": msg['content']
-                    })
-            else:
-                logger.info(f"[DEBUG] 会話履歴なし（初回メッセージまたは履歴なし）")
 
-            # 現在のユーザーメッセージを追加
-            messages.append({
-                "role": "user",
-                "content": text
-            })
+# extract_event_info のシステムプロンプト（固定。現在日時はユーザーの入力の直前に入れる）
+EVENT_INFO_PROMPT = (
+    "あなたは予定とタスクを管理するAIです。\n"
+    "現在の日時（日本時間）はユーザーの入力の直前に示します。  \n"
+    "この日時は、すべての自然言語の解釈において**常に絶対的な基準**としてください。  \n"
+    "会話の流れや前回の入力に引きずられることなく、**毎回この現在日時を最優先にしてください。**\n"
+    "\n"
+    "あなたはイベント情報抽出の専門家です。ユーザーのテキストからイベントのタイトルと日時を抽出し、以下のJSON形式で返してください。\n\n"
+    "抽出ルール:\n"
+    "1. イベントのタイトルは、直前の人名や主語、会議名なども含めて、できるだけ長く・具体的に抽出してください。\n"
+    "   例:『田中さんとMTG 新作アプリの件』→タイトル:『田中さんとMTG』、説明:『新作アプリの件』\n"
+    "2. 開始日時と終了日時を抽出（終了時間が明示されていない場合は1時間後をデフォルトとする）\n"
+    "3. 日本語の日付表現を具体的な日付に変換\n"
+    "4. 時間表現を24時間形式に変換\n"
+    "5. タイムゾーンは日本時間（JST）を想定\n\n"
+    "出力形式:\n"
+    "{\n  \"title\": \"イベントタイトル\",\n  \"start_datetime\": \"2024-01-15T09:00:00\",\n  \"end_datetime\": \"2024-01-15T10:00:00\",\n  \"description\": \"説明（オプション）\"\n}\n"
+)
+
+# check_multiple_dates_availability のシステムプロンプト（固定。現在日時はユーザーの入力の直前に入れる）
+DATES_AVAILABILITY_PROMPT = (
+    "あなたは予定とタスクを管理するAIです。\n"
+    "現在の日時（日本時間）はユーザーの入力の直前に示します。  \n"
+    "この日時は、すべての自然言語の解釈において**常に絶対的な基準**としてください。  \n"
+    "会話の流れや前回の入力に引きずられることなく、**毎回この現在日時を最優先にしてください。**\n"
+    "\n"
+    "複数の日付の空き時間確認リクエストを処理してください。以下のJSON形式で返してください。\n\n"
+    "出力形式:\n"
+    "{\n  \"dates\": [\n    {\n      \"date\": \"2024-01-15\",\n      \"time_range\": \"09:00-18:00\"\n    }\n  ]\n}\n"
+)
+
+
+def _current_time_message(now_jst):
+    """プロンプトの最後（ユーザーの入力の直前）に置く現在日時のメッセージ"""
+    return {"role": "system", "content": f"現在の日時（日本時間）は {now_jst} です。日付の解釈はこの日時を基準にしてください。"}
 
-            response = self.client.chat.completions.create(
-                model="gpt-4o",  # より強力なモデルに変更
-                messages=messages,
-                temperature=0  # 0にして決定論的に
-            )
-            result = response.choices[0].message.content
-            logger.info(f"[DEBUG] AI生レスポンス: {result}")
-            parsed = self._parse_ai_response(result)
+
+class AIService:
+    def __init__(self):
+        self.client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
+        # 同じ文・同じ日の問い合わせのLLM応答キャッシュ（プロセス内で共有）
+        self.response_cache = shared_ai_response_cache()
+        # 定型の入力（「明日の空き時間」「4/6 10:00-12:00」など）はLLMを呼ばずにルールで解釈する
+        self.use_intent_rules = Config.INTENT_RULES_ENABLED
+        # 単純な入力は小さいモデルで解釈し、妥当でなければ大きいモデルへ（プロセス内で共有）
+        self.model_router = shared_model_router()
+    
+    def _get_jst_now_str(self):
+        now = datetime.now(pytz.timezone('Asia/Tokyo'))
+        return now.strftime('%Y-%m-%dT%H:%M:%S%z')
+    
+    def extract_dates_and_times(self, text, conversation_history=None):
+        """テキストから日時を抽出し、タスクの種類を判定します
+
+        Args:
+            text: ユーザーのメッセージ
+            conversation_history: 会話履歴 [{'role': 'user'/'assistant', 'content': '...'}]
+        """
+        try:
+            logger.info(f"[DEBUG] ===== extract_dates_and_times開始 =====")
+            logger.info(f"[DEBUG] ユーザー入力テキスト: '{text}'")
+            if self.use_intent_rules:
+                parsed = match_intent(text)
+                if parsed is not None:
+                    # ルールの結果は補完済みの最終形なので、LLM応答向けの補正はしない
+                    logger.info(f"[DEBUG] ルールで解釈（LLM呼び出しなし）: {parsed}")
+                    return parsed
+            cache = self.response_cache
+            cache_key = cache.make_key(text, conversation_history) if cache else None
+            parsed = cache.get(cache_key) if cache_key else None
+            if parsed is not None:
+                logger.info(f"[DEBUG] AI応答キャッシュを使用: {parsed}")
+            else:
+                parsed = self._request_dates_and_times(text, conversation_history)
+                if cache_key and 'error' not in parsed:
+                    cache.put(cache_key, parsed)
 
             # AIの判定を尊重
             logger.info(f"[DEBUG] パース後のJSON: {parsed}")
@@ -129,27 +229,6 @@ JSON形式のみで返答。説明不要。"""
             if parsed.get('required_duration_minutes'):
                 logger.info(f"[DEBUG] required_duration_minutes: {parsed['required_duration_minutes']}分")
 
-            # 同じ日付が複数ある場合は警告
-            if 'dates' in parsed:
-                date_counts = {}
-                for d in parsed['dates']:
-                    if isinstance(d, dict) and 'date' in d:
-                        date_str = d['date']
-                        date_counts[date_str] = date_counts.get(date_str, 0) + 1
-
-                duplicates = {date: count for date, count in date_counts.items() if count > 1}
-                if duplicates:
-                    logger.warning(f"[WARNING] AIが同じ日付を複数回返しました: {duplicates}")
-                    for date, count in duplicates.items():
-                        logger.warning(f"[WARNING]   {date}: {count}回")
-
-            # 'date'キーがあり'dates'がない場合、'dates'配列に変換
-            if 'date' in parsed and 'dates' not in parsed:
-                date_value = parsed['date']
-                logger.warning(f"[WARNING] AIが'date'キーで返答。'dates'配列に変換します: {date_value}")
-                parsed['dates'] = [{'date': date_value}]
-                del parsed['date']  # 重複を避けるため削除
-
             # 「10:00〜17:00のように空いている」= 検索枠指定。required_duration は誤判定の元なので除去
             if parsed.get('task_type') == 'availability_check':
                 has_explicit_slot_range = bool(
@@ -223,8 +302,8 @@ JSON形式のみで返答。説明不要。"""
                 if has_explicit_time_range:
                     logger.info("[DEBUG] 明示的な時間範囲指定を検出。time/end_timeの自動補正はスキップします")
 
-                # 各dateのtime〜end_timeが required_duration_minutes と同じ長さの場合は修正
-                for d in parsed.get('dates', []):
+                # 各date・rangeのtime〜end_timeが required_duration_minutes と同じ長さの場合は修正
+                for d in parsed.get('dates', []) + (parsed.get('ranges') or []):
                     if isinstance(d, dict) and d.get('time') and d.get('end_time'):
                         from datetime import datetime
                         try:
@@ -257,7 +336,17 @@ JSON形式のみで返答。説明不要。"""
                 # エラーが発生しても、AIの解析結果をそのまま返す
                 logger.warning(f"[WARNING] _supplement_timesエラーのため、AI解析結果をそのまま使用")
 
-            parsed = self._fill_availability_until_deadline(parsed, text)
+            # 範囲指定（ranges）を日ごとの dates に展開（_supplement_times の月・来週の展開より後に行う）
+            # ranges で返った期間は曜日の指定も含めてLLMが決めているので、締切までの全日補完はしない
+            from_ranges = bool(parsed.get('ranges'))
+            parsed = self._expand_date_ranges(parsed)
+            if not from_ranges:
+                parsed = self._fill_availability_until_deadline(parsed, text)
+            if parsed.get('task_type') == 'add_event':
+                # 「MTG」のような短いタイトルは extract_event_info と同じく人名などを含めて補完
+                for d in parsed.get('dates') or []:
+                    if isinstance(d, dict) and d.get('title'):
+                        d['title'] = self._expand_short_title(d['title'], text)
             return parsed
 
         except Exception as e:
@@ -266,8 +355,159 @@ JSON形式のみで返答。説明不要。"""
             traceback.print_exc()
             return {"error": "イベント情報を正しく認識できませんでした。\n\n・日時を打つと空き時間を返します\n・予定を打つとカレンダーに追加します\n\n例：\n『明日の午前9時から会議を追加して』\n『来週月曜日の14時から打ち合わせ』"}
     
+    def _request_dates_and_times(self, text, conversation_history=None):
+        """extract_dates_and_times のLLM呼び出し（プロンプト構築〜JSONパース）"""
+        # メッセージ構築（固定のシステムプロンプト → 会話履歴 → 現在日時 → ユーザーの入力）
+        messages = [{"role": "system", "content": DATES_AND_TIMES_PROMPT}]
+
+        # 会話履歴を追加（最新5件まで）
+        if conversation_history:
+            logger.info(f"[DEBUG] 会話履歴を追加: {len(conversation_history)}件（最新5件まで使用）")
+            for i, msg in enumerate(conversation_history[-5:]):
+                logger.info(f"[DEBUG] 会話履歴[{i}]: role={msg['role']}, content={msg['content'][:50]}...")
+                messages.append({
+                    "role": msg['role'],
+                    "content": msg['content']
+                })
+        else:
+            logger.info(f"[DEBUG] 会話履歴なし（初回メッセージまたは履歴なし）")
+
+        # 現在日時と現在のユーザーメッセージを追加
+        messages.append(_current_time_message(self._get_jst_now_str()))
+        messages.append({
+            "role": "user",
+            "content": text
+        })
+
+        router = self.model_router
+        if router and router.is_simple(text):
+            # 単純な入力はまず小さいモデルで解釈し、スキーマ・妥当性チェックを通らなければ大きいモデルへ
+            started = time.monotonic()
+            parsed, structured = self._chat_json(
+                router.small_model, messages, 'dates_and_times', DATES_AND_TIMES_SCHEMA, temperature=0
+            )
+            router.record('small', started)
+            problem = validate_dates_response(parsed) if structured else 'スキーマ通りの応答でない'
+            if problem is None:
+                return parsed
+            router.record_escalation(problem)
+            logger.info(f"[DEBUG] {router.small_model}の応答を採用せず{router.large_model}で再解釈: {problem}")
+
+        started = time.monotonic()
+        parsed, structured = self._chat_json(
+            router.large_model if router else "gpt-4o", messages, 'dates_and_times', DATES_AND_TIMES_SCHEMA,
+            temperature=0  # 0にして決定論的に
+        )
+        if router:
+            router.record('large', started)
+        if not structured:
+            parsed = self._repair_dates_response(parsed)
+        return parsed
+
+    def _chat_json(self, model, messages, schema_name, schema, temperature=0):
+        """JSONスキーマ（strict）に沿った応答を1回の json.loads で dict にして (dict, True) を返します
+
+        スキーマ指定が使えない・応答がJSONとして読めない場合は、スキーマなしの応答から
+        JSON部分を抜き出して (dict, False) を返す（呼び出し側で形の補正を行う）。
+        """
+        try:
+            response = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                response_format=response_format(schema_name, schema),
+            )
+        except openai.BadRequestError as e:
+            logger.warning(f"[WARNING] JSONスキーマ指定の呼び出しに失敗。スキーマなしで再実行します: {e}")
+            response = self.client.chat.completions.create(model=model, messages=messages, temperature=temperature)
+            _record_usage(schema_name, response)
+            result = response.choices[0].message.content or ''
+            logger.info(f"[DEBUG] AI生レスポンス: {result}")
+            return self._parse_ai_response(result), False
+        _record_usage(schema_name, response)
+        result = response.choices[0].message.content or ''
+        logger.info(f"[DEBUG] AI生レスポンス: {result}")
+        try:
+            parsed = json.loads(result)
+            if isinstance(parsed, dict):
+                return drop_nulls(parsed), True
+        except ValueError:
+            pass
+        logger.warning(f"[WARNING] AI応答がスキーマ通りのJSONではありません（拒否・打ち切りの可能性）")
+        return self._parse_ai_response(result), False
+
+    def _repair_dates_response(self, parsed):
+        """スキーマなしで受け取った extract_dates_and_times の応答の形を補正します"""
+        # 同じ日付が複数ある場合は警告
+        if 'dates' in parsed and isinstance(parsed['dates'], list):
+            date_counts = {}
+            for d in parsed['dates']:
+                if isinstance(d, dict) and 'date' in d:
+                    date_str = d['date']
+                    date_counts[date_str] = date_counts.get(date_str, 0) + 1
+
+            duplicates = {date: count for date, count in date_counts.items() if count > 1}
+            if duplicates:
+                logger.warning(f"[WARNING] AIが同じ日付を複数回返しました: {duplicates}")
+                for date, count in duplicates.items():
+                    logger.warning(f"[WARNING]   {date}: {count}回")
+
+        # 'date'キーがあり'dates'がない場合、'dates'配列に変換
+        if 'date' in parsed and 'dates' not in parsed:
+            date_value = parsed['date']
+            logger.warning(f"[WARNING] AIが'date'キーで返答。'dates'配列に変換します: {date_value}")
+            parsed['dates'] = [{'date': date_value}]
+            del parsed['date']  # 重複を避けるため削除
+        return parsed
+
+    def _expand_date_ranges(self, parsed):
+        """LLMが返した範囲指定 ranges を日ごとの dates に展開します
+
+        ranges の各要素: {"start_date", "end_date", "weekdays"(0=月〜6=日, 省略時は全曜日), "time", "end_time"}
+        日数の多い問い合わせでもLLMの出力は1要素で済む。空き確認・予定追加では今日より前を除き、1範囲は MAX_RANGE_DAYS 日まで。
+        """
+        ranges = parsed.pop('ranges', None)
+        if not ranges or not isinstance(ranges, list):
+            return parsed
+        dates = parsed.get('dates')
+        if not isinstance(dates, list):
+            dates = []
+        seen = {(d.get('date'), d.get('time'), d.get('end_time')) for d in dates if isinstance(d, dict)}
+        today = datetime.now(pytz.timezone('Asia/Tokyo')).date()
+        added = 0
+        for r in ranges:
+            if not isinstance(r, dict):
+                logger.warning(f"[WARNING] rangesの要素が辞書でないためスキップ: {r}")
+                continue
+            try:
+                start = datetime.strptime(r['start_date'], '%Y-%m-%d').date()
+                end = datetime.strptime(r.get('end_date') or r['start_date'], '%Y-%m-%d').date()
+                weekdays = _parse_weekdays(r.get('weekdays'))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"[WARNING] rangesの要素を解釈できないためスキップ: {r} ({e})")
+                continue
+            if parsed.get('task_type') != 'show_schedule':
+                start = max(start, today)
+            end = min(end, start + timedelta(days=MAX_RANGE_DAYS - 1))
+            time_str = r.get('time') or '08:00'
+            end_time_str = r.get('end_time') or '22:00'
+            for day in _dates_in_range(start, end, weekdays):
+                key = (day.strftime('%Y-%m-%d'), time_str, end_time_str)
+                if key in seen:
+                    continue
+                seen.add(key)
+                dates.append({'date': key[0], 'time': time_str, 'end_time': end_time_str})
+                added += 1
+        dates.sort(key=lambda d: (d.get('date') or '', d.get('time') or '') if isinstance(d, dict) else ('', ''))
+        parsed['dates'] = dates
+        logger.info(f"[DEBUG] ranges {len(ranges)}件を展開: {added}日分を追加（計{len(dates)}件）")
+        return parsed
+
     def _fill_availability_until_deadline(self, parsed, original_text):
-        """「4/15まで」のように締切日付がある空き確認で、今日〜締切の全日を揃える（AIの日付漏れ対策）"""
+        """「4/15まで」のように締切日付がある空き確認で、今日〜締切の全日を揃える（AIの日付漏れ対策）
+
+        「平日」「土日」「週末」の指定があれば、その曜日だけを補う。
+        """
         if parsed.get('task_type') != 'availability_check':
             return parsed
         dates = parsed.get('dates')
@@ -297,12 +537,15 @@ JSON形式のみで返答。説明不要。"""
         for d in dates:
             if isinstance(d, dict) and d.get('date'):
                 by_date[d['date']] = dict(d)
-        cur = today
-        while cur <= deadline:
-            k = cur.strftime('%Y-%m-%d')
+        weekdays = None
+        if '平日' in original_text:
+            weekdays = {0, 1, 2, 3, 4}
+        elif '土日' in original_text or '週末' in original_text:
+            weekdays = {5, 6}
+        for day in _dates_in_range(today, deadline, weekdays):
+            k = day.strftime('%Y-%m-%d')
             if k not in by_date:
                 by_date[k] = {'date': k, 'time': st, 'end_time': et}
-            cur += timedelta(days=1)
         filled = sorted(
             (e for e in by_date.values() if today.strftime('%Y-%m-%d') <= e['date'] <= deadline.strftime('%Y-%m-%d')),
             key=lambda x: x['date'],
@@ -1079,53 +1322,37 @@ JSON形式のみで返答。説明不要。"""
         print(f"[DEBUG] 作成された移動時間イベント: {travel_events}")
         return travel_events
     
+    def _expand_short_title(self, title, text):
+        """タイトルが短すぎる場合は人名や主語＋MTGなどを含めて補完します"""
+        # 例: "MTG"や"会議"など短い場合は元テキストから人名＋MTGを抽出
+        if title and len(title) <= 4:
+            # 例: "田中さんとMTG" "佐藤さん会議" "山田さんMTG" など
+            m = re.search(r'([\w一-龠ぁ-んァ-ン]+さん[と]?\s*MTG|[\w一-龠ぁ-んァ-ン]+さん[と]?\s*会議)', text)
+            if m:
+                return m.group(1)
+        return title
+
     def extract_event_info(self, text):
         """イベント追加用の情報を抽出します"""
         try:
-            now_jst = self._get_jst_now_str()
-            system_prompt = (
-                f"あなたは予定とタスクを管理するAIです。\n"
-                f"現在の日時（日本時間）は {now_jst} です。  \n"
-                "この日時は、すべての自然言語の解釈において**常に絶対的な基準**としてください。  \n"
-                "会話の流れや前回の入力に引きずられることなく、**毎回この現在日時を最優先にしてください。**\n"
-                "\n"
-                "あなたはイベント情報抽出の専門家です。ユーザーのテキストからイベントのタイトルと日時を抽出し、以下のJSON形式で返してください。\n\n"
-                "抽出ルール:\n"
-                "1. イベントのタイトルは、直前の人名や主語、会議名なども含めて、できるだけ長く・具体的に抽出してください。\n"
-                "   例:『田中さんとMTG 新作アプリの件』→タイトル:『田中さんとMTG』、説明:『新作アプリの件』\n"
-                "2. 開始日時と終了日時を抽出（終了時間が明示されていない場合は1時間後をデフォルトとする）\n"
-                "3. 日本語の日付表現を具体的な日付に変換\n"
-                "4. 時間表現を24時間形式に変換\n"
-                "5. タイムゾーンは日本時間（JST）を想定\n\n"
-                "出力形式:\n"
-                "{\n  \"title\": \"イベントタイトル\",\n  \"start_datetime\": \"2024-01-15T09:00:00\",\n  \"end_datetime\": \"2024-01-15T10:00:00\",\n  \"description\": \"説明（オプション）\"\n}\n"
-            )
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
+            parsed, _ = self._chat_json(
+                "gpt-4o-mini",
+                [
                     {
                         "role": "system",
-                        "content": system_prompt
+                        "content": EVENT_INFO_PROMPT
                     },
+                    _current_time_message(self._get_jst_now_str()),
                     {
                         "role": "user",
                         "content": text
                     }
                 ],
+                'event_info', EVENT_INFO_SCHEMA,
                 temperature=0.1
             )
-            result = response.choices[0].message.content
-            parsed = self._parse_ai_response(result)
-            # --- タイトルが短すぎる場合は人名や主語＋MTGなどを含めて補完 ---
             if parsed and isinstance(parsed, dict) and 'title' in parsed:
-                title = parsed['title']
-                # 例: "MTG"や"会議"など短い場合は元テキストから人名＋MTGを抽出
-                if title and len(title) <= 4:
-                    import re
-                    # 例: "田中さんとMTG" "佐藤さん会議" "山田さんMTG" など
-                    m = re.search(r'([\w一-龠ぁ-んァ-ン]+さん[と]?\s*MTG|[\w一-龠ぁ-んァ-ン]+さん[と]?\s*会議)', text)
-                    if m:
-                        parsed['title'] = m.group(1)
+                parsed['title'] = self._expand_short_title(parsed['title'], text)
             return parsed
         except Exception as e:
             return {"error": f"AI処理エラー: {str(e)}"}
@@ -1210,34 +1437,23 @@ JSON形式のみで返答。説明不要。"""
     def check_multiple_dates_availability(self, dates_info):
         """複数の日付の空き時間を確認するための情報を抽出します"""
         try:
-            now_jst = self._get_jst_now_str()
-            system_prompt = (
-                f"あなたは予定とタスクを管理するAIです。\n"
-                f"現在の日時（日本時間）は {now_jst} です。  \n"
-                "この日時は、すべての自然言語の解釈において**常に絶対的な基準**としてください。  \n"
-                "会話の流れや前回の入力に引きずられることなく、**毎回この現在日時を最優先にしてください。**\n"
-                "\n"
-                "複数の日付の空き時間確認リクエストを処理してください。以下のJSON形式で返してください。\n\n"
-                "出力形式:\n"
-                "{\n  \"dates\": [\n    {\n      \"date\": \"2024-01-15\",\n      \"time_range\": \"09:00-18:00\"\n    }\n  ]\n}\n"
-            )
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
+            parsed, _ = self._chat_json(
+                "gpt-4o-mini",
+                [
                     {
                         "role": "system",
-                        "content": system_prompt
+                        "content": DATES_AVAILABILITY_PROMPT
                     },
+                    _current_time_message(self._get_jst_now_str()),
                     {
                         "role": "user",
                         "content": dates_info
                     }
                 ],
+                'dates_availability', DATES_AVAILABILITY_SCHEMA,
                 temperature=0.1
             )
-            
-            result = response.choices[0].message.content
-            return self._parse_ai_response(result)
+            return parsed
             
         except Exception as e:
             return {"error": f"AI処理エラー: {str(e)}"}
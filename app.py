@@ -36,14 +36,23 @@ from line_bot_handler import LineBotHandler
 from config import Config
 import json
 from datetime import datetime
-import pickle
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from db import DBHelper
 from werkzeug.middleware.proxy_fix import ProxyFix
-from ai_service import AIService
+from ai_service import AIService, ai_usage_stats
+from ai_cache import ai_response_cache_stats
+from intent_rules import intent_rule_stats
+from model_router import model_router_stats
 from send_daily_agenda import send_daily_agenda
+from work_queue import KeyedWorkQueue
+from calendar_service import (
+    service_cache, credentials_cache, calendar_mirror, warm_calendar_discovery, calendar_discovery_stats,
+    remember_refreshed_credentials,
+)
+from token_store import encode_credentials, migrate_legacy_tokens, refresh_stats
+from token_refresher import TokenRefresher
 
 # ログ設定
 logger = logging.getLogger(__name__)
@@ -62,6 +71,13 @@ except ValueError as e:
     logger.error(f"設定エラー: {e}")
     raise
 
+# Calendar v3 ディスカバリドキュメントを事前に読み込む（初回リクエストのservice構築を速くする）
+if Config.PREWARM_CALENDAR_DISCOVERY:
+    try:
+        warm_calendar_discovery()
+    except Exception as e:
+        logger.warning(f"ディスカバリドキュメントの事前読み込みに失敗しました: {e}")
+
 # LINEボットハンドラーを初期化
 try:
     line_bot_handler = LineBotHandler()
@@ -76,6 +92,41 @@ except Exception as e:
 # DBヘルパーの初期化
 db_helper = DBHelper()
 
+# 旧形式（pickle等）で保存されたGoogleトークンを1度だけ現在の形式に移行
+if Config.MIGRATE_TOKENS_ON_STARTUP:
+    try:
+        migrate_legacy_tokens(db_helper)
+    except Exception as e:
+        logger.error(f"トークン形式の移行に失敗しました: {e}")
+
+# 期限が近いGoogleトークンをバックグラウンドで先にリフレッシュ（リクエスト処理中のリフレッシュを減らす）
+token_refresher = TokenRefresher(
+    db_helper,
+    interval_seconds=Config.TOKEN_REFRESH_INTERVAL,
+    window_seconds=Config.TOKEN_REFRESH_WINDOW,
+    max_workers=Config.TOKEN_REFRESH_WORKERS,
+    on_refreshed=remember_refreshed_credentials
+)
+if Config.TOKEN_REFRESH_ENABLED:
+    token_refresher.start()
+
+# Webhookイベント処理キュー（ユーザーごとの順序を保ってワーカーで処理）
+webhook_queue = KeyedWorkQueue(
+    num_workers=Config.WEBHOOK_WORKERS,
+    max_queue_size=Config.WEBHOOK_QUEUE_SIZE,
+    name="webhook",
+    submit_timeout=Config.WEBHOOK_SUBMIT_TIMEOUT
+)
+if Config.WEBHOOK_ASYNC:
+    webhook_queue.start()
+
+def _dispatch_event(event):
+    """キューから取り出したWebhookイベントを処理関数に振り分ける"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        handle_message(event)
+    else:
+        logger.info(f"未対応のイベントをスキップ: {type(event).__name__}")
+
 @app.route("/callback", methods=['POST'])
 def callback():
     """LINE Webhookのコールバックエンドポイント"""
@@ -86,14 +137,31 @@ def callback():
     body = request.get_data(as_text=True)
     logger.info("Request body: " + body)
 
+    if not Config.WEBHOOK_ASYNC:
+        try:
+            # 署名を検証し、問題なければhandleに定義されている関数を呼び出す
+            handler.handle(body, signature)
+        except InvalidSignatureError:
+            # 署名検証で失敗したときは例外をあげる
+            logger.error("署名検証に失敗しました")
+            abort(400)
+        return 'OK'
+
     try:
-        # 署名を検証し、問題なければhandleに定義されている関数を呼び出す
-        handler.handle(body, signature)
+        # 署名を検証してイベントを取り出す（処理はワーカーに任せてすぐに200を返す）
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
-        # 署名検証で失敗したときは例外をあげる
         logger.error("署名検証に失敗しました")
         abort(400)
 
+    for event in events:
+        user_id = getattr(event.source, 'user_id', None)
+        if not webhook_queue.submit(user_id, _dispatch_event, event):
+            # キューが満杯の場合、その場で処理するとキューに残る同じユーザーの先のメッセージより先に処理してしまうので、
+            # 503を返してLINEに再送させる（回数は webhook_queue の rejected に数えられる）
+            logger.warning("Webhookキューが満杯のため503を返します")
+            return 'Service Unavailable', 503
+
     # 正常終了時は200を返す
     return 'OK'
 
@@ -363,8 +431,10 @@ def oauth2callback():
             
         credentials = flow.credentials
         # トークンをDBに保存
-        token_data = pickle.dumps(credentials)
+        token_data = encode_credentials(credentials)
         db_helper.save_google_token(line_user_id, token_data)
+        # 別のGoogleアカウントで認証し直した場合に備えてミラーを作り直す
+        db_helper.clear_calendar_mirror(line_user_id)
         # ワンタイムコードを使用済みに
         db_helper.mark_onetime_code_used(line_user_id)
         # 認証完了画面
@@ -473,11 +543,34 @@ def api_send_daily_agenda():
     if not secret_token or req_token != secret_token:
         return jsonify({'status': 'error', 'message': 'Invalid or missing token'}), 403
     try:
-        send_daily_agenda()
-        return jsonify({'status': 'ok'})
+        summary = send_daily_agenda()
+        return jsonify({'status': 'ok', 'summary': summary})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    """内部キューなどのメトリクスを返す"""
+    from flask import request, jsonify
+    secret_token = os.environ.get('DAILY_AGENDA_SECRET_TOKEN')
+    req_token = request.args.get('token')
+    if not secret_token or req_token != secret_token:
+        return jsonify({'status': 'error', 'message': 'Invalid or missing token'}), 403
+    return jsonify({
+        'webhook_queue': webhook_queue.stats(),
+        'calendar_service_cache': service_cache.stats(),
+        'credentials_cache': credentials_cache.stats(),
+        'token_refresh': dict(token_refresher.stats(), refreshes_by_source=refresh_stats()),
+        'calendar_discovery': calendar_discovery_stats(),
+        'calendar_mirror': calendar_mirror.stats(),
+        'db_pool': db_helper.pool_stats(),
+        'session_cache': db_helper.session_cache.stats() if db_helper.session_cache else None,
+        'ai_response_cache': ai_response_cache_stats(),
+        'intent_rules': intent_rule_stats(),
+        'openai_usage': ai_usage_stats(),
+        'model_router': model_router_stats(),
+    })
+
 @app.route('/api/debug_users', methods=['GET'])
 def api_debug_users():
     import os
@@ -488,9 +581,10 @@ def api_debug_users():
         return jsonify({'status': 'error', 'message': 'Invalid or missing token'}), 403
     from db import DBHelper
     db = DBHelper()
-    c = db.conn.cursor()
-    c.execute('SELECT line_user_id, LENGTH(google_token), created_at, updated_at FROM users')
-    rows = c.fetchall()
+    with db.connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT line_user_id, LENGTH(google_token), created_at, updated_at FROM users')
+        rows = c.fetchall()
     return jsonify({'users': rows})
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+空き時間計算のベンチマーク
+1か月分の予定に対して、日付ごとの find_free_slots_for_day（予定リスト渡し）・
+BusyIntervalIndex・BusyMinuteBitmap の処理時間を比較する
+
+使い方: python bench_availability.py [日数] [1日あたりの予定数] [繰り返し回数]
+"""
+
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from busy_index import BusyIntervalIndex, BusyMinuteBitmap, bitmap_available
+from calendar_service import GoogleCalendarService
+
+JST = pytz.timezone('Asia/Tokyo')
+TRAVEL_MINUTES = 30
+REQUIRED_MINUTES = 120
+
+
+def make_events(days, per_day, seed=0):
+    random.seed(seed)
+    start = JST.localize(datetime(2025, 3, 1))
+    events = []
+    for d in range(days):
+        for _ in range(per_day):
+            s = start + timedelta(days=d, minutes=random.randrange(6 * 60, 23 * 60, 15))
+            e = s + timedelta(minutes=random.choice([30, 60, 90, 120]))
+            events.append({'title': 'bench', 'start': s.isoformat(), 'end': e.isoformat(), 'all_day': False})
+    return start, start + timedelta(days=days), events
+
+
+def frames_for(start, days):
+    return [(start + timedelta(days=d, hours=8), start + timedelta(days=d, hours=22)) for d in range(days)]
+
+
+def pad_and_filter(slots):
+    """現行の handler と同じく、空き枠ごとに移動時間を引いて必要時間で絞り込む"""
+    result = []
+    for slot in slots:
+        s = datetime.strptime(slot['start'], "%H:%M") + timedelta(minutes=TRAVEL_MINUTES)
+        e = datetime.strptime(slot['end'], "%H:%M") - timedelta(minutes=TRAVEL_MINUTES)
+        if s < e and (e - s).total_seconds() / 60 >= REQUIRED_MINUTES:
+            result.append({'start': s.strftime("%H:%M"), 'end': e.strftime("%H:%M")})
+    return result
+
+
+def bench_list(service, start, end, events, frames):
+    return [pad_and_filter(service.find_free_slots_for_day(s, e, events)) for s, e in frames]
+
+
+def bench_interval(service, start, end, events, frames):
+    busy_index = BusyIntervalIndex(events, JST)
+    return [pad_and_filter(service.find_free_slots_for_day(s, e, busy_index)) for s, e in frames]
+
+
+def bench_bitmap(service, start, end, events, frames):
+    bitmap = BusyMinuteBitmap(events, start, end, JST)
+    return bitmap.free_slots_for_frames(frames, min_minutes=REQUIRED_MINUTES, pad_minutes=TRAVEL_MINUTES)
+
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 31
+    per_day = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    service = GoogleCalendarService()
+    start, end, events = make_events(days, per_day)
+    frames = frames_for(start, days)
+
+    benches = [('list', bench_list), ('interval', bench_interval)]
+    if bitmap_available():
+        benches.append(('bitmap', bench_bitmap))
+    else:
+        print("numpy がないため bitmap はスキップします")
+
+    print(f"{days}日 × {per_day}件/日, 移動{TRAVEL_MINUTES}分, 必要{REQUIRED_MINUTES}分, {repeat}回")
+    expected = None
+    for name, func in benches:
+        result = func(service, start, end, events, frames)
+        if expected is None:
+            expected = result
+        elif result != expected:
+            print(f"⚠️ {name} の結果が list と一致しません")
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func(service, start, end, events, frames)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+        print(f"{name:>8}: {elapsed_ms:8.2f} ms/回")
+
+
+if __name__ == "__main__":
+    main()
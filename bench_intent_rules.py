@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+ルールでの解釈（intent_rules）のベンチマーク
+よく来るメッセージのコーパスのうち、LLMを呼ばずに解釈できる割合と1件あたりの処理時間を表示する
+
+使い方: python bench_intent_rules.py [コーパスファイル（1行1メッセージ、\\n で改行）]
+"""
+
+import sys
+import time
+
+from intent_rules import match_intent
+
+# 実際の問い合わせに多い形を集めたコーパス（LLMが必要なものも含む）
+CORPUS = [
+    '明日の空き時間',
+    '今日の空き時間',
+    '本日の空き時間を教えて',
+    '明日空いてる？',
+    '明後日の空き状況',
+    '来週の空き時間',
+    '来週空いてる時間ある？',
+    '明日の10時-18時の空き時間',
+    '明日18時以降空いてる？',
+    '今日の予定',
+    '明日の予定',
+    '本日の予定は？',
+    '来週の予定を教えて',
+    '7/15 15:00〜16:00の空き時間',
+    '4/6 10:00-12:00',
+    '4/6(月) 10:00-12:00/14:00-16:00',
+    '4/6 10:00-12:00\n4/7 13:00-15:00\n4/8 9:00-10:30',
+    '4/6 15:00 なみさん',
+    '明日 10:00-11:00 歯医者',
+    '5/1 19:00 飲み会',
+    '明日の午前9時から会議を追加して',
+    '明日 10:00 会議を追加して',
+    '明日 15:00 歯医者の予約を入れて',
+    '4/6 10:00-12:00 でお願いします',
+    '来週月曜日の14時から打ち合わせ',
+    '4/15までの9:00〜18:00が空いている日程出して',
+    '3月で2時間打ち合わせできる日',
+    '明日の午後に1時間打ち合わせ 移動30分',
+    '来月の空き時間',
+    '11月2週目の空き時間',
+    '16日11:30-14:00/15:00-17:00',
+    '今日から1週間の空き時間',
+    'はい',
+]
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip('\n').replace('\\n', '\n') for line in f if line.strip()]
+
+
+def main():
+    corpus = load_corpus(sys.argv[1]) if len(sys.argv) > 1 else CORPUS
+    local = []
+    fallback = []
+    for text in corpus:
+        (local if match_intent(text) is not None else fallback).append(text)
+    repeat = 100
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in corpus:
+            match_intent(text)
+    elapsed_us = (time.perf_counter() - started) * 1_000_000 / (repeat * len(corpus))
+
+    print(f"メッセージ数: {len(corpus)}")
+    print(f"ルールで解釈（LLM呼び出しなし）: {len(local)}件 ({len(local) / len(corpus):.0%})")
+    print(f"LLMへ: {len(fallback)}件")
+    print(f"ルール判定: {elapsed_us:.1f} µs/件")
+    print("\n--- LLMへ回したメッセージ ---")
+    for text in fallback:
+        print(f"  {text!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+DBクエリ1回あたりのオーバーヘッドのベンチマーク
+users の主キー検索（get_google_token と同じ文）を繰り返し実行し、
+以前の書き方（メソッド内で分岐してSQL文字列を直接 execute）とクエリ層経由の処理時間を比較する
+
+SQLite は一時ファイルで計測する。DATABASE_URL が設定されていれば PostgreSQL でも
+PREPARE なし（毎回SQLを送ってパース）と PREPARE/EXECUTE を比較する
+
+使い方: python bench_queries.py [繰り返し回数]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import queries
+from db import DBHelper
+
+USER_ID = 'bench-user'
+LEGACY_PG_SQL = 'SELECT google_token FROM users WHERE line_user_id=%s'
+LEGACY_SQLITE_SQL = 'SELECT google_token FROM users WHERE line_user_id=?'
+
+
+def legacy(db, conn):
+    c = conn.cursor()
+    if db.is_postgres:
+        c.execute(LEGACY_PG_SQL, (USER_ID,))
+    else:
+        c.execute(LEGACY_SQLITE_SQL, (USER_ID,))
+    return c.fetchone()
+
+
+def layered(db, conn):
+    return db._execute(conn, queries.GET_GOOGLE_TOKEN, (USER_ID,)).fetchone()
+
+
+def run(label, func, db, conn, repeat):
+    func(db, conn)  # PREPARE・文キャッシュの準備
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(db, conn)
+    elapsed_us = (time.perf_counter() - started) * 1_000_000 / repeat
+    print(f"{label:>28}: {elapsed_us:8.1f} µs/クエリ")
+
+
+def bench_sqlite(repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        saved_url = os.environ.pop('DATABASE_URL', None)
+        try:
+            db = DBHelper(db_path=db_path)
+        finally:
+            if saved_url is not None:
+                os.environ['DATABASE_URL'] = saved_url
+        db.save_google_token(USER_ID, b'x' * 300)
+        print(f"SQLite ({repeat}回)")
+        with db.connection() as conn:
+            run('以前の書き方', legacy, db, conn, repeat)
+            run('クエリ層', layered, db, conn, repeat)
+        # 参考: 文キャッシュなし（毎回パース）
+        uncached = sqlite3.connect(db_path, cached_statements=0)
+        run('クエリ層（文キャッシュなし）', layered, db, uncached, repeat)
+        uncached.close()
+        db.close()
+
+
+def bench_postgres(repeat):
+    db = DBHelper()
+    if not db.is_postgres:
+        return
+    db.save_google_token(USER_ID, b'x' * 300)
+    print(f"PostgreSQL ({repeat}回)")
+    with db.connection() as conn:
+        run('以前の書き方', legacy, db, conn, repeat)
+        db.use_prepared = False
+        run('クエリ層（PREPAREなし）', layered, db, conn, repeat)
+        db.use_prepared = True
+        run('クエリ層（PREPARE/EXECUTE）', layered, db, conn, repeat)
+        c = conn.cursor()
+        c.execute('DELETE FROM users WHERE line_user_id=%s', (USER_ID,))
+        conn.commit()
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench_sqlite(repeat)
+    if os.getenv('DATABASE_URL'):
+        bench_postgres(max(1, repeat // 10))
+    else:
+        print("DATABASE_URL が未設定のため PostgreSQL はスキップします")
+
+
+if __name__ == "__main__":
+    main()
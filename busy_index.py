@@ -0,0 +1,181 @@
+from bisect import bisect_right
+from datetime import datetime
+import pytz
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def bitmap_available():
+    """BusyMinuteBitmap（numpy）が使えるかどうか"""
+    return np is not None
+
+
+def _event_time(value):
+    """イベントの start/end（文字列 or {'dateTime'/'date'} の辞書）をISO文字列で返します"""
+    if isinstance(value, dict):
+        return value.get('dateTime', value.get('date'))
+    return value
+
+
+def _to_epoch_minutes(dt, tz, round_up=False):
+    if dt.tzinfo is None:
+        dt = tz.localize(dt)
+    seconds = int(dt.timestamp())
+    if round_up:
+        return -(-seconds // 60)
+    return seconds // 60
+
+
+class BusyIntervalIndex:
+    """予定を epoch 分の整数区間にして、ソート・マージした状態で保持する空き時間インデックス
+
+    取得した範囲の予定から1度だけ作れば、同じ範囲内の複数の枠・複数の日付について
+    ISO文字列の再パースや再ソートなしで空き時間を求められる。
+    終日予定（all_day フラグ付き・日付のみ）は空き計算に含めない。
+    """
+
+    def __init__(self, events=None, tz=None):
+        self.tz = tz or pytz.timezone('Asia/Tokyo')
+        intervals = []
+        for event in events or []:
+            if event.get('all_day'):
+                continue
+            start = _event_time(event.get('start'))
+            end = _event_time(event.get('end'))
+            if not start or not end or 'T' not in str(start):
+                # 終日（日付のみ）や時刻なしは空き計算に含めない（場所ラベル等）
+                continue
+            start_min = _to_epoch_minutes(datetime.fromisoformat(str(start).replace('Z', '+00:00')), self.tz)
+            end_min = _to_epoch_minutes(datetime.fromisoformat(str(end).replace('Z', '+00:00')), self.tz, round_up=True)
+            if end_min > start_min:
+                intervals.append((start_min, end_min))
+
+        intervals.sort()
+        self.starts = []
+        self.ends = []
+        for start_min, end_min in intervals:
+            if self.ends and start_min <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end_min)
+            else:
+                self.starts.append(start_min)
+                self.ends.append(end_min)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def free_intervals(self, start_min, end_min, min_minutes=0):
+        """[start_min, end_min) 内の空き区間 (開始分, 終了分) のリストを返します"""
+        free = []
+        current = start_min
+        i = bisect_right(self.ends, start_min)
+        while i < len(self.starts) and self.starts[i] < end_min:
+            if current < self.starts[i]:
+                free.append((current, self.starts[i]))
+            current = max(current, self.ends[i])
+            i += 1
+        if current < end_min:
+            free.append((current, end_min))
+        if min_minutes:
+            free = [(s, e) for s, e in free if e - s >= min_minutes]
+        return free
+
+    def free_slots(self, start_dt, end_dt, min_minutes=0):
+        """枠 [start_dt, end_dt) 内の空き時間を [{'start': 'HH:MM', 'end': 'HH:MM'}] で返します"""
+        start_min = _to_epoch_minutes(start_dt, self.tz)
+        end_min = _to_epoch_minutes(end_dt, self.tz)
+        return [
+            {'start': self._format(s), 'end': self._format(e)}
+            for s, e in self.free_intervals(start_min, end_min, min_minutes)
+        ]
+
+    def free_slots_for_frames(self, frames, min_minutes=0):
+        """複数の枠 [(start_dt, end_dt), ...] の空き時間を枠の順にまとめて返します"""
+        return [self.free_slots(start_dt, end_dt, min_minutes) for start_dt, end_dt in frames]
+
+    def _format(self, epoch_minutes):
+        return datetime.fromtimestamp(epoch_minutes * 60, self.tz).strftime('%H:%M')
+
+
+class BusyMinuteBitmap:
+    """期間内の予定を1分単位のNumPyブール配列にラスタライズした空き時間計算
+
+    月単位の検索向け。全枠を1本の配列に並べて空きの連続区間（ランレングス）をまとめて求め、
+    移動時間の前後パディングと必要時間での絞り込みも配列演算で行う。numpy が必要。
+    """
+
+    MINUTES_PER_DAY = 24 * 60
+
+    def __init__(self, events, span_start, span_end, tz=None):
+        if np is None:
+            raise RuntimeError("BusyMinuteBitmap を使うには numpy が必要です")
+        busy_index = events if isinstance(events, BusyIntervalIndex) else BusyIntervalIndex(events, tz)
+        self.tz = tz or busy_index.tz
+        self.origin = _to_epoch_minutes(span_start, self.tz)
+        self.size = max(0, _to_epoch_minutes(span_end, self.tz) - self.origin)
+        # origin からの分オフセットを時刻表示に直すための補正（origin の時刻ぶん）
+        origin_dt = datetime.fromtimestamp(self.origin * 60, self.tz)
+        self.origin_minute_of_day = origin_dt.hour * 60 + origin_dt.minute
+
+        starts = np.clip(np.asarray(busy_index.starts, dtype=np.int64) - self.origin, 0, self.size)
+        ends = np.clip(np.asarray(busy_index.ends, dtype=np.int64) - self.origin, 0, self.size)
+        delta = np.zeros(self.size + 1, dtype=np.int32)
+        np.add.at(delta, starts, 1)
+        np.add.at(delta, ends, -1)
+        self.busy = np.cumsum(delta[:-1]) > 0
+
+    def offset(self, dt):
+        """datetime を配列上の分オフセットにします"""
+        return _to_epoch_minutes(dt, self.tz) - self.origin
+
+    def free_runs(self, windows, min_minutes=0, pad_minutes=0):
+        """分オフセットの枠 [(start, end), ...] ごとに空き区間 (開始, 終了) のリストを返します
+
+        空き区間は前後から pad_minutes ずつ削り、その後 min_minutes 未満のものを除く。
+        """
+        results = [[] for _ in windows]
+        segments = []
+        for i, (start, end) in enumerate(windows):
+            start = max(0, start)
+            end = min(self.size, end)
+            if start < end:
+                segments.append((i, start, end))
+        if not segments:
+            return results
+
+        # 各枠を1本に並べ、枠の間に「空きでない」区切りを1つずつ挟む
+        positions = np.concatenate([np.arange(start, end + 1) for _, start, end in segments])
+        separators = np.cumsum([end - start + 1 for _, start, end in segments]) - 1
+        free = ~self.busy[np.minimum(positions, self.size - 1)]
+        free[separators] = False
+
+        edges = np.diff(np.concatenate(([0], free.astype(np.int8), [0])))
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+
+        segment_bases = np.concatenate(([0], separators[:-1] + 1))
+        segment_of_run = np.searchsorted(segment_bases, run_starts, side='right') - 1
+        offsets = positions[segment_bases[segment_of_run]] - segment_bases[segment_of_run]
+        abs_starts = run_starts + offsets + pad_minutes
+        abs_ends = run_ends + offsets - pad_minutes
+        keep = abs_ends - abs_starts > 0
+        if min_minutes:
+            keep &= abs_ends - abs_starts >= min_minutes
+
+        for seg, s, e in zip(segment_of_run[keep], abs_starts[keep], abs_ends[keep]):
+            results[segments[seg][0]].append((int(s), int(e)))
+        return results
+
+    def free_slots_for_frames(self, frames, min_minutes=0, pad_minutes=0):
+        """複数の枠 [(start_dt, end_dt), ...] の空き時間を [{'start','end'}] のリストで返します"""
+        windows = [(self.offset(start_dt), self.offset(end_dt)) for start_dt, end_dt in frames]
+        return [
+            [{'start': self.format(s), 'end': self.format(e)} for s, e in runs]
+            for runs in self.free_runs(windows, min_minutes, pad_minutes)
+        ]
+
+    def format(self, offset):
+        minute_of_day = (self.origin_minute_of_day + offset) % self.MINUTES_PER_DAY
+        return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
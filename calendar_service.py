@@ -1,14 +1,25 @@
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient import discovery_cache
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+import google_auth_httplib2
+import httplib2
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import json
 import os
 import pickle
+import threading
+import time
 import pytz
 from config import Config
 from dateutil import parser
-from db import DBHelper
+from db import DBHelper, register_token_listener
+from busy_index import BusyIntervalIndex
+from token_store import CredentialsCache, decode_credentials, refresh_and_save, token_fingerprint
 import logging
 
 logger = logging.getLogger("calendar_service")
@@ -61,6 +72,439 @@ def _event_is_all_day_for_availability(api_event, tz):
     return False
 
 
+def _build_request(http, *args, **kwargs):
+    """リクエストごとに新しいHttpを使う（キャッシュしたserviceを複数スレッドで共有するため）"""
+    new_http = google_auth_httplib2.AuthorizedHttp(http.credentials, http=httplib2.Http())
+    return HttpRequest(new_http, *args, **kwargs)
+
+
+_discovery_lock = threading.Lock()
+_calendar_discovery_doc = None
+_calendar_discovery_info = {'source': None, 'load_ms': None}
+
+
+def load_calendar_discovery():
+    """Calendar v3 のディスカバリドキュメント（dict）を返します
+
+    プロセス内では1度だけ読み込んでメモリに保持する。読み込み元はディスク上のキャッシュファイル、
+    なければ google-api-python-client 同梱の静的ドキュメントで、後者はキャッシュファイルに書き出す。
+    どちらも使えない場合は None を返し、呼び出し側は通常の build() にフォールバックする。
+    """
+    global _calendar_discovery_doc
+    if _calendar_discovery_doc is not None:
+        return _calendar_discovery_doc
+
+    with _discovery_lock:
+        if _calendar_discovery_doc is not None:
+            return _calendar_discovery_doc
+
+        started = time.monotonic()
+        doc = None
+        source = None
+        path = Config.CALENDAR_DISCOVERY_FILE
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    doc = json.load(f)
+                source = 'disk'
+            except Exception as e:
+                logger.warning(f"ディスカバリキャッシュの読み込みに失敗: {path}: {e}")
+                doc = None
+
+        if doc is None:
+            content = discovery_cache.get_static_doc('calendar', 'v3')
+            if content:
+                doc = json.loads(content)
+                source = 'bundled'
+                if path:
+                    try:
+                        tmp_path = f"{path}.tmp"
+                        with open(tmp_path, 'w', encoding='utf-8') as f:
+                            f.write(content)
+                        os.replace(tmp_path, path)
+                    except Exception as e:
+                        logger.warning(f"ディスカバリキャッシュの書き出しに失敗: {path}: {e}")
+
+        if doc is None:
+            logger.warning("Calendar v3 のディスカバリドキュメントが見つかりません。通常のbuild()を使用します")
+            return None
+
+        _calendar_discovery_doc = doc
+        _calendar_discovery_info['source'] = source
+        _calendar_discovery_info['load_ms'] = round((time.monotonic() - started) * 1000, 1)
+        logger.info(f"Calendar v3 ディスカバリドキュメント読み込み: source={source}, {_calendar_discovery_info['load_ms']}ms")
+        return doc
+
+
+def warm_calendar_discovery():
+    """起動時にディスカバリドキュメントを読み込んでおきます"""
+    return load_calendar_discovery() is not None
+
+
+def calendar_discovery_stats():
+    return dict(_calendar_discovery_info, loaded=_calendar_discovery_doc is not None)
+
+
+def _build_calendar_service(credentials):
+    """Calendar v3 のserviceオブジェクトを構築します（読み込み済みのディスカバリドキュメントを使用）"""
+    doc = load_calendar_discovery()
+    if doc is not None:
+        return build_from_document(doc, credentials=credentials, requestBuilder=_build_request)
+    return build('calendar', 'v3', credentials=credentials, requestBuilder=_build_request)
+
+
+# 近い日付は1回の範囲クエリにまとめる（この日数以内の間隔なら同じ範囲に含める）
+EVENTS_RANGE_COALESCE_GAP_DAYS = 3
+
+
+def _coalesce_date_runs(dates, max_gap_days=EVENTS_RANGE_COALESCE_GAP_DAYS):
+    """日付を昇順に並べ、近い日付同士を (開始日, 終了日) の範囲にまとめます"""
+    runs = []
+    for d in sorted(set(dates)):
+        if runs and (d - runs[-1][1]).days <= max_gap_days:
+            runs[-1][1] = d
+        else:
+            runs.append([d, d])
+    return [(start, end) for start, end in runs]
+
+
+def _event_span(api_event, tz):
+    """APIイベントの開始・終了を tz 付き datetime で返します（終日は子夜〜終了日の子夜）"""
+    try:
+        spans = []
+        for key in ('start', 'end'):
+            value = api_event.get(key) or {}
+            if value.get('dateTime'):
+                dt = parser.isoparse(value['dateTime'])
+                if dt.tzinfo is None:
+                    dt = tz.localize(dt)
+                spans.append(dt.astimezone(tz))
+            elif value.get('date'):
+                d = datetime.strptime(value['date'], '%Y-%m-%d')
+                spans.append(tz.localize(d))
+            else:
+                return None
+        return spans[0], spans[1]
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+# events().list の1ページ上限と、レスポンスに含めるフィールド（使う属性だけに絞る）
+EVENTS_PAGE_SIZE = 2500
+EVENTS_LIST_FIELDS = 'nextPageToken,items(id,status,summary,start,end)'
+
+
+def _iter_events(service, time_min, time_max, page_size=EVENTS_PAGE_SIZE):
+    """events().list をページングしながらイベントを1件ずつ返します
+
+    次のページは前のページを読み終えてから取得するため、途中で打ち切れば以降のリクエストは発生しない。
+    """
+    for events_result in _iter_event_pages(
+        service,
+        timeMin=time_min,
+        timeMax=time_max,
+        orderBy='startTime',
+        maxResults=page_size,
+        fields=EVENTS_LIST_FIELDS
+    ):
+        for event in events_result.get('items', []):
+            yield event
+
+
+def _iter_event_pages(service, **params):
+    """events().list のレスポンスを1ページずつ返します（singleEvents=True固定）"""
+    page_token = None
+    while True:
+        events_result = service.events().list(
+            calendarId=Config.GOOGLE_CALENDAR_ID,
+            singleEvents=True,
+            pageToken=page_token,
+            **params
+        ).execute()
+        yield events_result
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            break
+
+
+class CalendarServiceCache:
+    """LINEユーザーIDごとに構築済みのCalendar serviceを保持するLRU/TTLキャッシュ
+
+    TTLを過ぎたエントリは即座に捨てず、DB上のトークンが変わっていなければ再利用する。
+    トークンの保存（認証・リフレッシュ）時は register_token_listener 経由で無効化される。
+    """
+
+    def __init__(self, max_size=256, ttl_seconds=600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, line_user_id):
+        """エントリを返します。TTL切れの場合は ('stale', entry) として返します"""
+        with self._lock:
+            entry = self._entries.get(line_user_id)
+            if entry is None:
+                return None, None
+            credentials = entry['credentials']
+            if credentials is None or credentials.expired:
+                # アクセストークン期限切れはリフレッシュが必要なので作り直す
+                del self._entries[line_user_id]
+                return None, None
+            self._entries.move_to_end(line_user_id)
+            if time.monotonic() - entry['cached_at'] >= self.ttl_seconds:
+                return 'stale', entry
+            return 'fresh', entry
+
+    def put(self, line_user_id, service, credentials, fingerprint):
+        with self._lock:
+            self._entries[line_user_id] = {
+                'service': service,
+                'credentials': credentials,
+                'fingerprint': fingerprint,
+                'cached_at': time.monotonic(),
+            }
+            self._entries.move_to_end(line_user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def touch(self, line_user_id):
+        """トークンが変わっていないことを確認できたエントリの有効期限を延長します"""
+        with self._lock:
+            entry = self._entries.get(line_user_id)
+            if entry is not None:
+                entry['cached_at'] = time.monotonic()
+                self.revalidations += 1
+
+    def invalidate(self, line_user_id):
+        with self._lock:
+            if self._entries.pop(line_user_id, None) is not None:
+                self.invalidations += 1
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+                'revalidations': self.revalidations,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
+
+
+# プロセス内で共有するserviceキャッシュ（DBHelper/GoogleCalendarServiceはインスタンスが複数あるため）
+service_cache = CalendarServiceCache(
+    max_size=Config.CALENDAR_SERVICE_CACHE_SIZE,
+    ttl_seconds=Config.CALENDAR_SERVICE_CACHE_TTL
+)
+register_token_listener(service_cache.invalidate)
+
+# デコード済みCredentialsのキャッシュ（トークンのpickle/JSONデコードを毎回行わない）
+credentials_cache = CredentialsCache(max_size=Config.CALENDAR_SERVICE_CACHE_SIZE)
+register_token_listener(credentials_cache.invalidate)
+
+
+def remember_refreshed_credentials(line_user_id, token_data, credentials):
+    """先行リフレッシュ済みのCredentialsをキャッシュに入れ、次のリクエストでデコードせずに使えるようにします"""
+    credentials_cache.put(line_user_id, token_fingerprint(token_data), credentials)
+
+
+MIRROR_LIST_FIELDS = 'nextPageToken,nextSyncToken,items(id,status,summary,start,end)'
+
+
+def _utc_key(dt):
+    """ミラーの範囲検索に使う比較可能なUTC文字列"""
+    return dt.astimezone(pytz.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class CalendarEventMirror:
+    """syncToken の差分同期で維持する、ユーザーごとのローカルイベントミラー（DBHelperのDBに保存）
+
+    今日から window_days 日分をフル同期したあとは events().list(syncToken=...) で差分だけを取り込み、
+    ミラー対象期間に収まる範囲の問い合わせはDBから返す。syncToken が失効（410 Gone）したらフル同期し直す。
+    """
+
+    def __init__(self, window_days=62, min_sync_interval=5):
+        self.window_days = window_days
+        self.min_sync_interval = min_sync_interval
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._last_sync = {}
+        self.full_syncs = 0
+        self.delta_syncs = 0
+        self.delta_skipped = 0
+        self.resyncs_gone = 0
+        self.served = 0
+        self.bypassed = 0
+
+    def _user_lock(self, line_user_id):
+        with self._locks_guard:
+            lock = self._locks.get(line_user_id)
+            if lock is None:
+                lock = self._locks[line_user_id] = threading.Lock()
+            return lock
+
+    def mark_dirty(self, line_user_id):
+        """自分で予定を追加したあとなど、次回は必ず差分同期するようにします"""
+        self._last_sync.pop(line_user_id, None)
+
+    def _window(self):
+        jst = pytz.timezone('Asia/Tokyo')
+        today = jst.localize(datetime.combine(datetime.now(jst).date(), datetime.min.time()))
+        return today - timedelta(days=1), today + timedelta(days=self.window_days + 1)
+
+    def get_events(self, db_helper, service, line_user_id, utc_start, utc_end):
+        """[utc_start, utc_end) に重なるAPIイベントをミラーから返します。ミラーで答えられない範囲なら None"""
+        start_key = _utc_key(utc_start)
+        end_key = _utc_key(utc_end)
+        with self._user_lock(line_user_id):
+            state = db_helper.get_calendar_sync_state(line_user_id)
+            covered = (
+                state is not None and state['sync_token']
+                and state['window_start'] <= start_key and end_key <= state['window_end']
+            )
+            if covered:
+                # 410 Gone でフル同期し直すと対象期間が今日基準に変わるので、同期後の期間で確かめ直す
+                window_start_key, window_end_key = self._delta_sync(db_helper, service, line_user_id, state)
+                if not (window_start_key <= start_key and end_key <= window_end_key):
+                    self.bypassed += 1
+                    return None
+            else:
+                window_start, window_end = self._window()
+                if not (_utc_key(window_start) <= start_key and end_key <= _utc_key(window_end)):
+                    self.bypassed += 1
+                    return None
+                if not self._full_sync(db_helper, service, line_user_id, window_start, window_end):
+                    self.bypassed += 1
+                    return None
+            rows = db_helper.get_mirrored_events(line_user_id, start_key, end_key)
+        self.served += 1
+        return [json.loads(row) for row in rows]
+
+    def _full_sync(self, db_helper, service, line_user_id, window_start, window_end):
+        jst = pytz.timezone('Asia/Tokyo')
+        upserts = []
+        sync_token = None
+        for events_result in _iter_event_pages(
+            service,
+            timeMin=window_start.astimezone(pytz.UTC).isoformat(),
+            timeMax=window_end.astimezone(pytz.UTC).isoformat(),
+            maxResults=EVENTS_PAGE_SIZE,
+            fields=MIRROR_LIST_FIELDS
+        ):
+            for event in events_result.get('items', []):
+                row = _mirror_row(event, jst)
+                if row is not None and event.get('status') != 'cancelled':
+                    upserts.append(row)
+            sync_token = events_result.get('nextSyncToken') or sync_token
+        if not sync_token:
+            logger.warning(f"フル同期でnextSyncTokenが返りませんでした: {line_user_id}")
+            return False
+        db_helper.save_calendar_mirror(
+            line_user_id, upserts, [], sync_token,
+            window_start=_utc_key(window_start), window_end=_utc_key(window_end), replace=True
+        )
+        self._last_sync[line_user_id] = time.monotonic()
+        self.full_syncs += 1
+        logger.info(f"カレンダーミラーをフル同期: {line_user_id}, {len(upserts)}件")
+        return True
+
+    def _delta_sync(self, db_helper, service, line_user_id, state):
+        """差分同期し、同期後のミラー対象期間 (window_start, window_end)（UTCキー）を返します"""
+        last = self._last_sync.get(line_user_id)
+        if last is not None and time.monotonic() - last < self.min_sync_interval:
+            self.delta_skipped += 1
+            return state['window_start'], state['window_end']
+        jst = pytz.timezone('Asia/Tokyo')
+        upserts = []
+        deletes = []
+        sync_token = None
+        try:
+            for events_result in _iter_event_pages(
+                service,
+                syncToken=state['sync_token'],
+                maxResults=EVENTS_PAGE_SIZE,
+                fields=MIRROR_LIST_FIELDS
+            ):
+                for event in events_result.get('items', []):
+                    row = _mirror_row(event, jst)
+                    # ミラー対象期間から外れた予定は削除扱い
+                    if (
+                        event.get('status') == 'cancelled' or row is None
+                        or row[1] >= state['window_end'] or row[2] <= state['window_start']
+                    ):
+                        deletes.append(event['id'])
+                    else:
+                        upserts.append(row)
+                sync_token = events_result.get('nextSyncToken') or sync_token
+        except HttpError as e:
+            if getattr(e, 'resp', None) is not None and e.resp.status == 410:
+                logger.info(f"syncTokenが失効したためフル同期し直します: {line_user_id}")
+                self.resyncs_gone += 1
+                db_helper.clear_calendar_mirror(line_user_id)
+                window_start, window_end = self._window()
+                if not self._full_sync(db_helper, service, line_user_id, window_start, window_end):
+                    raise
+                return _utc_key(window_start), _utc_key(window_end)
+            raise
+        db_helper.save_calendar_mirror(line_user_id, upserts, deletes, sync_token or state['sync_token'])
+        self._last_sync[line_user_id] = time.monotonic()
+        self.delta_syncs += 1
+        return state['window_start'], state['window_end']
+
+    def stats(self):
+        return {
+            'window_days': self.window_days,
+            'full_syncs': self.full_syncs,
+            'delta_syncs': self.delta_syncs,
+            'delta_skipped': self.delta_skipped,
+            'resyncs_gone': self.resyncs_gone,
+            'served': self.served,
+            'bypassed': self.bypassed,
+        }
+
+
+def _mirror_row(api_event, tz):
+    """ミラーに保存する (event_id, start_utc, end_utc, event_json) を作ります"""
+    if not api_event.get('id'):
+        return None
+    span = _event_span(api_event, tz)
+    if span is None:
+        return None
+    stored = {key: api_event[key] for key in ('id', 'status', 'summary', 'start', 'end') if key in api_event}
+    return (
+        api_event['id'],
+        _utc_key(span[0]),
+        _utc_key(span[1]),
+        json.dumps(stored, ensure_ascii=False, separators=(',', ':'))
+    )
+
+
+calendar_mirror = CalendarEventMirror(
+    window_days=Config.CALENDAR_MIRROR_DAYS,
+    min_sync_interval=Config.CALENDAR_MIRROR_SYNC_INTERVAL
+)
+
+
 class GoogleCalendarService:
     def __init__(self):
         self.SCOPES = ['https://www.googleapis.com/auth/calendar']
@@ -82,84 +526,82 @@ class GoogleCalendarService:
             self.creds = None
         
         if self.creds:
-            self.service = build('calendar', 'v3', credentials=self.creds)
+            self.service = _build_calendar_service(self.creds)
         else:
             self.service = None  # 認証情報がなければserviceはNoneのまま
     
     def _get_user_credentials(self, line_user_id):
         """ユーザーの認証トークンをDBから取得"""
+        credentials, _ = self._load_user_credentials(line_user_id)
+        return credentials
+
+    def _load_user_credentials(self, line_user_id):
+        """ユーザーの認証情報と、対応するDB上のトークンのハッシュを返します"""
         try:
             token_data = self.db_helper.get_google_token(line_user_id)
 
             if not token_data:
                 logger.warning(f"トークンデータなし: user={line_user_id}")
-                return None
-
-            credentials = None
-
-            # まずpickle形式で試行
-            try:
-                if isinstance(token_data, (bytes, bytearray)):
-                    credentials = pickle.loads(token_data)
-                else:
-                    # memoryviewやその他の型の場合はbytesに変換
-                    if hasattr(token_data, 'tobytes'):
-                        token_bytes = token_data.tobytes()
-                    else:
-                        token_bytes = bytes(token_data)
-                    credentials = pickle.loads(token_bytes)
+                return None, None
 
-            except Exception as pickle_error:
-                # JSON形式で試行
-                try:
-                    import json
-                    from google.oauth2.credentials import Credentials
-
-                    # トークンデータを文字列に変換
-                    if isinstance(token_data, (bytes, bytearray)):
-                        token_str = token_data.decode('utf-8')
-                    elif hasattr(token_data, 'tobytes'):
-                        token_str = token_data.tobytes().decode('utf-8')
-                    else:
-                        token_str = str(token_data)
+            fingerprint = token_fingerprint(token_data)
 
-                    token_dict = json.loads(token_str)
-                    credentials = Credentials.from_authorized_user_info(token_dict)
+            # デコード済みで、DB上のトークンが変わっておらず期限も十分残っていればそのまま使う
+            credentials = credentials_cache.get(line_user_id, fingerprint)
+            if credentials is not None:
+                return credentials, fingerprint
 
-                except Exception as json_error:
-                    logger.error(f"トークン読み込みエラー: {json_error}")
-                    return None
+            try:
+                credentials = decode_credentials(token_data)
+            except Exception as decode_error:
+                logger.error(f"トークン読み込みエラー: {decode_error}")
+                return None, None
 
             if credentials:
                 # トークンの有効期限をチェック
                 if credentials.expired and credentials.refresh_token:
                     try:
-                        credentials.refresh(Request())
-                        # 更新されたトークンをDBに保存
-                        updated_token_data = pickle.dumps(credentials)
-                        self.db_helper.save_google_token(line_user_id, updated_token_data)
+                        # 更新されたトークンをDBに保存（通常は先行リフレッシュ済みでここには来ない）
+                        updated_token_data = refresh_and_save(self.db_helper, line_user_id, credentials, source='request')
+                        fingerprint = token_fingerprint(updated_token_data)
                         logger.info(f"トークンリフレッシュ完了: user={line_user_id}")
                     except Exception as refresh_error:
                         logger.error(f"トークンリフレッシュエラー: {refresh_error}")
 
-                return credentials
+                credentials_cache.put(line_user_id, fingerprint, credentials)
+                return credentials, fingerprint
             else:
                 logger.error(f"認証情報作成失敗: user={line_user_id}")
-                return None
+                return None, None
 
         except Exception as e:
             logger.error(f"認証情報取得エラー: {e}")
-            return None
+            return None, None
     
     def _get_calendar_service(self, line_user_id):
-        """ユーザーごとのGoogle Calendarサービスを取得"""
+        """ユーザーごとのGoogle Calendarサービスを取得（構築済みserviceはキャッシュして再利用）"""
         try:
-            credentials = self._get_user_credentials(line_user_id)
+            state, entry = service_cache.get(line_user_id)
+            if state == 'fresh':
+                service_cache.record(hit=True)
+                return entry['service']
+            if state == 'stale':
+                # TTL切れ: DB上のトークンが変わっていなければ構築済みのserviceを使い続ける
+                token_data = self.db_helper.get_google_token(line_user_id)
+                if token_data and token_fingerprint(token_data) == entry['fingerprint']:
+                    service_cache.touch(line_user_id)
+                    service_cache.record(hit=True)
+                    return entry['service']
+                service_cache.invalidate(line_user_id)
+
+            service_cache.record(hit=False)
+            credentials, fingerprint = self._load_user_credentials(line_user_id)
 
             if not credentials:
                 raise Exception("ユーザーの認証トークンが見つかりません。認証を完了してください。")
 
-            service = build('calendar', 'v3', credentials=credentials)
+            service = _build_calendar_service(credentials)
+            service_cache.put(line_user_id, service, credentials, fingerprint)
             return service
 
         except Exception as e:
@@ -176,14 +618,7 @@ class GoogleCalendarService:
                 s = dt.isoformat()
                 return s if s.endswith(("+09:00", "+00:00", "-0")) else s + "Z"
             # 指定された時間帯のイベントを取得
-            events_result = self.service.events().list(
-                calendarId=Config.GOOGLE_CALENDAR_ID,  # 'primary'（各ユーザーのメインカレンダー）
-                timeMin=iso_no_z(start_time),
-                timeMax=iso_no_z(end_time),
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
-            events = events_result.get('items', [])
+            events = list(_iter_events(self.service, iso_no_z(start_time), iso_no_z(end_time)))
             if not events:
                 return True, "指定された時間帯は空いています。"
             # 既存のイベント情報を取得
@@ -247,6 +682,8 @@ class GoogleCalendarService:
                 body=event
             ).execute()
             logger.info(f"[DEBUG] Google Calendar APIレスポンス: {event}")
+            if line_user_id:
+                calendar_mirror.mark_dirty(line_user_id)
             return True, "✅予定を追加しました", {
                 'title': title,
                 'start': start_time.isoformat(),
@@ -349,6 +786,8 @@ class GoogleCalendarService:
 
                 # バッチリクエストを実行
                 batch.execute()
+                if line_user_id:
+                    calendar_mirror.mark_dirty(line_user_id)
 
                 # チャンクの結果を全体に集計
                 total_results['success'].extend(chunk_results['success'])
@@ -370,59 +809,69 @@ class GoogleCalendarService:
             return 0, len(events_data), {'error': str(e)}
 
     def get_events_for_dates(self, dates, line_user_id=None):
-        """指定された日付のイベントを取得します（ユーザーごとの認証トークン対応、JST日付で正確に抽出）"""
-        import pytz
-        events_info = []
+        """指定された日付のイベントを取得します（ユーザーごとの認証トークン対応、JST日付で正確に抽出）
+
+        近い日付はまとめて1回の範囲クエリで取得し、結果をJSTの日付ごとに振り分ける。
+        戻り値は dates の順に {'date', 'events'}（失敗時は {'date', 'error'}）を並べたリスト。
+        """
         jst = pytz.timezone('Asia/Tokyo')
-        for date in dates:
-            # JST 0:00〜翌日0:00をUTCに変換
-            start_of_day_jst = jst.localize(datetime.combine(date, datetime.min.time()))
-            end_of_day_jst = start_of_day_jst + timedelta(days=1)
-            start_of_day_utc = start_of_day_jst.astimezone(pytz.UTC)
-            end_of_day_utc = end_of_day_jst.astimezone(pytz.UTC)
+        day_list = [d.date() if isinstance(d, datetime) else d for d in dates]
+        results = {}
+
+        service = None
+        auth_error = None
+        if day_list:
             try:
                 service = self._get_calendar_service(line_user_id) if line_user_id else self.service
-                if not service:
-                    events_info.append({
-                        'date': date.strftime('%Y-%m-%d'),
+            except Exception as e:
+                auth_error = str(e)
+
+        for run_start, run_end in _coalesce_date_runs(day_list):
+            run_days = [d for d in sorted(set(day_list)) if run_start <= d <= run_end]
+            if auth_error is not None:
+                for d in run_days:
+                    results[d] = {'date': d.strftime('%Y-%m-%d'), 'error': auth_error}
+                continue
+            if not service:
+                for d in run_days:
+                    results[d] = {
+                        'date': d.strftime('%Y-%m-%d'),
                         'events': [],
                         'error': 'Google認証が必要です。'
-                    })
-                    continue
-                events_result = service.events().list(
-                    calendarId=Config.GOOGLE_CALENDAR_ID,
-                    timeMin=start_of_day_utc.isoformat(),
-                    timeMax=end_of_day_utc.isoformat(),
-                    singleEvents=True,
-                    orderBy='startTime'
-                ).execute()
-                events = events_result.get('items', [])
-                if events:
-                    day_events = []
-                    for event in events:
-                        start = event['start'].get('dateTime', event['start'].get('date'))
-                        end = event['end'].get('dateTime', event['end'].get('date'))
-                        title = event.get('summary', 'タイトルなし')
-                        day_events.append({
-                            'title': title,
-                            'start': start,
-                            'end': end
-                        })
-                    events_info.append({
-                        'date': date.strftime('%Y-%m-%d'),
-                        'events': day_events
-                    })
-                else:
-                    events_info.append({
-                        'date': date.strftime('%Y-%m-%d'),
-                        'events': []
-                    })
+                    }
+                continue
+
+            # JST 開始日0:00〜終了日翌日0:00をUTCに変換
+            range_start = jst.localize(datetime.combine(run_start, datetime.min.time()))
+            range_end = jst.localize(datetime.combine(run_end + timedelta(days=1), datetime.min.time()))
+            buckets = {d: [] for d in run_days}
+            try:
+                for event in _iter_events(
+                    service,
+                    range_start.astimezone(pytz.UTC).isoformat(),
+                    range_end.astimezone(pytz.UTC).isoformat(),
+                ):
+                    span = _event_span(event, jst)
+                    if span is None:
+                        continue
+                    ev_start, ev_end = span
+                    for d in run_days:
+                        day_start = jst.localize(datetime.combine(d, datetime.min.time()))
+                        day_end = day_start + timedelta(days=1)
+                        if ev_start < day_end and (ev_end > day_start or ev_start >= day_start):
+                            buckets[d].append({
+                                'title': event.get('summary', 'タイトルなし'),
+                                'start': event['start'].get('dateTime', event['start'].get('date')),
+                                'end': event['end'].get('dateTime', event['end'].get('date'))
+                            })
             except Exception as e:
-                events_info.append({
-                    'date': date.strftime('%Y-%m-%d'),
-                    'error': str(e)
-                })
-        return events_info
+                for d in run_days:
+                    results[d] = {'date': d.strftime('%Y-%m-%d'), 'error': str(e)}
+                continue
+            for d in run_days:
+                results[d] = {'date': d.strftime('%Y-%m-%d'), 'events': buckets[d]}
+
+        return [dict(results[d]) for d in day_list]
     
     def get_events_for_time_range(self, start_time, end_time, line_user_id):
         """指定された時間範囲のイベントを取得します（Config.GOOGLE_CALENDAR_IDから取得）"""
@@ -440,41 +889,39 @@ class GoogleCalendarService:
             utc_start = start_time.astimezone(pytz.UTC)
             utc_end = end_time.astimezone(pytz.UTC)
 
-            # Config.GOOGLE_CALENDAR_IDから予定を取得（他のメソッドと同じ）
+            # ミラーで答えられる範囲ならDBから、そうでなければ Config.GOOGLE_CALENDAR_ID から直接取得
+            events = None
+            if Config.CALENDAR_MIRROR_ENABLED:
+                try:
+                    events = calendar_mirror.get_events(self.db_helper, service, line_user_id, utc_start, utc_end)
+                except Exception as e:
+                    logger.warning(f"カレンダーミラーの利用に失敗したため直接取得します: {e}")
+                    events = None
+            if events is None:
+                events = _iter_events(service, utc_start.isoformat(), utc_end.isoformat())
+
+            # ページを読みながら変換し、生のイベントは保持しない
+            event_list = []
             try:
-                events_result = service.events().list(
-                    calendarId=Config.GOOGLE_CALENDAR_ID,
-                    timeMin=utc_start.isoformat(),
-                    timeMax=utc_end.isoformat(),
-                    singleEvents=True,
-                    orderBy='startTime'
-                ).execute()
-
-                events = events_result.get('items', [])
-                logger.info(f"予定取得: {start_time.date()} - {end_time.date()}, {len(events)}件")
+                for event in events:
+                    start = event['start'].get('dateTime', event['start'].get('date'))
+                    end = event['end'].get('dateTime', event['end'].get('date'))
+                    title = event.get('summary', 'タイトルなし')
+                    # 終日は date のみのほか、dateTime で 1 日ぶんとして返る場合がある（空き計算から除外）
+                    all_day = _event_is_all_day_for_availability(event, jst)
+
+                    event_data = {
+                        'title': title,
+                        'start': start,
+                        'end': end,
+                        'all_day': all_day,
+                    }
+                    event_list.append(event_data)
+                logger.info(f"予定取得: {start_time.date()} - {end_time.date()}, {len(event_list)}件")
             except Exception as e:
                 logger.error(f"カレンダーからの予定取得エラー: {e}")
                 return []
 
-            if not events:
-                return []
-
-            event_list = []
-            for event in events:
-                start = event['start'].get('dateTime', event['start'].get('date'))
-                end = event['end'].get('dateTime', event['end'].get('date'))
-                title = event.get('summary', 'タイトルなし')
-                # 終日は date のみのほか、dateTime で 1 日ぶんとして返る場合がある（空き計算から除外）
-                all_day = _event_is_all_day_for_availability(event, jst)
-
-                event_data = {
-                    'title': title,
-                    'start': start,
-                    'end': end,
-                    'all_day': all_day,
-                }
-                event_list.append(event_data)
-
             return event_list
 
         except Exception as e:
@@ -484,7 +931,10 @@ class GoogleCalendarService:
             return []
     
     def find_free_slots_for_day(self, start_dt, end_dt, events):
-        """指定枠(start_dt, end_dt)内で既存予定を除いた空き時間帯リストを返す"""
+        """指定枠(start_dt, end_dt)内で既存予定を除いた空き時間帯リストを返す
+
+        events には予定のリストのほか、取得範囲から作った BusyIntervalIndex をそのまま渡せる。
+        """
         try:
             jst = pytz.timezone('Asia/Tokyo')
             if start_dt.tzinfo is None:
@@ -492,67 +942,8 @@ class GoogleCalendarService:
             if end_dt.tzinfo is None:
                 end_dt = jst.localize(end_dt)
 
-            # eventsがNoneや空の場合は必ず再取得
-            if events is None or len(events) == 0:
-                return [{
-                    'start': start_dt.strftime('%H:%M'),
-                    'end': end_dt.strftime('%H:%M')
-                }]
-
-            # 既存予定を時間順にbusy_timesへ
-            busy_times = []
-
-            for event in events:
-                if event.get('all_day'):
-                    continue
-                start = event['start'] if isinstance(event['start'], str) else event['start'].get('dateTime', event['start'].get('date'))
-                end = event['end'] if isinstance(event['end'], str) else event['end'].get('dateTime', event['end'].get('date'))
-                if not start or 'T' not in str(start):
-                    # 終日（日付のみ）や時刻なしは空き計算に含めない（場所ラベル等）
-                    continue
-
-                start_ev = datetime.fromisoformat(str(start).replace('Z', '+00:00'))
-                end_ev = datetime.fromisoformat(str(end).replace('Z', '+00:00'))
-
-                if end_ev <= start_dt or start_ev >= end_dt:
-                    continue
-
-                busy_start = max(start_ev, start_dt)
-                busy_end = min(end_ev, end_dt)
-                busy_times.append((busy_start, busy_end))
-
-            # 空き時間を計算
-            free_slots = []
-            if not busy_times:
-                free_slots.append({
-                    'start': start_dt.strftime('%H:%M'),
-                    'end': end_dt.strftime('%H:%M')
-                })
-                return free_slots
-
-            # busy_timesを開始時刻順に明示的にソート
-            busy_times = sorted(busy_times, key=lambda x: x[0])
-
-            current_time = start_dt
-
-            for busy_start, busy_end in busy_times:
-                if current_time < busy_start:
-                    free_slot = {
-                        'start': current_time.strftime('%H:%M'),
-                        'end': busy_start.strftime('%H:%M')
-                    }
-                    free_slots.append(free_slot)
-
-                current_time = max(current_time, busy_end)
-
-            if current_time < end_dt:
-                free_slot = {
-                    'start': current_time.strftime('%H:%M'),
-                    'end': end_dt.strftime('%H:%M')
-                }
-                free_slots.append(free_slot)
-
-            return free_slots
+            busy_index = events if isinstance(events, BusyIntervalIndex) else BusyIntervalIndex(events, jst)
+            return busy_index.free_slots(start_dt, end_dt)
 
         except Exception as e:
             logger.error(f"空き時間検索エラー: {e}")
@@ -14,6 +14,26 @@ class Config:
     # Google Calendar設定
     GOOGLE_CALENDAR_ID = 'primary'
     GOOGLE_CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE', 'credentials.json')
+    # credentials.json を置かない環境（GitHub Actions など）でのOAuthクライアント設定
+    GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
+    GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
+    # 起動時に旧形式（pickle）のトークンをJSON形式へ移行する
+    MIGRATE_TOKENS_ON_STARTUP = os.getenv('MIGRATE_TOKENS_ON_STARTUP', 'true').lower() == 'true'
+    # 期限が近いトークンの先行リフレッシュ（走査間隔秒・対象にする残り秒数・並列数）
+    TOKEN_REFRESH_ENABLED = os.getenv('TOKEN_REFRESH_ENABLED', 'true').lower() == 'true'
+    TOKEN_REFRESH_INTERVAL = int(os.getenv('TOKEN_REFRESH_INTERVAL', '300'))
+    TOKEN_REFRESH_WINDOW = int(os.getenv('TOKEN_REFRESH_WINDOW', '900'))
+    TOKEN_REFRESH_WORKERS = int(os.getenv('TOKEN_REFRESH_WORKERS', '4'))
+    # 構築済みCalendar serviceのキャッシュ（ユーザー数上限・再検証までの秒数）
+    CALENDAR_SERVICE_CACHE_SIZE = int(os.getenv('CALENDAR_SERVICE_CACHE_SIZE', '256'))
+    CALENDAR_SERVICE_CACHE_TTL = int(os.getenv('CALENDAR_SERVICE_CACHE_TTL', '600'))
+    # Calendar v3 ディスカバリドキュメントのキャッシュファイルと起動時の事前読み込み
+    CALENDAR_DISCOVERY_FILE = os.getenv('CALENDAR_DISCOVERY_FILE', 'calendar_v3_discovery.json')
+    PREWARM_CALENDAR_DISCOVERY = os.getenv('PREWARM_CALENDAR_DISCOVERY', 'true').lower() == 'true'
+    # syncTokenで差分同期するローカルイベントミラー（対象日数・差分同期の最短間隔秒）
+    CALENDAR_MIRROR_ENABLED = os.getenv('CALENDAR_MIRROR_ENABLED', 'true').lower() == 'true'
+    CALENDAR_MIRROR_DAYS = int(os.getenv('CALENDAR_MIRROR_DAYS', '62'))
+    CALENDAR_MIRROR_SYNC_INTERVAL = int(os.getenv('CALENDAR_MIRROR_SYNC_INTERVAL', '5'))
     
     # Flask設定
     FLASK_SECRET_KEY = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key')
@@ -21,7 +41,53 @@ class Config:
     # アプリケーション設定
     TIMEZONE = os.getenv('TIMEZONE', 'Asia/Tokyo')
     DEFAULT_EVENT_DURATION = int(os.getenv('DEFAULT_EVENT_DURATION', '60'))  # 分
-    
+    # 空き時間の計算方式（interval: 予定区間インデックス / bitmap: NumPyの分単位ビットマップ）
+    AVAILABILITY_BACKEND = os.getenv('AVAILABILITY_BACKEND', 'interval')
+
+    # Webhook処理設定（署名検証後すぐに200を返し、イベントはワーカーで処理）
+    WEBHOOK_ASYNC = os.getenv('WEBHOOK_ASYNC', 'true').lower() == 'true'
+    WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+    WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '100'))
+    # キューが満杯のときに空きを待つ秒数（待っても空かなければ503を返してLINEに再送させる）
+    WEBHOOK_SUBMIT_TIMEOUT = float(os.getenv('WEBHOOK_SUBMIT_TIMEOUT', '2'))
+
+    # 日次予定送信（並列数・ユーザーごとのタイムアウト秒・API呼び出しレート（回/秒））
+    DAILY_AGENDA_WORKERS = int(os.getenv('DAILY_AGENDA_WORKERS', '8'))
+    DAILY_AGENDA_USER_TIMEOUT = int(os.getenv('DAILY_AGENDA_USER_TIMEOUT', '30'))
+    GOOGLE_API_RATE_PER_SEC = float(os.getenv('GOOGLE_API_RATE_PER_SEC', '10'))
+    LINE_API_RATE_PER_SEC = float(os.getenv('LINE_API_RATE_PER_SEC', '50'))
+
+    # DB設定
+    # PostgreSQL接続プール（最小・最大接続数、空きを待つ最大秒数）
+    DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+    DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+    # PostgreSQLでクエリを接続ごとに PREPARE して EXECUTE で実行する
+    DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() == 'true'
+    # ユーザーごとに保持する会話履歴の件数（会話リングのスロット数）
+    CONVERSATION_HISTORY_SIZE = int(os.getenv('CONVERSATION_HISTORY_SIZE', '20'))
+    # ユーザーごとの認証状態・保留中の予定・直近の会話履歴のキャッシュ（ユーザー数上限・有効秒数・保持する履歴件数）
+    SESSION_CACHE_ENABLED = os.getenv('SESSION_CACHE_ENABLED', 'true').lower() == 'true'
+    SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '1024'))
+    SESSION_CACHE_TTL = int(os.getenv('SESSION_CACHE_TTL', '300'))
+    SESSION_CACHE_HISTORY = int(os.getenv('SESSION_CACHE_HISTORY', '10'))
+
+    # 定型の入力（「明日の空き時間」「4/6 10:00-12:00」など）をLLMを呼ばずにルールで解釈する
+    INTENT_RULES_ENABLED = os.getenv('INTENT_RULES_ENABLED', 'true').lower() == 'true'
+    # extract_dates_and_times のモデル振り分け（単純な入力は小さいモデル → 妥当でなければ大きいモデル）
+    # 小さいモデルに送る入力の最大文字数
+    AI_MODEL_ROUTING_ENABLED = os.getenv('AI_MODEL_ROUTING_ENABLED', 'true').lower() == 'true'
+    AI_SMALL_MODEL = os.getenv('AI_SMALL_MODEL', 'gpt-4o-mini')
+    AI_LARGE_MODEL = os.getenv('AI_LARGE_MODEL', 'gpt-4o')
+    AI_ROUTING_MAX_CHARS = int(os.getenv('AI_ROUTING_MAX_CHARS', '40'))
+    # AI応答キャッシュ（extract_dates_and_times の同じ文・同じ日の問い合わせでLLMを呼ばない）
+    # 件数上限・有効秒数・前の発言を参照する入力をキャッシュする会話履歴の件数上限・DBにも保存するか
+    AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'true').lower() == 'true'
+    AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', '512'))
+    AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', '3600'))
+    AI_CACHE_MAX_HISTORY = int(os.getenv('AI_CACHE_MAX_HISTORY', '2'))
+    AI_CACHE_PERSIST = os.getenv('AI_CACHE_PERSIST', 'false').lower() == 'true'
+
     @classmethod
     def validate_config(cls):
         """設定の妥当性をチェックします"""
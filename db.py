@@ -1,10 +1,19 @@
 import os
 import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import secrets
 import string
 import logging
 
+from config import Config
+import queries
+from session_cache import SessionCache
+from work_queue import percentile
+
 logger = logging.getLogger(__name__)
 
 try:
@@ -18,159 +27,272 @@ except ImportError:
 
 DB_PATH = 'line_calendar.db'
 
+# google_token が保存されたときに呼ばれるコールバック（キャッシュ無効化用）
+_token_listeners = []
+
+def register_token_listener(callback):
+    """google_tokenの保存時に callback(line_user_id) を呼ぶように登録します"""
+    if callback not in _token_listeners:
+        _token_listeners.append(callback)
+
+def _notify_token_saved(line_user_id):
+    for callback in list(_token_listeners):
+        try:
+            callback(line_user_id)
+        except Exception as e:
+            logger.warning(f"トークン更新通知でエラー: {e}")
+
+def _is_connection_error(e):
+    return psycopg2 is not None and isinstance(e, (psycopg2.InterfaceError, psycopg2.OperationalError))
+
+
+class PostgresPool:
+    """ThreadedConnectionPool に空き待ちと待ち時間の計測を足したラッパー
+
+    ThreadedConnectionPool は上限に達すると即座に PoolError を投げるため、セマフォで
+    空きが出るまで（最大 timeout 秒）待たせる。同じDSNのDBHelperは1つのプールを共有する。
+    """
+
+    def __init__(self, pool, maxconn, timeout, latency_window=500):
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self._pool = pool
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._lock = threading.Lock()
+        self._wait_times = deque(maxlen=latency_window)
+        self._max_wait = 0.0
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise psycopg2.pool.PoolError(f"接続プールの空きを{self.timeout}秒待ちましたが取得できませんでした")
+        wait = time.monotonic() - started
+        try:
+            conn = self._pool.getconn()
+            if conn.closed:
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_times.append(wait)
+            self._max_wait = max(self._max_wait, wait)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        try:
+            # 未コミットのトランザクションは ThreadedConnectionPool がロールバックしてから戻す
+            self._pool.putconn(conn, close=discard or bool(conn.closed))
+        except Exception as e:
+            logger.warning(f"接続の返却に失敗: {e}")
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                if discard:
+                    self._discarded += 1
+            self._slots.release()
+
+    def closeall(self):
+        try:
+            self._pool.closeall()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._lock:
+            wait_times = list(self._wait_times)
+            stats = {
+                'backend': 'postgres',
+                'max_size': self.maxconn,
+                'in_use': self._in_use,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'max_wait_ms': round(self._max_wait * 1000, 1),
+            }
+        stats['wait_ms_p50'] = round(percentile(wait_times, 50) * 1000, 1)
+        stats['wait_ms_p95'] = round(percentile(wait_times, 95) * 1000, 1)
+        return stats
+
+
+_pg_pools = {}
+_pg_pools_lock = threading.Lock()
+
+def _shared_pg_pool(dsn):
+    with _pg_pools_lock:
+        pool = _pg_pools.get(dsn)
+        if pool is None:
+            maxconn = max(1, Config.DB_POOL_MAX)
+            threaded_pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn=min(max(0, Config.DB_POOL_MIN), maxconn),
+                maxconn=maxconn,
+                dsn=dsn,
+                cursor_factory=psycopg2.extras.DictCursor
+            )
+            pool = _pg_pools[dsn] = PostgresPool(threaded_pool, maxconn, Config.DB_POOL_TIMEOUT)
+        return pool
+
+
+_session_caches = {}
+_session_caches_lock = threading.Lock()
+
+def _shared_session_cache(key):
+    """DBごと（PostgreSQLはDSN・SQLiteはファイル）に1つのセッションキャッシュを共有します"""
+    with _session_caches_lock:
+        cache = _session_caches.get(key)
+        if cache is None:
+            cache = _session_caches[key] = SessionCache(
+                max_size=Config.SESSION_CACHE_SIZE,
+                ttl_seconds=Config.SESSION_CACHE_TTL,
+                history_size=min(Config.SESSION_CACHE_HISTORY, Config.CONVERSATION_HISTORY_SIZE),
+            )
+            # トークン保存（認証・リフレッシュ）時は認証状態が変わりうるので捨てる
+            register_token_listener(cache.invalidate)
+        return cache
+
+
 class DBHelper:
     def __init__(self, db_path=DB_PATH):
         db_url = os.getenv('DATABASE_URL')
         self.is_postgres = False
         self.db_url = db_url
         self.db_path = db_path
+        # スレッドごとの状態（SQLiteの接続・PostgreSQLで借りている接続とネストの深さ）
+        self._local = threading.local()
+        self._sqlite_opened = 0
+        self._sqlite_lock = threading.Lock()
+        # PostgreSQLでサーバー側のプリペアドステートメントを使うか
+        self.use_prepared = Config.DB_PREPARED_STATEMENTS
+        # ユーザーごとに保持する会話履歴の件数（会話リングのスロット数）
+        self.history_size = max(1, Config.CONVERSATION_HISTORY_SIZE)
         
         if db_url and psycopg2 is not None:
             self.is_postgres = True
-            # 接続プールを作成
-            self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=10,
-                dsn=db_url,
-                cursor_factory=psycopg2.extras.DictCursor
-            )
-            self.conn = self._get_connection()
-        else:
-            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            # 接続プール（同じDSNのDBHelper間で共有）
+            self.connection_pool = _shared_pg_pool(db_url)
+        # ユーザーごとの認証状態・保留中の予定・直近の会話履歴のキャッシュ
+        self.session_cache = None
+        if Config.SESSION_CACHE_ENABLED:
+            self.session_cache = _shared_session_cache(db_url if self.is_postgres else os.path.abspath(db_path))
         
         self._init_tables()
 
-    def _get_connection(self):
-        """データベース接続を取得（再接続機能付き）"""
+    @contextmanager
+    def connection(self):
+        """1操作分の接続を借りて返すコンテキストマネージャ
+
+        PostgreSQLはプールから借りて抜けるときに返却し、SQLiteはスレッドごとの接続を使う。
+        同じスレッドで入れ子になった場合は外側と同じ接続を使う。
+        """
         if not self.is_postgres:
-            return self.conn
-        
+            conn = self._sqlite_connection()
+            try:
+                yield conn
+            except Exception:
+                conn.rollback()
+                raise
+            return
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            self._local.depth += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+        conn = self.connection_pool.getconn()
+        self._local.conn = conn
+        self._local.depth = 0
+        discard = False
         try:
-            # 接続プールから接続を取得
-            conn = self.connection_pool.getconn()
-            # 接続が有効かテスト
-            conn.cursor().execute('SELECT 1')
-            return conn
+            yield conn
         except Exception as e:
-            logger.warning(f"データベース接続エラー: {e}")
-            # 接続プールを再作成
-            try:
-                self.connection_pool.closeall()
-            except:
-                pass
-            self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=10,
-                dsn=self.db_url,
-                cursor_factory=psycopg2.extras.DictCursor
-            )
-            return self.connection_pool.getconn()
+            discard = _is_connection_error(e)
+            queries.forget_prepared(conn)
+            if not discard:
+                try:
+                    conn.rollback()
+                except Exception:
+                    discard = True
+            raise
+        finally:
+            self._local.conn = None
+            self.connection_pool.putconn(conn, discard=discard)
+
+    def _sqlite_connection(self):
+        conn = getattr(self._local, 'sqlite_conn', None)
+        if conn is None:
+            # 定義済みのクエリがすべて接続ごとの文キャッシュに収まるようにする
+            conn = sqlite3.connect(self.db_path, cached_statements=max(128, len(queries.QUERIES) * 2))
+            self._local.sqlite_conn = conn
+            with self._sqlite_lock:
+                self._sqlite_opened += 1
+        return conn
+
+    def pool_stats(self):
+        """接続プールの利用状況（待ち時間はミリ秒）"""
+        if self.is_postgres:
+            return self.connection_pool.stats()
+        with self._sqlite_lock:
+            return {'backend': 'sqlite', 'connections_opened': self._sqlite_opened}
 
     def _execute_with_retry(self, operation):
-        """データベース操作をリトライ機能付きで実行"""
+        """データベース操作をリトライ機能付きで実行
+
+        operation は呼ばれるたびに connection() で接続を借りる。切断された接続は返却時に捨てられるので、
+        再試行ではプールから別の接続が使われる。
+        """
         max_retries = 3
         for attempt in range(max_retries):
             try:
                 return operation()
-            except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
-                if "connection already closed" in str(e) or "connection" in str(e).lower():
+            except Exception as e:
+                if _is_connection_error(e) and "connection" in str(e).lower():
                     logger.warning(f"データベース接続エラー (試行 {attempt + 1}/{max_retries}): {e}")
                     if attempt < max_retries - 1:
-                        # 接続を再取得
-                        if self.is_postgres:
-                            try:
-                                self.connection_pool.putconn(self.conn)
-                            except:
-                                pass
-                            self.conn = self._get_connection()
-                        import time
                         time.sleep(1)
                         continue
-                raise e
+                raise
         return operation()
 
+    def _execute(self, conn, query, params=()):
+        """queries の Query を実行してカーソルを返します"""
+        return queries.execute(conn, conn.cursor(), query, params, self.is_postgres, self.use_prepared)
+
+    def _executemany(self, conn, query, seq_of_params):
+        return queries.executemany(conn, conn.cursor(), query, seq_of_params, self.is_postgres, self.use_prepared)
+
+    def _execute_batch(self, conn, statements):
+        return queries.execute_batch(conn, conn.cursor(), statements, self.is_postgres, self.use_prepared)
+
+    def _cached_session(self, line_user_id, history_limit=0):
+        if self.session_cache is None:
+            return None
+        return self.session_cache.get(line_user_id, history_limit)
+
+    def _invalidate_session(self, line_user_id):
+        if self.session_cache is not None:
+            self.session_cache.invalidate(line_user_id)
+
+    def _blob(self, data):
+        return PG_BINARY(data) if self.is_postgres else data
+
     def _init_tables(self):
         def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                # PostgreSQL: SERIAL型やIF NOT EXISTSの書き方に注意
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        line_user_id TEXT PRIMARY KEY,
-                        google_token BYTEA,
-                        created_at TEXT,
-                        updated_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS onetimes (
-                        code TEXT PRIMARY KEY,
-                        line_user_id TEXT,
-                        expires_at TEXT,
-                        used INTEGER DEFAULT 0,
-                        created_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS pending_events (
-                        line_user_id TEXT PRIMARY KEY,
-                        event_json TEXT,
-                        created_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS conversation_history (
-                        id SERIAL PRIMARY KEY,
-                        line_user_id TEXT NOT NULL,
-                        role TEXT NOT NULL,
-                        content TEXT NOT NULL,
-                        created_at TEXT NOT NULL
-                    )
-                ''')
-                c.execute('''
-                    CREATE INDEX IF NOT EXISTS idx_conversation_user_time
-                    ON conversation_history(line_user_id, created_at DESC)
-                ''')
-            else:
-                # SQLite
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        line_user_id TEXT PRIMARY KEY,
-                        google_token BLOB,
-                        created_at TEXT,
-                        updated_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS onetimes (
-                        code TEXT PRIMARY KEY,
-                        line_user_id TEXT,
-                        expires_at TEXT,
-                        used INTEGER DEFAULT 0,
-                        created_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS pending_events (
-                        line_user_id TEXT PRIMARY KEY,
-                        event_json TEXT,
-                        created_at TEXT
-                    )
-                ''')
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS conversation_history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        line_user_id TEXT NOT NULL,
-                        role TEXT NOT NULL,
-                        content TEXT NOT NULL,
-                        created_at TEXT NOT NULL
-                    )
-                ''')
-                c.execute('''
-                    CREATE INDEX IF NOT EXISTS idx_conversation_user_time
-                    ON conversation_history(line_user_id, created_at DESC)
-                ''')
-            self.conn.commit()
+            with self.connection() as conn:
+                for query in queries.SCHEMA:
+                    self._execute(conn, query)
+                self._migrate_conversation_history(conn)
+                conn.commit()
         
         self._execute_with_retry(operation)
 
@@ -178,58 +300,35 @@ class DBHelper:
     def save_google_token(self, line_user_id, google_token_bytes):
         now = datetime.utcnow().isoformat()
         print(f"[DEBUG] save_google_token: line_user_id={line_user_id}, token_length={len(google_token_bytes) if google_token_bytes else 0}, time={now}")
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO users (line_user_id, google_token, created_at, updated_at)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (line_user_id) DO UPDATE SET google_token=EXCLUDED.google_token, updated_at=EXCLUDED.updated_at
-            ''', (line_user_id, PG_BINARY(google_token_bytes), now, now))
-        else:
-            c.execute('''
-                INSERT INTO users (line_user_id, google_token, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(line_user_id) DO UPDATE SET google_token=excluded.google_token, updated_at=excluded.updated_at
-            ''', (line_user_id, google_token_bytes, now, now))
-        self.conn.commit()
+        with self.connection() as conn:
+            self._execute(conn, queries.SAVE_GOOGLE_TOKEN, (line_user_id, self._blob(google_token_bytes), now, now))
+            conn.commit()
+        _notify_token_saved(line_user_id)
 
     def get_google_token(self, line_user_id):
         def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                c.execute('SELECT google_token FROM users WHERE line_user_id=%s', (line_user_id,))
-            else:
-                c.execute('SELECT google_token FROM users WHERE line_user_id=?', (line_user_id,))
-            row = c.fetchone()
-            print(f"[DEBUG] get_google_token: line_user_id={line_user_id}, token_found={row is not None}, token_length={len(row[0]) if row and row[0] else 0}")
-            return row[0] if row else None
+            with self.connection() as conn:
+                row = self._execute(conn, queries.GET_GOOGLE_TOKEN, (line_user_id,)).fetchone()
+                print(f"[DEBUG] get_google_token: line_user_id={line_user_id}, token_found={row is not None}, token_length={len(row[0]) if row and row[0] else 0}")
+                return row[0] if row else None
         
         return self._execute_with_retry(operation)
 
+    def unit_of_work(self, line_user_id, history_limit=5):
+        """1メッセージ分の読み書きをまとめる MessageUnitOfWork を返します（with で使う）"""
+        return MessageUnitOfWork(self, line_user_id, history_limit)
+
     # --- onetimes ---
     def create_onetime_code(self, line_user_id, code, expires_minutes=10):
         now = datetime.utcnow()
         expires_at = (now + timedelta(minutes=expires_minutes)).isoformat()
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at)
-                VALUES (%s, %s, %s, 0, %s)
-            ''', (code, line_user_id, expires_at, now.isoformat()))
-        else:
-            c.execute('''
-                INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at)
-                VALUES (?, ?, ?, 0, ?)
-            ''', (code, line_user_id, expires_at, now.isoformat()))
-        self.conn.commit()
+        with self.connection() as conn:
+            self._execute(conn, queries.CREATE_ONETIME_CODE, (code, line_user_id, expires_at, now.isoformat()))
+            conn.commit()
 
     def get_onetime_code(self, code):
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('SELECT code, line_user_id, expires_at, used FROM onetimes WHERE code=%s', (code,))
-        else:
-            c.execute('SELECT code, line_user_id, expires_at, used FROM onetimes WHERE code=?', (code,))
-        row = c.fetchone()
+        with self.connection() as conn:
+            row = self._execute(conn, queries.GET_ONETIME_CODE, (code,)).fetchone()
         if row:
             return {
                 'code': row[0],
@@ -240,12 +339,9 @@ class DBHelper:
         return None
 
     def mark_onetime_code_used(self, code):
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('UPDATE onetimes SET used=1 WHERE code=%s', (code,))
-        else:
-            c.execute('UPDATE onetimes SET used=1 WHERE code=?', (code,))
-        self.conn.commit()
+        with self.connection() as conn:
+            self._execute(conn, queries.MARK_ONETIME_USED, (code,))
+            conn.commit()
 
     def generate_onetime_code(self, line_user_id, expires_minutes=10):
         """ワンタイムコードを生成してDBに保存"""
@@ -254,37 +350,16 @@ class DBHelper:
         expires_at = (datetime.now() + timedelta(minutes=expires_minutes)).isoformat()
         created_at = datetime.now().isoformat()
         
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO onetimes (code, line_user_id, expires_at, created_at)
-                VALUES (%s, %s, %s, %s)
-            ''', (code, line_user_id, expires_at, created_at))
-        else:
-            c.execute('''
-                INSERT INTO onetimes (code, line_user_id, expires_at, created_at)
-                VALUES (?, ?, ?, ?)
-            ''', (code, line_user_id, expires_at, created_at))
-        self.conn.commit()
+        with self.connection() as conn:
+            self._execute(conn, queries.INSERT_ONETIME_CODE, (code, line_user_id, expires_at, created_at))
+            conn.commit()
         
         return code
 
     def verify_onetime_code(self, code):
         """ワンタイムコードを検証（有効期限・使用済みチェック）"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                SELECT line_user_id, expires_at, used 
-                FROM onetimes 
-                WHERE code = %s
-            ''', (code,))
-        else:
-            c.execute('''
-                SELECT line_user_id, expires_at, used 
-                FROM onetimes 
-                WHERE code = ?
-            ''', (code,))
-        result = c.fetchone()
+        with self.connection() as conn:
+            result = self._execute(conn, queries.VERIFY_ONETIME_CODE, (code,)).fetchone()
         
         if not result:
             return None  # コードが存在しない
@@ -303,195 +378,300 @@ class DBHelper:
 
     def mark_onetime_used(self, code):
         """ワンタイムコードを使用済みにマーク"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('UPDATE onetimes SET used = 1 WHERE code = %s', (code,))
-        else:
-            c.execute('UPDATE onetimes SET used = 1 WHERE code = ?', (code,))
-        self.conn.commit()
+        self.mark_onetime_code_used(code)
 
     def cleanup_expired_onetimes(self):
         """期限切れのワンタイムコードを削除"""
-        c = self.conn.cursor()
         now = datetime.now().isoformat()
-        if self.is_postgres:
-            c.execute('DELETE FROM onetimes WHERE expires_at < %s', (now,))
-        else:
-            c.execute('DELETE FROM onetimes WHERE expires_at < ?', (now,))
-        self.conn.commit()
+        with self.connection() as conn:
+            self._execute(conn, queries.DELETE_EXPIRED_ONETIMES, (now,))
+            conn.commit()
 
     def user_exists(self, line_user_id):
         """ユーザーが認証済みかどうかを判定"""
+        session = self._cached_session(line_user_id)
+        if session is not None:
+            return session['user_exists']
+
         def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                c.execute('SELECT 1 FROM users WHERE line_user_id = %s', (line_user_id,))
-            else:
-                c.execute('SELECT 1 FROM users WHERE line_user_id = ?', (line_user_id,))
-            return c.fetchone() is not None
+            with self.connection() as conn:
+                return self._execute(conn, queries.USER_EXISTS, (line_user_id,)).fetchone() is not None
         
         return self._execute_with_retry(operation)
 
     def get_all_user_ids(self):
         """認証済みユーザーのLINEユーザーID一覧を返す（google_tokenがNULLや空でないユーザーのみ）"""
         def operation():
-            c = self.conn.cursor()
-            if self.is_postgres:
-                c.execute('SELECT line_user_id FROM users WHERE google_token IS NOT NULL AND octet_length(google_token) > 0')
-            else:
-                c.execute('SELECT line_user_id FROM users WHERE google_token IS NOT NULL AND length(google_token) > 0')
-            rows = c.fetchall()
-            return [row[0] for row in rows]
+            with self.connection() as conn:
+                return [row[0] for row in self._execute(conn, queries.GET_ALL_USER_IDS).fetchall()]
         
         return self._execute_with_retry(operation)
 
+    def get_all_google_tokens(self):
+        """認証済みユーザーの (LINEユーザーID, google_token) 一覧を返す（トークンの先行リフレッシュ用）"""
+        def operation():
+            with self.connection() as conn:
+                return [(row[0], row[1]) for row in self._execute(conn, queries.GET_ALL_GOOGLE_TOKENS).fetchall()]
+
+        return self._execute_with_retry(operation)
+
     def close(self):
+        """PostgreSQLは共有プールごと、SQLiteはこのスレッドの接続を閉じます"""
         if self.is_postgres:
-            try:
-                self.connection_pool.putconn(self.conn)
-                self.connection_pool.closeall()
-            except:
-                pass
+            with _pg_pools_lock:
+                if _pg_pools.get(self.db_url) is self.connection_pool:
+                    del _pg_pools[self.db_url]
+            self.connection_pool.closeall()
         else:
-            self.conn.close()
+            conn = getattr(self._local, 'sqlite_conn', None)
+            if conn is not None:
+                conn.close()
+                self._local.sqlite_conn = None
 
     def save_oauth_state(self, state, line_user_id):
         """OAuth stateとLINEユーザーIDを紐付けて保存"""
-        c = self.conn.cursor()
         now = datetime.now().isoformat()
-        if self.is_postgres:
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS oauth_states (
-                    state TEXT PRIMARY KEY,
-                    line_user_id TEXT,
-                    created_at TEXT
-                )
-            ''')
-            c.execute('''
-                INSERT INTO oauth_states (state, line_user_id, created_at)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (state) DO UPDATE SET line_user_id=EXCLUDED.line_user_id, created_at=EXCLUDED.created_at
-            ''', (state, line_user_id, now))
-        else:
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS oauth_states (
-                    state TEXT PRIMARY KEY,
-                    line_user_id TEXT,
-                    created_at TEXT
-                )
-            ''')
-            c.execute('''
-                INSERT OR REPLACE INTO oauth_states (state, line_user_id, created_at)
-                VALUES (?, ?, ?)
-            ''', (state, line_user_id, now))
-        self.conn.commit()
+        with self.connection() as conn:
+            self._execute(conn, queries.SAVE_OAUTH_STATE, (state, line_user_id, now))
+            conn.commit()
 
     def get_line_user_id_by_state(self, state):
         """stateからLINEユーザーIDを取得"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('SELECT line_user_id FROM oauth_states WHERE state = %s', (state,))
-        else:
-            c.execute('SELECT line_user_id FROM oauth_states WHERE state = ?', (state,))
-        result = c.fetchone()
+        with self.connection() as conn:
+            result = self._execute(conn, queries.GET_LINE_USER_ID_BY_STATE, (state,)).fetchone()
         return result[0] if result else None
 
     def save_pending_event(self, line_user_id, event_json):
         now = datetime.utcnow().isoformat()
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO pending_events (line_user_id, event_json, created_at)
-                VALUES (%s, %s, %s)
-                ON CONFLICT(line_user_id) DO UPDATE SET event_json=EXCLUDED.event_json, created_at=EXCLUDED.created_at
-            ''', (line_user_id, event_json, now))
-        else:
-            c.execute('''
-                INSERT INTO pending_events (line_user_id, event_json, created_at)
-                VALUES (?, ?, ?)
-                ON CONFLICT(line_user_id) DO UPDATE SET event_json=excluded.event_json, created_at=excluded.created_at
-            ''', (line_user_id, event_json, now))
-        self.conn.commit()
+        with self.connection() as conn:
+            self._execute(conn, queries.SAVE_PENDING_EVENT, (line_user_id, event_json, now))
+            conn.commit()
+        self._invalidate_session(line_user_id)
 
     def get_pending_event(self, line_user_id):
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('SELECT event_json FROM pending_events WHERE line_user_id=%s', (line_user_id,))
-        else:
-            c.execute('SELECT event_json FROM pending_events WHERE line_user_id=?', (line_user_id,))
-        row = c.fetchone()
+        session = self._cached_session(line_user_id)
+        if session is not None:
+            return session['pending_event']
+        with self.connection() as conn:
+            row = self._execute(conn, queries.GET_PENDING_EVENT, (line_user_id,)).fetchone()
         return row[0] if row else None
 
     def delete_pending_event(self, line_user_id):
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('DELETE FROM pending_events WHERE line_user_id=%s', (line_user_id,))
-        else:
-            c.execute('DELETE FROM pending_events WHERE line_user_id=?', (line_user_id,))
-        self.conn.commit()
+        with self.connection() as conn:
+            self._execute(conn, queries.DELETE_PENDING_EVENT, (line_user_id,))
+            conn.commit()
+        self._invalidate_session(line_user_id)
+
+    def _conversation_append(self, line_user_id, role, content, created_at=None):
+        """会話リングへの追加（最も古いスロットを上書き）の (query, params)"""
+        now = created_at or datetime.utcnow().isoformat()
+        return queries.APPEND_CONVERSATION_MESSAGE, (line_user_id, self.history_size, role, content, now, line_user_id)
+
+    def _conversation_lock(self, line_user_id):
+        """会話リングへの追加の前に取るロックの (query, params)。SQLiteでは None"""
+        if not self.is_postgres:
+            return None
+        return queries.LOCK_CONVERSATION_RING, (line_user_id,)
 
     def save_conversation_message(self, line_user_id, role, content):
-        """会話メッセージを保存（role: 'user' or 'assistant'）"""
-        now = datetime.utcnow().isoformat()
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                INSERT INTO conversation_history (line_user_id, role, content, created_at)
-                VALUES (%s, %s, %s, %s)
-            ''', (line_user_id, role, content, now))
-        else:
-            c.execute('''
-                INSERT INTO conversation_history (line_user_id, role, content, created_at)
-                VALUES (?, ?, ?, ?)
-            ''', (line_user_id, role, content, now))
-        self.conn.commit()
+        """会話メッセージを保存（role: 'user' or 'assistant'）。直近 history_size 件だけが残る"""
+        writes = [self._conversation_append(line_user_id, role, content)]
+        lock = self._conversation_lock(line_user_id)
+        if lock is not None:
+            writes.insert(0, lock)
+        with self.connection() as conn:
+            self._execute_batch(conn, writes)
+            conn.commit()
+        self._invalidate_session(line_user_id)
 
     def get_conversation_history(self, line_user_id, limit=10):
         """直近N件の会話履歴を取得"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                SELECT role, content, created_at
-                FROM conversation_history
-                WHERE line_user_id = %s
-                ORDER BY created_at DESC
-                LIMIT %s
-            ''', (line_user_id, limit))
-        else:
-            c.execute('''
-                SELECT role, content, created_at
-                FROM conversation_history
-                WHERE line_user_id = ?
-                ORDER BY created_at DESC
-                LIMIT ?
-            ''', (line_user_id, limit))
-        rows = c.fetchall()
+        session = self._cached_session(line_user_id, limit)
+        if session is not None:
+            return session['history']
+        with self.connection() as conn:
+            rows = self._execute(conn, queries.GET_CONVERSATION_HISTORY, (line_user_id, limit)).fetchall()
         # 時系列順に並び替え（古い順）
         return [{'role': row[0], 'content': row[1], 'created_at': row[2]} for row in reversed(rows)]
 
     def clear_old_conversation_history(self, line_user_id, keep_count=20):
-        """古い会話履歴を削除（最新N件のみ保持）"""
-        c = self.conn.cursor()
-        if self.is_postgres:
-            c.execute('''
-                DELETE FROM conversation_history
-                WHERE line_user_id = %s
-                AND id NOT IN (
-                    SELECT id FROM conversation_history
-                    WHERE line_user_id = %s
-                    ORDER BY created_at DESC
-                    LIMIT %s
-                )
-            ''', (line_user_id, line_user_id, keep_count))
-        else:
-            c.execute('''
-                DELETE FROM conversation_history
-                WHERE line_user_id = ?
-                AND id NOT IN (
-                    SELECT id FROM conversation_history
-                    WHERE line_user_id = ?
-                    ORDER BY created_at DESC
-                    LIMIT ?
-                )
-            ''', (line_user_id, line_user_id, keep_count))
-        self.conn.commit()
\ No newline at end of file
+        """古い会話履歴を削除（最新N件のみ保持）
+
+        リングは history_size 件を超えて溜まらないので、それより少なく絞りたいときだけ使う。
+        """
+        with self.connection() as conn:
+            self._execute(conn, queries.TRIM_CONVERSATION_RING, (line_user_id, line_user_id, keep_count))
+            conn.commit()
+        self._invalidate_session(line_user_id)
+
+    def _migrate_conversation_history(self, conn):
+        """旧 conversation_history の直近 history_size 件ずつを会話リングへ移します（リングが空のときだけ）
+
+        旧テーブルは削除せずに残す（以後は読み書きしない）。
+        """
+        if self._execute(conn, queries.CONVERSATION_RING_HAS_ROWS).fetchone():
+            return 0
+        by_user = {}
+        for line_user_id, role, content, created_at in self._execute(conn, queries.LEGACY_CONVERSATION_HISTORY).fetchall():
+            by_user.setdefault(line_user_id, []).append((role, content, created_at))
+        slots = []
+        for line_user_id, messages in by_user.items():
+            for seq, (role, content, created_at) in enumerate(messages[-self.history_size:]):
+                slots.append((line_user_id, seq % self.history_size, seq, role, content, created_at))
+        if slots:
+            self._executemany(conn, queries.INSERT_CONVERSATION_SLOT, slots)
+            logger.info(f"会話履歴をリング形式へ移行: {len(by_user)}ユーザー, {len(slots)}件")
+        return len(slots)
+
+    # --- calendar mirror ---
+    def get_calendar_sync_state(self, line_user_id):
+        """カレンダー同期状態（syncToken・ミラー対象期間）を取得"""
+        with self.connection() as conn:
+            row = self._execute(conn, queries.GET_CALENDAR_SYNC_STATE, (line_user_id,)).fetchone()
+        if not row:
+            return None
+        return {'sync_token': row[0], 'window_start': row[1], 'window_end': row[2], 'synced_at': row[3]}
+
+    def save_calendar_mirror(self, line_user_id, upserts, deletes, sync_token, window_start=None, window_end=None, replace=False):
+        """ミラーへの差分（upserts: [(event_id, start_utc, end_utc, event_json)], deletes: [event_id]）と
+        新しいsyncTokenを1トランザクションで保存します。replace=Trueなら既存のミラーを置き換える"""
+        now = datetime.utcnow().isoformat()
+        with self.connection() as conn:
+            if replace:
+                self._execute(conn, queries.DELETE_USER_MIRROR, (line_user_id,))
+            if deletes:
+                self._executemany(conn, queries.DELETE_MIRRORED_EVENT, [(line_user_id, event_id) for event_id in deletes])
+            if upserts:
+                self._executemany(conn, queries.UPSERT_MIRRORED_EVENT, [(line_user_id,) + tuple(row) for row in upserts])
+            self._execute(conn, queries.SAVE_CALENDAR_SYNC_STATE, (line_user_id, sync_token, window_start, window_end, now))
+            conn.commit()
+
+    def get_mirrored_events(self, line_user_id, start_utc, end_utc):
+        """ミラーから [start_utc, end_utc) に重なるイベント（JSON文字列）を開始時刻順に取得"""
+        with self.connection() as conn:
+            rows = self._execute(conn, queries.GET_MIRRORED_EVENTS, (line_user_id, end_utc, start_utc, start_utc)).fetchall()
+        return [row[0] for row in rows]
+
+    def clear_calendar_mirror(self, line_user_id):
+        """ユーザーのミラーと同期状態を削除（再認証時・syncToken失効時）"""
+        with self.connection() as conn:
+            self._execute(conn, queries.DELETE_USER_MIRROR, (line_user_id,))
+            self._execute(conn, queries.DELETE_SYNC_STATE, (line_user_id,))
+            conn.commit()
+
+    # --- ai_response_cache ---
+    def get_ai_response(self, cache_key):
+        """期限内のAI応答キャッシュ（JSON文字列）を取得"""
+        now = datetime.utcnow().isoformat()
+        with self.connection() as conn:
+            row = self._execute(conn, queries.GET_AI_RESPONSE, (cache_key, now)).fetchone()
+        return row[0] if row else None
+
+    def save_ai_response(self, cache_key, response_json, expires_at):
+        """AI応答キャッシュを保存し、期限切れの行を削除"""
+        now = datetime.utcnow().isoformat()
+        with self.connection() as conn:
+            self._execute(conn, queries.SAVE_AI_RESPONSE, (cache_key, response_json, expires_at))
+            self._execute(conn, queries.DELETE_EXPIRED_AI_RESPONSES, (now,))
+            conn.commit()
+
+
+class MessageUnitOfWork:
+    """1メッセージの処理で使うDBの読み書きをまとめる
+
+    開始時に認証済みか・保留中の予定・直近の会話履歴を1回の接続でまとめて読み込み、
+    書き込み（保留中の予定の削除・会話の保存）は溜めておいて、
+    終了時に1トランザクション（PostgreSQLでは1往復）でコミットする。
+    AIの応答を待つ間は接続を借りたままにしない。
+    セッションキャッシュにあれば読み込みはDBに行かず、コミットした書き込みはキャッシュにも反映する。
+    """
+
+    def __init__(self, db_helper, line_user_id, history_limit=5):
+        self.db_helper = db_helper
+        self.line_user_id = line_user_id
+        self.history_limit = history_limit
+        self.user_exists = False
+        self.pending_event = None
+        self.conversation_history = []
+        self._writes = []
+        self._pending_deleted = False
+        self._messages = []
+        self._cache_token = None
+
+    def __enter__(self):
+        self.load()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 例外で抜けた場合も、それまでの書き込みは保存する（個別にコミットしていた頃と同じ）
+        try:
+            self.commit()
+        except Exception as e:
+            if exc_type is None:
+                raise
+            logger.error(f"会話データの保存に失敗: {e}")
+        return False
+
+    def load(self):
+        db = self.db_helper
+        cache = db.session_cache
+        session = db._cached_session(self.line_user_id, self.history_limit)
+        if session is not None:
+            self.user_exists = session['user_exists']
+            self.pending_event = session['pending_event']
+            self.conversation_history = session['history']
+            self._cache_token = session['token']
+            return self
+
+        # キャッシュに入れる分（cache.history_size 件）まで履歴を読んでおく
+        generation = cache.generation(self.line_user_id) if cache is not None else None
+        limit = max(self.history_limit, cache.history_size) if cache is not None else self.history_limit
+
+        def operation():
+            with db.connection() as conn:
+                state = db._execute(conn, queries.GET_MESSAGE_STATE, (self.line_user_id, self.line_user_id)).fetchone()
+                rows = db._execute(conn, queries.GET_CONVERSATION_HISTORY, (self.line_user_id, limit)).fetchall()
+            return state, rows
+
+        state, rows = db._execute_with_retry(operation)
+        self.user_exists = state is not None and state[0] is not None
+        self.pending_event = state[1] if state is not None else None
+        # 時系列順に並び替え（古い順）
+        history = [{'role': row[0], 'content': row[1], 'created_at': row[2]} for row in reversed(rows)]
+        if cache is not None:
+            self._cache_token = cache.put(self.line_user_id, self.user_exists, self.pending_event, history, generation)
+        self.conversation_history = history[-self.history_limit:] if self.history_limit else []
+        return self
+
+    def delete_pending_event(self):
+        self.pending_event = None
+        self._pending_deleted = True
+        self._writes.append((queries.DELETE_PENDING_EVENT, (self.line_user_id,)))
+
+    def add_message(self, role, content):
+        """会話メッセージを保存（role: 'user' or 'assistant'）"""
+        created_at = datetime.utcnow().isoformat()
+        self._messages.append({'role': role, 'content': content, 'created_at': created_at})
+        self._writes.append(self.db_helper._conversation_append(self.line_user_id, role, content, created_at))
+
+    def commit(self):
+        """溜めた書き込みを1トランザクションで保存します"""
+        if not self._writes:
+            return
+        writes, self._writes = self._writes, []
+        pending_deleted, self._pending_deleted = self._pending_deleted, False
+        messages, self._messages = self._messages, []
+        lock = self.db_helper._conversation_lock(self.line_user_id) if messages else None
+        if lock is not None:
+            writes.insert(0, lock)
+        cache = self.db_helper.session_cache
+        try:
+            with self.db_helper.connection() as conn:
+                self.db_helper._execute_batch(conn, writes)
+                conn.commit()
+        except Exception:
+            if cache is not None:
+                cache.invalidate(self.line_user_id)
+            raise
+        if cache is not None:
+            cache.apply_writes(self.line_user_id, self._cache_token, pending_deleted, messages)
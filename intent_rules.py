@@ -0,0 +1,197 @@
+"""
+よく来る曖昧さのない入力を、LLMを呼ばずにルールで解釈する
+
+「明日の空き時間」「今日の予定」「来週の空き時間」「4/6 10:00-12:00」「4/6 15:00 なみさん」のような
+定型の入力だけを対象にし、extract_dates_and_times と同じ形の dict
+（task_type, dates[{date, time, end_time, ...}]）を返す。
+少しでも解釈に迷う入力（移動時間・所要時間・「まで」・「来月」・「〜を追加して」のような文章での依頼など）は None を返し、LLMに任せる。
+"""
+
+from datetime import datetime, timedelta
+import re
+import threading
+
+import pytz
+
+from ai_cache import normalize_text
+
+DEFAULT_START = '08:00'
+DEFAULT_END = '22:00'
+
+_DASH = r'[\-~〜–―ー]'
+_WEEKDAY = r'(?:\s*[\(（][月火水木金土日][\)）])?'
+_MONTH_DAY = r'(?P<month>\d{1,2})/(?P<day>\d{1,2})' + _WEEKDAY
+_RELATIVE_DAY = r'(?P<relative>今日|本日|明日|明後日|来週)'
+_DAY = rf'(?:{_RELATIVE_DAY}|{_MONTH_DAY})'
+_CLOCK = r'(\d{1,2}):(\d{2})'
+_CLOCK_RANGE = rf'{_CLOCK}\s*{_DASH}\s*{_CLOCK}'
+# 「10時-18時」「10-18時」「10時以降」「10:00-18:00」
+_WINDOW = rf'(?:(?P<window_range>{_CLOCK_RANGE})|(?P<hour_from>\d{{1,2}})時?\s*{_DASH}\s*(?P<hour_to>\d{{1,2}})時|(?P<hour_after>\d{{1,2}})時以降)'
+_ENDING = r'(?:を|は|が)?\s*(?:教えて|おしえて|見せて|みせて|出して|確認|ある)?\s*(?:ください|下さい|して)?\s*[？?！!。]*'
+_AVAILABILITY_WORD = r'(?:空き時間|空き状況|空いている時間|空いてる時間|空き|空いている|空いてる)'
+
+_AVAILABILITY_RE = re.compile(rf'^{_DAY}\s*(?:の)?\s*(?:{_WINDOW}\s*(?:の|で)?\s*)?{_AVAILABILITY_WORD}{_ENDING}$')
+_SCHEDULE_RE = re.compile(rf'^{_DAY}\s*(?:の)?\s*予定{_ENDING}$')
+# 「4/6 10:00-12:00」「4/6(月) 10:00-12:00/14:00-16:00」（1行に1日）
+_RANGE_LINE_RE = re.compile(rf'^{_MONTH_DAY}\s*(?P<ranges>{_CLOCK_RANGE}(?:\s*[/／、,]\s*{_CLOCK_RANGE})*)$')
+_RANGES_SUFFIX_RE = re.compile(rf'\s*(?:の|で|が)?\s*{_AVAILABILITY_WORD}{_ENDING}$')
+# 「4/6 15:00 なみさん」「明日 10:00-11:00 歯医者」
+_ADD_EVENT_RE = re.compile(rf'^{_DAY}\s+(?:(?P<range>{_CLOCK_RANGE})|(?P<start>{_CLOCK}))\s+(?P<title>\S.*)$')
+# タイトルにこれらが含まれるなら定型の予定追加ではない（移動時間・繰り返し・時刻の追加指定など）
+_TITLE_REJECT_RE = re.compile(r'空き|空い|移動|まで|から|毎日|毎週|\d+時|\d+分|\d{1,2}:\d{2}|\d{1,2}/\d{1,2}|[？?]')
+# 依頼・丁寧表現や助詞で始まる文は、タイトルから取り除く部分の判断をLLMに任せる
+# （「会議を追加して」「歯医者の予約を入れて」「でお願いします」など）
+_TITLE_COMMAND_RE = re.compile(
+    r'^(?:で|に|は|を|が)|追加|入れ|登録|予約して|予約を|お願い|ください|下さい|よろしく|頼む|して$|しといて|しておいて'
+)
+
+_counts = {'matched': 0, 'fallback': 0}
+_counts_lock = threading.Lock()
+
+
+def _count(key):
+    with _counts_lock:
+        _counts[key] = _counts.get(key, 0) + 1
+
+
+def intent_rule_stats():
+    with _counts_lock:
+        stats = dict(_counts)
+    total = stats['matched'] + stats['fallback']
+    stats['local_ratio'] = round(stats['matched'] / total, 3) if total else 0.0
+    return stats
+
+
+def _clock(hour, minute='00'):
+    hour, minute = int(hour), int(minute)
+    if hour > 24 or minute > 59 or (hour == 24 and minute):
+        raise ValueError('invalid time')
+    return '23:59' if hour == 24 else f"{hour:02d}:{minute:02d}"
+
+
+def _resolve_days(match, today):
+    """マッチした日付指定を日付のリストにします（M/Dは過ぎていれば来年）"""
+    relative = match.groupdict().get('relative')
+    if relative in ('今日', '本日'):
+        return [today]
+    if relative == '明日':
+        return [today + timedelta(days=1)]
+    if relative == '明後日':
+        return [today + timedelta(days=2)]
+    if relative == '来週':
+        days_until_next_monday = (7 - today.weekday()) % 7 or 7
+        next_monday = today + timedelta(days=days_until_next_monday)
+        return [next_monday + timedelta(days=i) for i in range(7)]
+    month, day = int(match.group('month')), int(match.group('day'))
+    target = datetime(today.year, month, day).date()
+    if target < today:
+        target = datetime(today.year + 1, month, day).date()
+    return [target]
+
+
+def _window(match):
+    """時間帯の指定（なければ 08:00〜22:00）"""
+    groups = match.groupdict()
+    if groups.get('window_range'):
+        sh, sm, eh, em = re.match(_CLOCK_RANGE, groups['window_range']).groups()
+        start, end = _clock(sh, sm), _clock(eh, em)
+    elif groups.get('hour_from'):
+        start, end = _clock(groups['hour_from']), _clock(groups['hour_to'])
+    elif groups.get('hour_after'):
+        start, end = _clock(groups['hour_after']), '23:59'
+    else:
+        return DEFAULT_START, DEFAULT_END
+    if start >= end:
+        raise ValueError('empty window')
+    return start, end
+
+
+def _match_availability(text, today):
+    match = _AVAILABILITY_RE.match(text)
+    if not match:
+        return None
+    start, end = _window(match)
+    return {
+        'task_type': 'availability_check',
+        'dates': [{'date': d.isoformat(), 'time': start, 'end_time': end} for d in _resolve_days(match, today)],
+    }
+
+
+def _match_schedule(text, today):
+    match = _SCHEDULE_RE.match(text)
+    if not match:
+        return None
+    return {
+        'task_type': 'show_schedule',
+        'dates': [{'date': d.isoformat(), 'time': '00:00', 'end_time': '23:59'} for d in _resolve_days(match, today)],
+    }
+
+
+def _match_range_lines(text, today):
+    """日付+時間帯だけの行の並び（「日時を打つと空き時間を返す」入力）"""
+    body = _RANGES_SUFFIX_RE.sub('', text)
+    lines = [line.strip() for line in body.split('\n') if line.strip()]
+    if not lines:
+        return None
+    dates = []
+    for line in lines:
+        match = _RANGE_LINE_RE.match(line)
+        if not match:
+            return None
+        date_str = _resolve_days(match, today)[0].isoformat()
+        for sh, sm, eh, em in re.findall(_CLOCK_RANGE, match.group('ranges')):
+            start, end = _clock(sh, sm), _clock(eh, em)
+            if start >= end:
+                return None
+            entry = {'date': date_str, 'time': start, 'end_time': end}
+            if entry not in dates:
+                dates.append(entry)
+    return {'task_type': 'availability_check', 'dates': dates}
+
+
+def _match_add_event(text, today):
+    match = _ADD_EVENT_RE.match(text)
+    if not match or match.group('relative') == '来週':
+        return None
+    title = match.group('title').strip()
+    if _TITLE_REJECT_RE.search(title) or _TITLE_COMMAND_RE.search(title):
+        return None
+    if match.group('range'):
+        sh, sm, eh, em = re.match(_CLOCK_RANGE, match.group('range')).groups()
+        start, end = _clock(sh, sm), _clock(eh, em)
+        if start >= end:
+            return None
+    else:
+        sh, sm = re.match(_CLOCK, match.group('start')).groups()
+        start = _clock(sh, sm)
+        # 終了がなければ1時間後（日をまたぐなら23:59まで）
+        end_dt = datetime.strptime(start, '%H:%M') + timedelta(hours=1)
+        end = end_dt.strftime('%H:%M') if end_dt.day == 1 else '23:59'
+    date_str = _resolve_days(match, today)[0].isoformat()
+    return {
+        'task_type': 'add_event',
+        'dates': [{'date': date_str, 'time': start, 'end_time': end, 'title': title, 'description': ''}],
+    }
+
+
+_MATCHERS = (_match_availability, _match_schedule, _match_range_lines, _match_add_event)
+
+
+def match_intent(text, now=None):
+    """定型の入力なら extract_dates_and_times と同じ形の dict を返します。ルールで確定できなければ None"""
+    if now is None:
+        now = datetime.now(pytz.timezone('Asia/Tokyo'))
+    normalized = '\n'.join(normalize_text(line) for line in (text or '').splitlines())
+    normalized = normalized.strip()
+    if normalized:
+        for matcher in _MATCHERS:
+            try:
+                parsed = matcher(normalized, now.date())
+            except ValueError:
+                # 存在しない日付・時刻（2/30, 25:00 など）はLLMに任せる
+                parsed = None
+            if parsed and parsed['dates']:
+                _count('matched')
+                return parsed
+    _count('fallback')
+    return None
@@ -6,6 +6,7 @@ from dateutil import parser
 import pytz
 import re
 from calendar_service import GoogleCalendarService
+from busy_index import BusyIntervalIndex, BusyMinuteBitmap, bitmap_available
 from ai_service import AIService
 from config import Config
 from db import DBHelper
@@ -102,13 +103,18 @@ class LineBotHandler:
         user_message = event.message.text
         line_user_id = event.source.user_id
 
+        # 認証状態・保留中の予定・会話履歴は最初にまとめて読み、書き込みは最後に1回でコミットする
+        with self.db_helper.unit_of_work(line_user_id, history_limit=5) as uow:
+            return self._handle_message(user_message, line_user_id, uow)
+
+    def _handle_message(self, user_message, line_user_id, uow):
         # Google認証未完了なら必ず認証案内を返す
-        if not self._check_user_auth(line_user_id):
+        if not uow.user_exists:
             return self._send_auth_guide(line_user_id)
 
         # 「はい」返答による強制追加判定
         if user_message.strip() in ["はい", "追加", "OK", "Yes", "yes"]:
-            pending_json = self.db_helper.get_pending_event(line_user_id)
+            pending_json = uow.pending_event
             if pending_json:
                 import json
                 events_data = json.loads(pending_json)
@@ -123,7 +129,7 @@ class LineBotHandler:
                         print(f"[DEBUG] 大量の保留イベント検出: {total_pending_events}件、バックグラウンド処理を使用")
 
                         # pending_eventsを削除
-                        self.db_helper.delete_pending_event(line_user_id)
+                        uow.delete_pending_event()
 
                         # バックグラウンド処理
                         import threading
@@ -288,7 +294,7 @@ class LineBotHandler:
                                 'reason': str(e)
                             })
 
-                    self.db_helper.delete_pending_event(line_user_id)
+                    uow.delete_pending_event()
                     
                     # 結果メッセージを構築（移動時間を含む場合は統一形式）
                     if added_events:
@@ -390,14 +396,14 @@ class LineBotHandler:
                         line_user_id=line_user_id,
                         force_add=True
                     )
-                    self.db_helper.delete_pending_event(line_user_id)
+                    uow.delete_pending_event()
                     response_text = self.ai_service.format_event_confirmation(success, message, result)
                     return TextSendMessage(text=response_text)
         else:
             # 「はい」以外の返答でpending_eventsがあれば削除し、キャンセルメッセージを返す
-            pending_json = self.db_helper.get_pending_event(line_user_id)
+            pending_json = uow.pending_event
             if pending_json:
-                self.db_helper.delete_pending_event(line_user_id)
+                uow.delete_pending_event()
                 return TextSendMessage(text="予定追加をキャンセルしました。")
         
         try:
@@ -409,14 +415,14 @@ class LineBotHandler:
                 return TextSendMessage(text="AIサービスの初期化に失敗しました。OpenAI APIキーを設定してください。")
 
             # 会話履歴を取得
-            conversation_history = self.db_helper.get_conversation_history(line_user_id, limit=5)
+            conversation_history = uow.conversation_history
             print(f"[DEBUG] 会話履歴取得: {len(conversation_history) if conversation_history else 0}件")
             if conversation_history:
                 for i, msg in enumerate(conversation_history):
                     print(f"[DEBUG] 履歴[{i}]: {msg['role']} - {msg['content'][:30]}...")
 
             # ユーザーメッセージを会話履歴に保存
-            self.db_helper.save_conversation_message(line_user_id, 'user', user_message)
+            uow.add_message('user', user_message)
             print(f"[DEBUG] ユーザーメッセージを保存: {user_message[:50]}...")
 
             # AIを使ってメッセージの意図を判断（会話履歴を渡す）
@@ -467,9 +473,8 @@ class LineBotHandler:
 
             # 応答を会話履歴に保存
             if response_message and hasattr(response_message, 'text'):
-                self.db_helper.save_conversation_message(line_user_id, 'assistant', response_message.text)
-                # 古い会話履歴をクリーンアップ（最新20件のみ保持）
-                self.db_helper.clear_old_conversation_history(line_user_id, keep_count=20)
+                # 会話履歴はリングバッファなので、古いものは追加時に上書きされる
+                uow.add_message('assistant', response_message.text)
 
             return response_message
 
@@ -1263,7 +1268,56 @@ class LineBotHandler:
             traceback.print_exc()
             return TextSendMessage(text=f"予定表示でエラーが発生しました: {str(e)}")
 
-    def _handle_availability_check(self, dates_info, line_user_id, required_duration_minutes=None, location=None, travel_time_minutes=None):
+    def _free_slots_by_frame_bitmap(self, dates_info, busy_index, span_start_dt, span_end_dt, travel_time_minutes=None, min_minutes=0):
+        """BusyMinuteBitmap で全日付の枠をまとめて計算し、free_slots_by_frame と同じ形で返します"""
+        jst = pytz.timezone('Asia/Tokyo')
+        bitmap = BusyMinuteBitmap(busy_index, span_start_dt, span_end_dt, jst)
+        travel = travel_time_minutes if travel_time_minutes and travel_time_minutes > 0 else 0
+        day_start = "08:00"
+        day_end = "22:00"
+
+        frames = []
+        slot_windows = []
+        check_windows = []
+        for date_info in dates_info:
+            if not isinstance(date_info, dict):
+                continue
+            date_str = date_info.get('date')
+            start_time = date_info.get('time')
+            end_time = date_info.get('end_time')
+            if not (date_str and start_time and end_time):
+                continue
+            # 8:00〜22:00 と枠の重なり部分だけを対象にする（interval方式と同じ）
+            slot_start = max(start_time, day_start)
+            slot_end = min(end_time, day_end)
+            frame = {'date': date_str, 'start_time': slot_start, 'end_time': slot_end, 'free_slots': [], 'raw_free_slots': []}
+            frames.append(frame)
+            if slot_start >= slot_end:
+                slot_windows.append((0, 0))
+                check_windows.append((0, 0))
+                continue
+            day_offset = bitmap.offset(jst.localize(datetime.strptime(date_str, "%Y-%m-%d")))
+            slot_start_min = self._hhmm_to_minutes(slot_start)
+            slot_end_min = self._hhmm_to_minutes(slot_end)
+            slot_windows.append((day_offset + slot_start_min, day_offset + slot_end_min))
+            # 移動時間ありの厳密判定用に、前後移動分を含んだ元枠（8:00〜22:00内）
+            check_start_min = max(self._hhmm_to_minutes(day_start), slot_start_min - travel)
+            check_end_min = min(self._hhmm_to_minutes(day_end), slot_end_min + travel)
+            check_windows.append((day_offset + check_start_min, day_offset + check_end_min))
+
+        free_runs = bitmap.free_runs(slot_windows, min_minutes=min_minutes, pad_minutes=travel)
+        raw_runs = bitmap.free_runs(check_windows)
+        for frame, runs, raw in zip(frames, free_runs, raw_runs):
+            frame['free_slots'] = [{'start': bitmap.format(s), 'end': bitmap.format(e)} for s, e in runs]
+            frame['raw_free_slots'] = [{'start': bitmap.format(s), 'end': bitmap.format(e)} for s, e in raw]
+        return frames
+
+    @staticmethod
+    def _hhmm_to_minutes(hhmm):
+        h, m = hhmm.split(':')
+        return int(h) * 60 + int(m)
+
+    def _handle_availability_check(self, dates_info, line_user_id, required_duration_minutes=None, location=None, travel_time_minutes=None, backend=None):
         """空き時間確認を処理します
 
         Args:
@@ -1272,6 +1326,7 @@ class LineBotHandler:
             required_duration_minutes: 必要な空き時間の長さ（分）。指定された場合、この長さ以上の空き時間のみを返す
             location: 場所指定（例：「東京」）。指定された場合、終日予定のタイトルに場所が含まれる日のみを抽出
             travel_time_minutes: 移動時間（片道、分）。指定された場合、表示時に前後から引く
+            backend: 空き時間の計算方式（'interval' / 'bitmap'）。未指定なら Config.AVAILABILITY_BACKEND
         """
         try:
             print(f"[DEBUG] _handle_availability_check開始")
@@ -1460,23 +1515,9 @@ class LineBotHandler:
                 all_events_bulk = self.calendar_service.get_events_for_time_range(bulk_start_dt, bulk_end_dt, line_user_id)
                 print(f"[DEBUG] 取得した予定数（空き時間計算用）: {len(all_events_bulk)}件")
 
-                # 予定を日付ごとに分類
-                events_by_date = {}
-                for event in all_events_bulk:
-                    start = event.get('start', '')
-                    # 日付部分を抽出
-                    if 'T' in start:
-                        # dateTime形式: 2026-04-02T09:00:00+09:00
-                        event_date = start.split('T')[0]
-                    else:
-                        # date形式（終日）: 2026-04-02
-                        event_date = start
-
-                    if event_date not in events_by_date:
-                        events_by_date[event_date] = []
-                    events_by_date[event_date].append(event)
-
-                print(f"[DEBUG] 予定がある日数: {len(events_by_date)}日")
+                # 取得範囲の予定から空き時間インデックスを1度だけ作る（日付・枠ごとの再パース不要）
+                busy_index = BusyIntervalIndex(all_events_bulk, jst)
+                print(f"[DEBUG] 予定区間数（マージ後）: {len(busy_index)}件")
 
             except Exception as e:
                 print(f"[ERROR] 予定一括取得エラー: {e}")
@@ -1484,8 +1525,45 @@ class LineBotHandler:
                 traceback.print_exc()
                 return TextSendMessage(text=f"予定取得中にエラーが発生しました: {str(e)}")
 
-            free_slots_by_frame = []
-            for i, date_info in enumerate(dates_info):
+            def _explicit_range_mode_for_dates(info):
+                """全日が同じ非デフォルト帯（08:00〜22:00以外の1種類）だけなら厳密モード"""
+                if not info:
+                    return False
+                date_ranges = {
+                    (d.get('time'), d.get('end_time'))
+                    for d in info
+                    if isinstance(d, dict) and d.get('time') and d.get('end_time')
+                }
+                non_default_ranges = {
+                    (start, end) for start, end in date_ranges
+                    if not (start == '08:00' and end == '22:00')
+                }
+                return len(non_default_ranges) == 1
+
+            explicit_range_mode = _explicit_range_mode_for_dates(dates_info)
+            print(f"[DEBUG] explicit_range_mode: {explicit_range_mode}")
+
+            # 空き時間の計算方式（interval: 予定区間インデックス / bitmap: NumPyの分単位ビットマップ）
+            backend = (backend or Config.AVAILABILITY_BACKEND or 'interval').lower()
+            if backend == 'bitmap' and not bitmap_available():
+                print(f"[WARNING] numpyが使えないためinterval方式で空き時間を計算します")
+                backend = 'interval'
+            print(f"[DEBUG] 空き時間計算方式: {backend}")
+
+            if backend == 'bitmap':
+                # 必要時間での絞り込みもビットマップ側で行う（厳密モードでは後段の内包判定に任せる）
+                min_minutes = 0
+                if required_duration_minutes and required_duration_minutes > 0 and not explicit_range_mode:
+                    min_minutes = required_duration_minutes
+                free_slots_by_frame = self._free_slots_by_frame_bitmap(
+                    dates_info, busy_index, bulk_start_dt, bulk_end_dt, travel_time_minutes, min_minutes
+                )
+                # 計算済みなので、下の日付ごとのループ（interval方式）は回さない
+                interval_dates_info = []
+            else:
+                interval_dates_info = dates_info
+                free_slots_by_frame = []
+            for i, date_info in enumerate(interval_dates_info):
                 print(f"[DEBUG] 日付{i+1}処理開始: タイプ={type(date_info)}, 値={date_info}")
 
                 # 文字列の場合はスキップ
@@ -1520,17 +1598,9 @@ class LineBotHandler:
 
                         print(f"[DEBUG] 日付{i+1}のdatetime: start_dt={start_dt}, end_dt={end_dt}")
 
-                        # メモリ上の予定から該当日の予定を取得（APIコールなし）
-                        print(f"[DEBUG] 日付{i+1}の予定取得（メモリから）")
-                        events = events_by_date.get(date_str, [])
+                        # メモリ上の空き時間インデックスを使う（APIコールなし・終日予定は含まない）
+                        events = busy_index
 
-                        # 終日予定を除外（場所メモ等・空き時間計算に含めない）
-                        events = [
-                            e for e in events
-                            if not e.get('all_day') and 'T' in e.get('start', '')
-                        ]
-                        print(f"[DEBUG] 日付{i+1}の取得予定（終日除外後）: {events}")
-                        
                         # 8:00〜22:00の間で空き時間を返す
                         day_start = "08:00"
                         day_end = "22:00"
@@ -1622,24 +1692,6 @@ class LineBotHandler:
             
             print(f"[DEBUG] 全日付処理完了、free_slots_by_frame: {free_slots_by_frame}")
 
-            def _explicit_range_mode_for_dates(info):
-                """全日が同じ非デフォルト帯（08:00〜22:00以外の1種類）だけなら厳密モード"""
-                if not info:
-                    return False
-                date_ranges = {
-                    (d.get('time'), d.get('end_time'))
-                    for d in info
-                    if isinstance(d, dict) and d.get('time') and d.get('end_time')
-                }
-                non_default_ranges = {
-                    (start, end) for start, end in date_ranges
-                    if not (start == '08:00' and end == '22:00')
-                }
-                return len(non_default_ranges) == 1
-
-            explicit_range_mode = _explicit_range_mode_for_dates(dates_info)
-            print(f"[DEBUG] explicit_range_mode: {explicit_range_mode}")
-
             # required_duration_minutesが指定されている場合、フィルタリング
             # 厳密モード（明示時間帯が丸ごと空いているか）では、移動調整後の表示用スロットは
             # 元帯より短くなるため、ここで required_duration を掛けると誤って全日除外される
@@ -1781,58 +1833,6 @@ class LineBotHandler:
             traceback.print_exc()
             return TextSendMessage(text=f"空き時間確認でエラーが発生しました: {str(e)}")
     
-    def _handle_event_addition(self, user_message, line_user_id):
-        """イベント追加を処理します"""
-        try:
-            # ユーザーの認証状態をチェック
-            if not self._check_user_auth(line_user_id):
-                return self._send_auth_guide(line_user_id)
-            
-            if not self.calendar_service:
-                return TextSendMessage(text="Google Calendarサービスが初期化されていません。認証ファイルを確認してください。")
-            
-            if not self.ai_service:
-                return TextSendMessage(text="AIサービスが初期化されていません。")
-            
-            # AIを使ってイベント情報を抽出
-            event_info = self.ai_service.extract_event_info(user_message)
-            
-            if 'error' in event_info:
-                # 日程のみの場合は空き時間確認として処理
-                dates_info = self.ai_service.extract_dates_and_times(user_message)
-                if 'error' not in dates_info and dates_info.get('dates'):
-                    required_duration = dates_info.get('required_duration_minutes')
-                    return self._handle_availability_check(dates_info.get('dates', []), line_user_id, required_duration)
-                
-                return TextSendMessage(text="・日時を打つと空き時間を返します\n・予定を打つとカレンダーに追加します\n\n例：\n・「明日の空き時間」\n・「7/15 15:00〜16:00の空き時間」\n・「明日の午前9時から会議を追加して」\n・「来週月曜日の14時から打ち合わせ」")
-            
-            # 日時をパース
-            start_datetime = parser.parse(event_info['start_datetime'])
-            end_datetime = parser.parse(event_info['end_datetime'])
-            
-            # タイムゾーンを設定
-            start_datetime = self.jst.localize(start_datetime)
-            end_datetime = self.jst.localize(end_datetime)
-            
-            # カレンダーにイベントを追加
-            success, message, result = self.calendar_service.add_event(
-                event_info['title'],
-                start_datetime,
-                end_datetime,
-                event_info.get('description', ''),
-                line_user_id=line_user_id,
-                force_add=True
-            )
-            logger.info(f"[DEBUG] add_event result: success={success}, message={message}, result={result}")
-            
-            # AIを使ってレスポンスをフォーマット
-            response_text = self.ai_service.format_event_confirmation(success, message, result)
-            
-            return TextSendMessage(text=response_text)
-            
-        except Exception as e:
-            return TextSendMessage(text=f"イベント追加でエラーが発生しました: {str(e)}")
-    
     def get_handler(self):
         """WebhookHandlerを取得します"""
         return self.handler 
\ No newline at end of file
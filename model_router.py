@@ -0,0 +1,163 @@
+"""
+extract_dates_and_times のモデル振り分け（gpt-4o-mini → gpt-4o）
+
+短く単純な入力はまず小さいモデルに送り、応答がスキーマ・妥当性チェックを通らなければ大きいモデルで解釈し直す。
+複雑な入力（移動時間・所要時間・締切・会話の流れを参照する入力など）は最初から大きいモデルに送る。
+"""
+
+from collections import deque
+from datetime import datetime
+import re
+import threading
+import time
+
+import pytz
+
+from ai_cache import CONTEXT_REFERENCE_PATTERN, normalize_text
+from config import Config
+from work_queue import percentile
+
+# 大きいモデルに任せる表現（所要時間・移動・締切・繰り返し・除外・会話の参照など）
+_COMPLEX_RE = re.compile(
+    r'移動|まで|週目|毎日|毎週|以外|除いて|除く|または|もしくは|打ち?合わせ|確保|\d+\s*時間|\d+\s*分|'
+    + CONTEXT_REFERENCE_PATTERN
+)
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_TIME_RE = re.compile(r'^([01]\d|2[0-3]):[0-5]\d$')
+TASK_TYPES = ('availability_check', 'show_schedule', 'add_event')
+# 移動時間（片道）の上限（extract_dates_and_times の MAX_TRAVEL_MINUTES と同じ）
+MAX_TRAVEL_MINUTES = 240
+
+
+def _check_window(entry, label):
+    start, end = entry.get('time'), entry.get('end_time')
+    for value in (start, end):
+        if value is not None and not _TIME_RE.match(value):
+            return f"{label}の時刻が不正: {value}"
+    if start and end and start >= end:
+        return f"{label}の時間帯が空: {start}〜{end}"
+    return None
+
+
+def validate_dates_response(parsed, today=None):
+    """小さいモデルの応答の妥当性を確認します。問題があればその内容、なければ None"""
+    if not isinstance(parsed, dict) or 'error' in parsed:
+        return 'JSONとして解釈できない'
+    if parsed.get('task_type') not in TASK_TYPES:
+        return f"task_typeが不正: {parsed.get('task_type')}"
+    if today is None:
+        today = datetime.now(pytz.timezone('Asia/Tokyo')).date()
+    today_str = today.isoformat()
+    # 過去の予定を見るのはよくある問い合わせなので、過去日付を誤りとみなすのは空き確認・予定追加だけ
+    future_only = parsed['task_type'] in ('availability_check', 'add_event')
+    dates = parsed.get('dates') or []
+    ranges = parsed.get('ranges') or []
+    if not dates and not ranges:
+        return 'datesもrangesも空'
+    for d in dates:
+        if not isinstance(d, dict) or not _DATE_RE.match(str(d.get('date', ''))):
+            return f"dateが不正: {d}"
+        if future_only and d['date'] < today_str:
+            return f"過去の日付: {d['date']}"
+        problem = _check_window(d, 'dates')
+        if problem:
+            return problem
+        if parsed['task_type'] == 'add_event' and not d.get('time'):
+            return f"予定追加なのに開始時刻がない: {d}"
+    for r in ranges:
+        if not isinstance(r, dict) or not _DATE_RE.match(str(r.get('start_date', ''))) \
+                or not _DATE_RE.match(str(r.get('end_date', ''))):
+            return f"rangesの日付が不正: {r}"
+        if r['start_date'] > r['end_date'] or (future_only and r['end_date'] < today_str):
+            return f"rangesの期間が不正: {r['start_date']}〜{r['end_date']}"
+        if any(not isinstance(w, int) or not 0 <= w <= 6 for w in (r.get('weekdays') or [])):
+            return f"weekdaysが不正: {r.get('weekdays')}"
+        problem = _check_window(r, 'ranges')
+        if problem:
+            return problem
+    duration = parsed.get('required_duration_minutes')
+    if duration is not None and not (isinstance(duration, int) and 0 < duration <= 24 * 60):
+        return f"required_duration_minutesが不正: {duration}"
+    travel = parsed.get('travel_time_minutes')
+    if travel is not None and not (isinstance(travel, int) and 0 <= travel <= MAX_TRAVEL_MINUTES):
+        return f"travel_time_minutesが不正: {travel}"
+    return None
+
+
+class ModelRouter:
+    """入力の複雑さで小さいモデル・大きいモデルを選び、段ごとの処理時間と昇格率を集計する"""
+
+    def __init__(self, small_model='gpt-4o-mini', large_model='gpt-4o', max_simple_chars=40, latency_window=500):
+        self.small_model = small_model
+        self.large_model = large_model
+        self.max_simple_chars = max_simple_chars
+        self._lock = threading.Lock()
+        self._latencies = {'small': deque(maxlen=latency_window), 'large': deque(maxlen=latency_window)}
+        self._calls = {'small': 0, 'large': 0}
+        self._escalations = 0
+        self._escalation_reasons = {}
+
+    def is_simple(self, text):
+        """小さいモデルで足りそうな入力か（1行・短い・複雑な表現を含まない）"""
+        normalized = normalize_text(text)
+        if not normalized or '\n' in (text or '').strip():
+            return False
+        return len(normalized) <= self.max_simple_chars and not _COMPLEX_RE.search(normalized)
+
+    def model_for(self, tier):
+        return self.small_model if tier == 'small' else self.large_model
+
+    def record(self, tier, started):
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._calls[tier] += 1
+            self._latencies[tier].append(elapsed)
+
+    def record_escalation(self, reason):
+        # 理由の種類ごとに数える（「dateが不正: {...}」の値部分は除く）
+        key = reason.split(':')[0]
+        with self._lock:
+            self._escalations += 1
+            self._escalation_reasons[key] = self._escalation_reasons.get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'small_model': self.small_model,
+                'large_model': self.large_model,
+                'escalations': self._escalations,
+                'escalation_reasons': dict(self._escalation_reasons),
+            }
+            small_calls = self._calls['small']
+            latencies = {tier: list(values) for tier, values in self._latencies.items()}
+            calls = dict(self._calls)
+        stats['escalation_rate'] = round(stats['escalations'] / small_calls, 3) if small_calls else 0.0
+        for tier in ('small', 'large'):
+            stats[tier] = {
+                'calls': calls[tier],
+                'latency_ms_p50': round(percentile(latencies[tier], 50) * 1000, 1),
+                'latency_ms_p95': round(percentile(latencies[tier], 95) * 1000, 1),
+            }
+        return stats
+
+
+_shared_router = None
+_shared_router_lock = threading.Lock()
+
+def shared_model_router():
+    """プロセス内で共有するルーター（AI_MODEL_ROUTING_ENABLED=false なら None）"""
+    global _shared_router
+    if not Config.AI_MODEL_ROUTING_ENABLED:
+        return None
+    with _shared_router_lock:
+        if _shared_router is None:
+            _shared_router = ModelRouter(
+                small_model=Config.AI_SMALL_MODEL,
+                large_model=Config.AI_LARGE_MODEL,
+                max_simple_chars=Config.AI_ROUTING_MAX_CHARS,
+            )
+        return _shared_router
+
+def model_router_stats():
+    router = shared_model_router()
+    return router.stats() if router else None
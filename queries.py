@@ -0,0 +1,384 @@
+import threading
+import weakref
+
+# DBHelper が使うSQLを1か所で定義するクエリ層
+#
+# SQLは SQLite の ? プレースホルダで1度だけ書き、PostgreSQL 用の文（%s 版と PREPARE 用の $n 版）は
+# import 時に変換しておく。PostgreSQL では接続ごとに PREPARE して EXECUTE で実行し、
+# SQLite では sqlite3 の接続ごとの文キャッシュ（cached_statements）に乗せる。
+# 新しいクエリは Query(...) を1つ足すだけでよい。
+
+
+def _split_placeholders(sql):
+    """文字列リテラル・引用符付き識別子の外にある ? の位置で sql を分割します"""
+    parts = []
+    current = []
+    quote = None
+    for ch in sql:
+        if quote:
+            current.append(ch)
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+            current.append(ch)
+        elif ch == '?':
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(ch)
+    parts.append(''.join(current))
+    return parts
+
+
+# 名前 → Query（PREPARE の文名になるため名前は重複させない）
+QUERIES = {}
+
+
+class Query:
+    """1つのSQL文。sql は ? プレースホルダで書く
+
+    バックエンドで構文自体が違う文（DDLの型など）だけ postgres= で PostgreSQL 用を別に渡す。
+    prepare=False の文（DDLなど）は PostgreSQL でも PREPARE せずにそのまま実行する。
+    """
+
+    def __init__(self, name, sql, postgres=None, prepare=True):
+        if name in QUERIES:
+            raise ValueError(f"クエリ名が重複しています: {name}")
+        QUERIES[name] = self
+        self.name = name
+        self.sqlite = sql
+        parts = _split_placeholders(postgres or sql)
+        self.param_count = len(parts) - 1
+        # psycopg2 に渡す文（% はエスケープ）と PREPARE 用の文（$1, $2, ...）
+        self.postgres = '%s'.join(part.replace('%', '%%') for part in parts)
+        self.prepare = prepare
+        self.statement_name = f"q_{name}"
+        prepared = [parts[0]]
+        for i, part in enumerate(parts[1:], 1):
+            prepared.append(f"${i}")
+            prepared.append(part)
+        self.prepare_sql = f"PREPARE {self.statement_name} AS {''.join(prepared)}"
+        if self.param_count:
+            self.execute_sql = f"EXECUTE {self.statement_name} ({', '.join(['%s'] * self.param_count)})"
+        else:
+            self.execute_sql = f"EXECUTE {self.statement_name}"
+
+    def __repr__(self):
+        return f"Query({self.name!r})"
+
+
+# PostgreSQL の接続ごとに PREPARE 済みの文の名前（None は状態不明で、次に使うとき DEALLOCATE ALL する）
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def forget_prepared(conn):
+    """エラーでロールバックした接続の PREPARE 状態を不明扱いにします"""
+    with _prepared_lock:
+        if conn in _prepared:
+            _prepared[conn] = None
+
+
+def _ensure_prepared(conn, cursor, query):
+    with _prepared_lock:
+        names = _prepared.get(conn, ())
+    if names is None:
+        cursor.execute('DEALLOCATE ALL')
+        names = set()
+    elif names == ():
+        names = set()
+    if query.statement_name not in names:
+        cursor.execute(query.prepare_sql)
+        names = names | {query.statement_name}
+    with _prepared_lock:
+        _prepared[conn] = names
+
+
+def execute(conn, cursor, query, params=(), is_postgres=False, prepared=True):
+    """query を実行します（PostgreSQLで prepared=True なら PREPARE 済みの文を EXECUTE）"""
+    if not is_postgres:
+        cursor.execute(query.sqlite, params)
+    elif prepared and query.prepare:
+        _ensure_prepared(conn, cursor, query)
+        cursor.execute(query.execute_sql, params)
+    elif params:
+        cursor.execute(query.postgres, params)
+    else:
+        cursor.execute(query.postgres.replace('%%', '%'))
+    return cursor
+
+
+def executemany(conn, cursor, query, seq_of_params, is_postgres=False, prepared=True):
+    """query を複数のパラメータで実行します"""
+    if not is_postgres:
+        cursor.executemany(query.sqlite, seq_of_params)
+    elif prepared and query.prepare:
+        _ensure_prepared(conn, cursor, query)
+        cursor.executemany(query.execute_sql, seq_of_params)
+    else:
+        cursor.executemany(query.postgres, seq_of_params)
+    return cursor
+
+
+def execute_batch(conn, cursor, statements, is_postgres=False, prepared=True):
+    """[(query, params), ...] を順に実行します（PostgreSQLでは1つの文字列にまとめて1往復で送る）"""
+    if not is_postgres:
+        for query, params in statements:
+            cursor.execute(query.sqlite, params)
+        return cursor
+    parts = []
+    for query, params in statements:
+        if prepared and query.prepare:
+            _ensure_prepared(conn, cursor, query)
+            parts.append(cursor.mogrify(query.execute_sql, params))
+        else:
+            parts.append(cursor.mogrify(query.postgres, params))
+    if parts:
+        cursor.execute(b';'.join(parts))
+    return cursor
+
+
+# --- スキーマ ---
+SCHEMA = [
+    Query('create_users', '''
+        CREATE TABLE IF NOT EXISTS users (
+            line_user_id TEXT PRIMARY KEY,
+            google_token BLOB,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    ''', postgres='''
+        CREATE TABLE IF NOT EXISTS users (
+            line_user_id TEXT PRIMARY KEY,
+            google_token BYTEA,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    ''', prepare=False),
+    Query('create_onetimes', '''
+        CREATE TABLE IF NOT EXISTS onetimes (
+            code TEXT PRIMARY KEY,
+            line_user_id TEXT,
+            expires_at TEXT,
+            used INTEGER DEFAULT 0,
+            created_at TEXT
+        )
+    ''', prepare=False),
+    Query('create_pending_events', '''
+        CREATE TABLE IF NOT EXISTS pending_events (
+            line_user_id TEXT PRIMARY KEY,
+            event_json TEXT,
+            created_at TEXT
+        )
+    ''', prepare=False),
+    Query('create_oauth_states', '''
+        CREATE TABLE IF NOT EXISTS oauth_states (
+            state TEXT PRIMARY KEY,
+            line_user_id TEXT,
+            created_at TEXT
+        )
+    ''', prepare=False),
+    Query('create_conversation_history', '''
+        CREATE TABLE IF NOT EXISTS conversation_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            line_user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''', postgres='''
+        CREATE TABLE IF NOT EXISTS conversation_history (
+            id SERIAL PRIMARY KEY,
+            line_user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''', prepare=False),
+    Query('create_idx_conversation_user_time', '''
+        CREATE INDEX IF NOT EXISTS idx_conversation_user_time
+        ON conversation_history(line_user_id, created_at DESC)
+    ''', prepare=False),
+    Query('create_conversation_ring', '''
+        CREATE TABLE IF NOT EXISTS conversation_ring (
+            line_user_id TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (line_user_id, slot)
+        )
+    ''', prepare=False),
+    Query('create_calendar_sync_state', '''
+        CREATE TABLE IF NOT EXISTS calendar_sync_state (
+            line_user_id TEXT PRIMARY KEY,
+            sync_token TEXT,
+            window_start TEXT,
+            window_end TEXT,
+            synced_at TEXT
+        )
+    ''', prepare=False),
+    Query('create_calendar_event_mirror', '''
+        CREATE TABLE IF NOT EXISTS calendar_event_mirror (
+            line_user_id TEXT NOT NULL,
+            event_id TEXT NOT NULL,
+            start_utc TEXT NOT NULL,
+            end_utc TEXT NOT NULL,
+            event_json TEXT NOT NULL,
+            PRIMARY KEY (line_user_id, event_id)
+        )
+    ''', prepare=False),
+    Query('create_idx_calendar_mirror_user_start', '''
+        CREATE INDEX IF NOT EXISTS idx_calendar_mirror_user_start
+        ON calendar_event_mirror(line_user_id, start_utc)
+    ''', prepare=False),
+    Query('create_ai_response_cache', '''
+        CREATE TABLE IF NOT EXISTS ai_response_cache (
+            cache_key TEXT PRIMARY KEY,
+            response_json TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        )
+    ''', prepare=False),
+]
+
+# --- users ---
+SAVE_GOOGLE_TOKEN = Query('save_google_token', '''
+    INSERT INTO users (line_user_id, google_token, created_at, updated_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (line_user_id) DO UPDATE SET google_token=EXCLUDED.google_token, updated_at=EXCLUDED.updated_at
+''')
+GET_GOOGLE_TOKEN = Query('get_google_token', 'SELECT google_token FROM users WHERE line_user_id=?')
+USER_EXISTS = Query('user_exists', 'SELECT 1 FROM users WHERE line_user_id=?')
+# length() は SQLite の BLOB・PostgreSQL の BYTEA どちらでもバイト数を返す
+GET_ALL_USER_IDS = Query(
+    'get_all_user_ids',
+    'SELECT line_user_id FROM users WHERE google_token IS NOT NULL AND length(google_token) > 0'
+)
+GET_ALL_GOOGLE_TOKENS = Query(
+    'get_all_google_tokens',
+    'SELECT line_user_id, google_token FROM users WHERE google_token IS NOT NULL AND length(google_token) > 0'
+)
+
+# 1メッセージの処理開始時に読む状態（認証済みか・保留中の予定）
+GET_MESSAGE_STATE = Query('get_message_state', '''
+    SELECT
+        (SELECT 1 FROM users WHERE line_user_id=?),
+        (SELECT event_json FROM pending_events WHERE line_user_id=?)
+''')
+
+# --- onetimes ---
+CREATE_ONETIME_CODE = Query('create_onetime_code', '''
+    INSERT INTO onetimes (code, line_user_id, expires_at, used, created_at)
+    VALUES (?, ?, ?, 0, ?)
+''')
+GET_ONETIME_CODE = Query('get_onetime_code', 'SELECT code, line_user_id, expires_at, used FROM onetimes WHERE code=?')
+MARK_ONETIME_USED = Query('mark_onetime_used', 'UPDATE onetimes SET used=1 WHERE code=?')
+INSERT_ONETIME_CODE = Query('insert_onetime_code', '''
+    INSERT INTO onetimes (code, line_user_id, expires_at, created_at)
+    VALUES (?, ?, ?, ?)
+''')
+VERIFY_ONETIME_CODE = Query('verify_onetime_code', 'SELECT line_user_id, expires_at, used FROM onetimes WHERE code=?')
+DELETE_EXPIRED_ONETIMES = Query('delete_expired_onetimes', 'DELETE FROM onetimes WHERE expires_at < ?')
+
+# --- oauth_states ---
+SAVE_OAUTH_STATE = Query('save_oauth_state', '''
+    INSERT INTO oauth_states (state, line_user_id, created_at)
+    VALUES (?, ?, ?)
+    ON CONFLICT (state) DO UPDATE SET line_user_id=EXCLUDED.line_user_id, created_at=EXCLUDED.created_at
+''')
+GET_LINE_USER_ID_BY_STATE = Query('get_line_user_id_by_state', 'SELECT line_user_id FROM oauth_states WHERE state=?')
+
+# --- pending_events ---
+SAVE_PENDING_EVENT = Query('save_pending_event', '''
+    INSERT INTO pending_events (line_user_id, event_json, created_at)
+    VALUES (?, ?, ?)
+    ON CONFLICT (line_user_id) DO UPDATE SET event_json=EXCLUDED.event_json, created_at=EXCLUDED.created_at
+''')
+GET_PENDING_EVENT = Query('get_pending_event', 'SELECT event_json FROM pending_events WHERE line_user_id=?')
+DELETE_PENDING_EVENT = Query('delete_pending_event', 'DELETE FROM pending_events WHERE line_user_id=?')
+
+# --- conversation_ring ---
+# 会話履歴はユーザーごとに ring_size 個のスロットを使い回すリングバッファ。
+# seq は通し番号で、slot = seq % ring_size に上書きするので、追加は1回のUPSERTで済む
+APPEND_CONVERSATION_MESSAGE = Query('append_conversation_message', '''
+    INSERT INTO conversation_ring (line_user_id, slot, seq, role, content, created_at)
+    SELECT CAST(? AS TEXT), head.next_seq % CAST(? AS INTEGER), head.next_seq, CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS TEXT)
+    FROM (SELECT COALESCE(MAX(seq), -1) + 1 AS next_seq FROM conversation_ring WHERE line_user_id = ?) AS head
+    WHERE 1 = 1
+    ON CONFLICT (line_user_id, slot) DO UPDATE SET
+        seq=EXCLUDED.seq, role=EXCLUDED.role, content=EXCLUDED.content, created_at=EXCLUDED.created_at
+''')
+# PostgreSQL では MAX(seq) の読み取りにロックがかからず、同じユーザーの追加が同時に走ると同じ seq になって
+# 片方のメッセージが上書きされるので、追加の前にユーザーごとのトランザクション単位のロックを取る
+# （SQLite は書き込みが1本ずつなので不要）
+LOCK_CONVERSATION_RING = Query(
+    'lock_conversation_ring', 'SELECT pg_advisory_xact_lock(hashtext(CAST(? AS TEXT)))'
+)
+GET_CONVERSATION_HISTORY = Query('get_conversation_history', '''
+    SELECT role, content, created_at
+    FROM conversation_ring
+    WHERE line_user_id = ?
+    ORDER BY seq DESC
+    LIMIT ?
+''')
+TRIM_CONVERSATION_RING = Query('trim_conversation_ring', '''
+    DELETE FROM conversation_ring
+    WHERE line_user_id = ?
+    AND seq <= (SELECT MAX(seq) FROM conversation_ring WHERE line_user_id = ?) - ?
+''')
+# 旧 conversation_history テーブルからの移行用
+CONVERSATION_RING_HAS_ROWS = Query('conversation_ring_has_rows', 'SELECT 1 FROM conversation_ring LIMIT 1')
+LEGACY_CONVERSATION_HISTORY = Query('legacy_conversation_history', '''
+    SELECT line_user_id, role, content, created_at
+    FROM conversation_history
+    ORDER BY line_user_id, created_at, id
+''')
+INSERT_CONVERSATION_SLOT = Query('insert_conversation_slot', '''
+    INSERT INTO conversation_ring (line_user_id, slot, seq, role, content, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (line_user_id, slot) DO NOTHING
+''')
+
+# --- calendar mirror ---
+GET_CALENDAR_SYNC_STATE = Query('get_calendar_sync_state', '''
+    SELECT sync_token, window_start, window_end, synced_at
+    FROM calendar_sync_state WHERE line_user_id=?
+''')
+SAVE_CALENDAR_SYNC_STATE = Query('save_calendar_sync_state', '''
+    INSERT INTO calendar_sync_state (line_user_id, sync_token, window_start, window_end, synced_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (line_user_id) DO UPDATE SET
+        sync_token=EXCLUDED.sync_token,
+        window_start=COALESCE(EXCLUDED.window_start, calendar_sync_state.window_start),
+        window_end=COALESCE(EXCLUDED.window_end, calendar_sync_state.window_end),
+        synced_at=EXCLUDED.synced_at
+''')
+UPSERT_MIRRORED_EVENT = Query('upsert_mirrored_event', '''
+    INSERT INTO calendar_event_mirror (line_user_id, event_id, start_utc, end_utc, event_json)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (line_user_id, event_id) DO UPDATE SET
+        start_utc=EXCLUDED.start_utc, end_utc=EXCLUDED.end_utc, event_json=EXCLUDED.event_json
+''')
+DELETE_MIRRORED_EVENT = Query(
+    'delete_mirrored_event', 'DELETE FROM calendar_event_mirror WHERE line_user_id=? AND event_id=?'
+)
+DELETE_USER_MIRROR = Query('delete_user_mirror', 'DELETE FROM calendar_event_mirror WHERE line_user_id=?')
+DELETE_SYNC_STATE = Query('delete_sync_state', 'DELETE FROM calendar_sync_state WHERE line_user_id=?')
+GET_MIRRORED_EVENTS = Query('get_mirrored_events', '''
+    SELECT event_json FROM calendar_event_mirror
+    WHERE line_user_id=? AND start_utc < ? AND (end_utc > ? OR start_utc >= ?)
+    ORDER BY start_utc, end_utc
+''')
+
+# --- ai_response_cache ---
+GET_AI_RESPONSE = Query(
+    'get_ai_response', 'SELECT response_json FROM ai_response_cache WHERE cache_key=? AND expires_at > ?'
+)
+SAVE_AI_RESPONSE = Query('save_ai_response', '''
+    INSERT INTO ai_response_cache (cache_key, response_json, expires_at)
+    VALUES (?, ?, ?)
+    ON CONFLICT (cache_key) DO UPDATE SET response_json=EXCLUDED.response_json, expires_at=EXCLUDED.expires_at
+''')
+DELETE_EXPIRED_AI_RESPONSES = Query('delete_expired_ai_responses', 'DELETE FROM ai_response_cache WHERE expires_at < ?')
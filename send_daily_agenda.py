@@ -1,12 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
+import threading
+import time
 from calendar_service import GoogleCalendarService
 from db import DBHelper
 from linebot import LineBotApi
 from linebot.models import TextSendMessage
 from config import Config
+from work_queue import RateLimiter, percentile
 import logging
 logging.basicConfig(level=logging.INFO)
 
+# LINE multicast の1リクエストあたりの宛先上限
+MULTICAST_MAX_RECIPIENTS = 500
+
 def format_rich_agenda(events_info, is_tomorrow=False):
     if not events_info or not events_info[0]['events']:
         return "✅明日の予定はありません！" if is_tomorrow else "✅今日の予定はありません！"
@@ -24,28 +31,151 @@ def format_rich_agenda(events_info, is_tomorrow=False):
     footer = "━━━━━━━━━━"
     return f"{header}\n" + "\n".join(lines) + footer
 
-def send_daily_agenda():
-    logging.info(f"[DEBUG] 日次予定送信開始: {datetime.now()}")
-    db = DBHelper()
-    # 追加デバッグ: usersテーブル全件ダンプ
-    c = db.conn.cursor()
+def _reauth_message(onetime_code):
+    return (
+        "Googleカレンダー連携の認証が切れています。\n"
+        "下記URLから再認証をお願いします。\n\n"
+        f"🔐 ワンタイムコード: {onetime_code}\n\n"
+        "https://task-bot-production.up.railway.app/onetime_login\n"
+        "（上記ページでワンタイムコードを入力してください）"
+    )
+
+def _prepare_agenda(user_id, tomorrow, calendar_service, line_bot_api, db, google_limiter, line_limiter, timed_out, messages):
+    """1ユーザー分の予定を取得して messages[user_id] に本文を入れる
+
+    戻り値は 'rendered' / 'reauth' / 'timeout'。本文の送信は同じ本文のユーザーをまとめてから行う。
+    認証エラー時の再認証案内はユーザーごとに内容が違うため、ここで個別に push する（送れなければ例外）。
+    """
     try:
-        c.execute("SELECT 1 FROM information_schema.tables WHERE table_name='users'")
-        if c.fetchone():
-            logging.info('[DEBUG] usersテーブルは存在します')
-        else:
-            logging.info('[DEBUG] usersテーブルは存在しません')
+        google_limiter.acquire()
+        events_info = calendar_service.get_events_for_dates([tomorrow], user_id)
+        logging.info(f"[DEBUG] ユーザー: {user_id} の取得した予定: {events_info}")
+        if events_info and 'events' not in events_info[0]:
+            raise Exception(events_info[0].get('error', '予定を取得できませんでした'))
+        message = format_rich_agenda(events_info, is_tomorrow=True)
+        if timed_out.is_set():
+            return 'timeout'
+        messages[user_id] = message
+        return 'rendered'
     except Exception as e:
-        logging.error(f'[DEBUG] usersテーブル存在確認クエリエラー: {e}')
+        if timed_out.is_set():
+            return 'timeout'
+        logging.error(f"[ERROR] ユーザー {user_id} への送信中にエラー: {e}")
+        # 認証エラー時はLINEで再認証案内を送信
+        onetime_code = db.generate_onetime_code(user_id)
+        try:
+            line_limiter.acquire()
+            line_bot_api.push_message(user_id, TextSendMessage(text=_reauth_message(onetime_code)))
+            logging.info(f"[DEBUG] ユーザー {user_id} に再認証案内を送信（ワンタイムコード付き）")
+        except Exception as e2:
+            logging.error(f"[ERROR] ユーザー {user_id} への再認証案内送信エラー: {e2}")
+            raise
+        return 'reauth'
+
+def _send_grouped(messages, line_bot_api, line_limiter, workers, user_timeout):
+    """同じ本文のユーザーは multicast（MULTICAST_MAX_RECIPIENTS 人ずつ）、それ以外は push で送信する
+
+    戻り値は ({user_id: 'sent' / 'failed' / 'timeout'}, multicast 呼び出し回数, push 呼び出し回数)。
+    multicast が失敗したまとまりは push で送り直す。
+    """
+    recipients_by_text = {}
+    for user_id, text in messages.items():
+        recipients_by_text.setdefault(text, []).append(user_id)
+
+    outcomes = {}
+    multicast_calls = 0
+    singles = []
+    for text, user_ids in recipients_by_text.items():
+        if len(user_ids) < 2:
+            singles.extend(user_ids)
+            continue
+        for i in range(0, len(user_ids), MULTICAST_MAX_RECIPIENTS):
+            chunk = user_ids[i:i + MULTICAST_MAX_RECIPIENTS]
+            try:
+                line_limiter.acquire()
+                multicast_calls += 1
+                line_bot_api.multicast(chunk, TextSendMessage(text=text))
+                logging.info(f"[DEBUG] multicast送信完了: {len(chunk)}人, メッセージ: {text}")
+                for user_id in chunk:
+                    outcomes[user_id] = 'sent'
+            except Exception as e:
+                logging.error(f"[ERROR] multicast送信エラー（pushで再送します）: {e}")
+                singles.extend(chunk)
+
+    def push(user_id, timed_out):
+        line_limiter.acquire()
+        line_bot_api.push_message(user_id, TextSendMessage(text=messages[user_id]))
+        logging.info(f"[DEBUG] ユーザー {user_id} への送信完了")
+        return 'sent'
+
+    for user_id, (outcome, _) in _fan_out(singles, push, workers, user_timeout).items():
+        outcomes[user_id] = outcome
+    return outcomes, multicast_calls, len(singles)
+
+def _fan_out(user_ids, task, workers, user_timeout):
+    """user_ids を最大 workers 並列で task(user_id, timed_out) に渡し、(結果, 処理秒数) の辞書を返す
+
+    処理開始から user_timeout 秒を超えたユーザーは 'timeout' とし、それ以降の送信は行わせない。
+    """
+    results = {}
+    started = {}
+    timed_out = {user_id: threading.Event() for user_id in user_ids}
+
+    def run(user_id):
+        started[user_id] = time.monotonic()
+        outcome = task(user_id, timed_out[user_id])
+        return outcome, time.monotonic() - started[user_id]
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="daily-agenda")
+    futures = {executor.submit(run, user_id): user_id for user_id in user_ids}
+    pending = set(futures)
     try:
-        c.execute('SELECT line_user_id, LENGTH(google_token), created_at, updated_at FROM users')
-        users = c.fetchall()
-        if users:
-            logging.info(f'[DEBUG] usersテーブル全件: {users}')
-        else:
-            logging.info('[DEBUG] usersテーブルは空です')
-    except Exception as e:
-        logging.error(f'[DEBUG] usersテーブル全件取得エラー: {e}')
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                user_id = futures[future]
+                try:
+                    results[user_id] = future.result()
+                except Exception:
+                    results[user_id] = ('failed', time.monotonic() - started.get(user_id, time.monotonic()))
+            now = time.monotonic()
+            for future in list(pending):
+                user_id = futures[future]
+                if user_id in started and now - started[user_id] > user_timeout:
+                    logging.error(f"[ERROR] ユーザー {user_id} の処理が{user_timeout}秒を超えたため打ち切ります")
+                    timed_out[user_id].set()
+                    results[user_id] = ('timeout', now - started[user_id])
+                    pending.discard(future)
+    finally:
+        # 打ち切ったスレッドの終了は待たない
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+def send_daily_agenda(workers=None, user_timeout=None):
+    """認証済みユーザー全員に明日の予定を送信し、結果のサマリーを返します"""
+    job_started = time.monotonic()
+    logging.info(f"[DEBUG] 日次予定送信開始: {datetime.now()}")
+    db = DBHelper()
+    # 追加デバッグ: usersテーブル全件ダンプ
+    with db.connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("SELECT 1 FROM information_schema.tables WHERE table_name='users'")
+            if c.fetchone():
+                logging.info('[DEBUG] usersテーブルは存在します')
+            else:
+                logging.info('[DEBUG] usersテーブルは存在しません')
+        except Exception as e:
+            logging.error(f'[DEBUG] usersテーブル存在確認クエリエラー: {e}')
+        try:
+            c.execute('SELECT line_user_id, LENGTH(google_token), created_at, updated_at FROM users')
+            users = c.fetchall()
+            if users:
+                logging.info(f'[DEBUG] usersテーブル全件: {users}')
+            else:
+                logging.info('[DEBUG] usersテーブルは空です')
+        except Exception as e:
+            logging.error(f'[DEBUG] usersテーブル全件取得エラー: {e}')
     calendar_service = GoogleCalendarService()
     line_bot_api = LineBotApi(Config.LINE_CHANNEL_ACCESS_TOKEN)
     tomorrow = datetime.now().date() + timedelta(days=1)
@@ -53,32 +183,41 @@ def send_daily_agenda():
     user_ids = db.get_all_user_ids()  # 認証済みユーザーのみ返すようにDBHelperを調整
     logging.info(f"[DEBUG] 送信対象ユーザー: {user_ids}")
 
-    for user_id in user_ids:
-        try:
-            events_info = calendar_service.get_events_for_dates([tomorrow], user_id)
-            logging.info(f"[DEBUG] ユーザー: {user_id} の取得した予定: {events_info}")
-            message = format_rich_agenda(events_info, is_tomorrow=True)
-            logging.info(f"[DEBUG] 送信先: {user_id}, メッセージ: {message}")
-            line_bot_api.push_message(user_id, TextSendMessage(text=message))
-            logging.info(f"[DEBUG] ユーザー {user_id} への送信完了")
-        except Exception as e:
-            logging.error(f"[ERROR] ユーザー {user_id} への送信中にエラー: {e}")
-            # 認証エラー時はLINEで再認証案内を送信
-            onetime_code = db.generate_onetime_code(user_id)
-            auth_message = (
-                "Googleカレンダー連携の認証が切れています。\n"
-                "下記URLから再認証をお願いします。\n\n"
-                f"🔐 ワンタイムコード: {onetime_code}\n\n"
-                "https://task-bot-production.up.railway.app/onetime_login\n"
-                "（上記ページでワンタイムコードを入力してください）"
-            )
-            try:
-                line_bot_api.push_message(user_id, TextSendMessage(text=auth_message))
-                logging.info(f"[DEBUG] ユーザー {user_id} に再認証案内を送信（ワンタイムコード付き）")
-            except Exception as e2:
-                logging.error(f"[ERROR] ユーザー {user_id} への再認証案内送信エラー: {e2}")
-    
+    workers = workers or Config.DAILY_AGENDA_WORKERS
+    user_timeout = user_timeout or Config.DAILY_AGENDA_USER_TIMEOUT
+    google_limiter = RateLimiter(Config.GOOGLE_API_RATE_PER_SEC)
+    line_limiter = RateLimiter(Config.LINE_API_RATE_PER_SEC)
+
+    messages = {}
+
+    def task(user_id, timed_out):
+        return _prepare_agenda(
+            user_id, tomorrow, calendar_service, line_bot_api, db, google_limiter, line_limiter, timed_out, messages
+        )
+
+    results = _fan_out(user_ids, task, workers, user_timeout)
+    rendered = {user_id: messages[user_id] for user_id, (outcome, _) in results.items() if outcome == 'rendered'}
+    send_outcomes, multicast_calls, push_calls = _send_grouped(rendered, line_bot_api, line_limiter, workers, user_timeout)
+
+    durations = [elapsed for _, elapsed in results.values()]
+    outcomes = [send_outcomes.get(user_id, outcome) for user_id, (outcome, _) in results.items()]
+    summary = {
+        'users': len(user_ids),
+        'sent': outcomes.count('sent'),
+        'reauth': outcomes.count('reauth'),
+        'failed': outcomes.count('failed'),
+        'timeouts': outcomes.count('timeout'),
+        'multicast_calls': multicast_calls,
+        'push_calls': push_calls + outcomes.count('reauth'),
+        'workers': workers,
+        'wall_ms': round((time.monotonic() - job_started) * 1000, 1),
+        'user_ms_p50': round(percentile(durations, 50) * 1000, 1),
+        'user_ms_p95': round(percentile(durations, 95) * 1000, 1),
+        'user_ms_max': round(max(durations) * 1000, 1) if durations else 0.0,
+    }
+    logging.info(f"[DEBUG] 日次予定送信サマリー: {summary}")
     logging.info(f"[DEBUG] 日次予定送信完了: {datetime.now()}")
+    return summary
 
 if __name__ == "__main__":
     send_daily_agenda() 
\ No newline at end of file
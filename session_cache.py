@@ -0,0 +1,121 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class SessionCache:
+    """ユーザーごとの認証済みか・保留中の予定・直近の会話履歴を保持するキャッシュ（TTL + LRU）
+
+    MessageUnitOfWork が読み込んだ内容を丸ごと入れ、同じユーザーの次のメッセージでは
+    DBを読まずに済ませる。MessageUnitOfWork の書き込みはコミット後に反映（ライトスルー）し、
+    それ以外の経路での書き込み（トークン保存・保留中の予定の保存/削除など）では無効化する。
+    取得と保存の間に無効化された場合は保存しない（古い内容で上書きしないため）。
+    エントリには保存ごとに別の token を付け、書き込みの反映は読み込んだときと同じエントリにだけ行う。
+    """
+
+    def __init__(self, max_size=1024, ttl_seconds=300, history_size=10):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.history_size = history_size
+        self._entries = OrderedDict()
+        # 無効化のたびに増やす世代番号と、ユーザーごとの最後に無効化された世代（読み込み中に無効化されたかの判定用）
+        # 記録は直近 max_size 人分だけ残し、捨てた記録の世代は _generation_floor にまとめる
+        self._generation = 0
+        self._generations = OrderedDict()
+        self._generation_floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, line_user_id):
+        """読み込み開始時の世代。put() に渡すと、それ以降に無効化されていれば保存しない"""
+        with self._lock:
+            return self._generation
+
+    def _invalidated_since(self, line_user_id, generation):
+        invalidated = self._generations.get(line_user_id, self._generation_floor)
+        return invalidated > generation
+
+    def get(self, line_user_id, history_limit=0):
+        """キャッシュ済みなら {'user_exists', 'pending_event', 'history', 'token'} を返します（history は直近 history_limit 件）"""
+        with self._lock:
+            entry = self._entries.get(line_user_id)
+            if entry is None or history_limit > self.history_size:
+                self.misses += 1
+                return None
+            if entry['expires_at'] <= time.monotonic():
+                del self._entries[line_user_id]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(line_user_id)
+            self.hits += 1
+            history = entry['history'][-history_limit:] if history_limit else []
+            return {
+                'user_exists': entry['user_exists'],
+                'pending_event': entry['pending_event'],
+                'history': [dict(message) for message in history],
+                'token': entry['token'],
+            }
+
+    def put(self, line_user_id, user_exists, pending_event, history, generation):
+        """DBから読み込んだ内容を保存して token を返します。読み込み開始後に無効化されていれば保存せず None"""
+        with self._lock:
+            if self._invalidated_since(line_user_id, generation):
+                return None
+            token = object()
+            self._entries[line_user_id] = {
+                'token': token,
+                'user_exists': user_exists,
+                'pending_event': pending_event,
+                'history': [dict(message) for message in history[-self.history_size:]],
+                'expires_at': time.monotonic() + self.ttl,
+            }
+            self._entries.move_to_end(line_user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return token
+
+    def apply_writes(self, line_user_id, token, pending_deleted=False, messages=()):
+        """コミット済みの書き込みを、token のエントリに反映します（別のエントリに置き換わっていれば捨てる）"""
+        with self._lock:
+            entry = self._entries.get(line_user_id)
+            if entry is None:
+                return
+            if token is None or entry['token'] is not token:
+                del self._entries[line_user_id]
+                self.invalidations += 1
+                return
+            if pending_deleted:
+                entry['pending_event'] = None
+            if messages:
+                entry['history'] = (entry['history'] + [dict(message) for message in messages])[-self.history_size:]
+
+    def invalidate(self, line_user_id):
+        with self._lock:
+            self._generation += 1
+            self._generations[line_user_id] = self._generation
+            self._generations.move_to_end(line_user_id)
+            while len(self._generations) > self.max_size:
+                _, self._generation_floor = self._generations.popitem(last=False)
+            if self._entries.pop(line_user_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            }
@@ -9,6 +9,7 @@ import sys
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import json
+import pytest
 
 from calendar_service import GoogleCalendarService, _event_is_all_day_for_availability
 import pytz
@@ -228,6 +229,989 @@ def test_find_free_slots_ignores_timed_midnight_all_day():
         {'start': '20:30', 'end': '22:00'},
     ]
 
+class _FakeEventsList:
+    def __init__(self, pages, calls):
+        self.pages = pages
+        self.calls = calls
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        page = self.pages[kwargs.get('pageToken') or 0]
+        return type('Req', (), {'execute': lambda _self: page})()
+
+
+class _FakeCalendarApi:
+    def __init__(self, pages):
+        self.calls = []
+        self.pages = pages
+
+    def events(self):
+        return _FakeEventsList(self.pages, self.calls)
+
+
+def test_get_events_for_dates_single_range_query():
+    """近い日付は1回の範囲クエリ（ページング込み）で取得し、JST日付ごとに振り分ける"""
+    from datetime import date
+    api = _FakeCalendarApi({
+        0: {'items': [
+            {'summary': '朝会', 'start': {'dateTime': '2025-07-10T09:00:00+09:00'}, 'end': {'dateTime': '2025-07-10T09:30:00+09:00'}},
+            {'summary': '出張', 'start': {'date': '2025-07-10'}, 'end': {'date': '2025-07-12'}},
+        ], 'nextPageToken': 'p2'},
+        'p2': {'items': [
+            {'summary': 'MTG', 'start': {'dateTime': '2025-07-11T01:00:00Z'}, 'end': {'dateTime': '2025-07-11T02:00:00Z'}},
+        ]},
+    })
+    service = GoogleCalendarService()
+    service.service = api
+    events_info = service.get_events_for_dates([date(2025, 7, 11), date(2025, 7, 10), date(2025, 7, 12)])
+    assert len(api.calls) == 2
+    assert api.calls[0]['maxResults'] == 2500
+    assert api.calls[0]['fields'] == 'nextPageToken,items(id,status,summary,start,end)'
+    assert api.calls[1]['pageToken'] == 'p2'
+    assert [info['date'] for info in events_info] == ['2025-07-11', '2025-07-10', '2025-07-12']
+    assert [e['title'] for e in events_info[0]['events']] == ['出張', 'MTG']
+    assert [e['title'] for e in events_info[1]['events']] == ['朝会', '出張']
+    assert events_info[2]['events'] == []
+
+class _FakeSyncingCalendarApi:
+    """フル同期では nextSyncToken を返し、syncToken 指定時は差分を返す"""
+
+    def __init__(self):
+        self.calls = []
+        self.items = []
+        self.delta = []
+        self.gone = False
+
+    def events(self):
+        return self
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get('syncToken'):
+            if self.gone:
+                import httplib2
+                from googleapiclient.errors import HttpError
+                self.gone = False
+                raise HttpError(httplib2.Response({'status': 410}), b'')
+            page = {'items': self.delta, 'nextSyncToken': 'token-delta'}
+        else:
+            page = {'items': self.items, 'nextSyncToken': 'token-full'}
+        return type('Req', (), {'execute': lambda _self: page})()
+
+
+def test_get_events_for_time_range_uses_sync_mirror(tmp_path):
+    """2回目以降は syncToken の差分だけを取得してミラーから答え、410 ならフル同期し直す"""
+    from calendar_service import CalendarEventMirror
+    import calendar_service
+    from db import DBHelper
+    jst = pytz.timezone('Asia/Tokyo')
+    day = datetime.now(jst).date() + timedelta(days=2)
+    def iso(hour):
+        return jst.localize(datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)).isoformat()
+    api = _FakeSyncingCalendarApi()
+    api.items = [
+        {'id': 'a', 'status': 'confirmed', 'summary': 'MTG', 'start': {'dateTime': iso(10)}, 'end': {'dateTime': iso(11)}},
+        {'id': 'b', 'status': 'confirmed', 'summary': '会食', 'start': {'dateTime': iso(19)}, 'end': {'dateTime': iso(21)}},
+    ]
+    service = GoogleCalendarService()
+    service.db_helper = DBHelper(db_path=str(tmp_path / 'mirror.db'))
+    service._get_calendar_service = lambda line_user_id: api
+    original_mirror = calendar_service.calendar_mirror
+    calendar_service.calendar_mirror = CalendarEventMirror(window_days=30, min_sync_interval=0)
+    try:
+        start_dt = jst.localize(datetime.combine(day, datetime.min.time()) + timedelta(hours=9))
+        end_dt = start_dt + timedelta(hours=12)
+        events = service.get_events_for_time_range(start_dt, end_dt, 'U1')
+        assert [e['title'] for e in events] == ['MTG', '会食']
+        assert 'syncToken' not in api.calls[-1]
+
+        api.delta = [
+            {'id': 'a', 'status': 'cancelled'},
+            {'id': 'c', 'status': 'confirmed', 'summary': '面談', 'start': {'dateTime': iso(13)}, 'end': {'dateTime': iso(14)}},
+        ]
+        events = service.get_events_for_time_range(start_dt, end_dt, 'U1')
+        assert api.calls[-1]['syncToken'] == 'token-full'
+        assert [e['title'] for e in events] == ['面談', '会食']
+
+        api.gone = True
+        events = service.get_events_for_time_range(start_dt, end_dt, 'U1')
+        assert 'syncToken' not in api.calls[-1]
+        assert [e['title'] for e in events] == ['MTG', '会食']
+        assert calendar_service.calendar_mirror.stats()['resyncs_gone'] == 1
+
+        # 以前のフル同期の期間（過去日を含む）に入る問い合わせでも、410 でフル同期し直した後の
+        # 期間（今日基準）から外れるなら、ミラーの空の結果ではなく直接取得した予定を返す
+        mirror = calendar_service.calendar_mirror
+        past_day = datetime.now(jst).date() - timedelta(days=5)
+        past_start = jst.localize(datetime.combine(past_day, datetime.min.time()) + timedelta(hours=9))
+        past_end = past_start + timedelta(hours=12)
+        past_event = {'id': 'p', 'status': 'confirmed', 'summary': '過去の会議',
+                      'start': {'dateTime': (past_start + timedelta(hours=1)).isoformat()},
+                      'end': {'dateTime': (past_start + timedelta(hours=2)).isoformat()}}
+        api.items = api.items + [past_event]
+        current_window = mirror._window
+        mirror._window = lambda: (past_start - timedelta(days=1), current_window()[1])
+        events = service.get_events_for_time_range(past_start, past_end, 'U2')
+        assert '過去の会議' in [e['title'] for e in events]
+        mirror._window = current_window
+        api.gone = True
+        bypassed = mirror.stats()['bypassed']
+        events = service.get_events_for_time_range(past_start, past_end, 'U2')
+        assert mirror.stats()['resyncs_gone'] == 2 and mirror.stats()['bypassed'] == bypassed + 1
+        assert api.calls[-1]['timeMin'] == past_start.astimezone(pytz.UTC).isoformat()
+        assert '過去の会議' in [e['title'] for e in events]
+    finally:
+        calendar_service.calendar_mirror = original_mirror
+
+def test_calendar_discovery_loads_from_disk_or_bundled_doc(tmp_path, monkeypatch):
+    """ディスカバリドキュメントは同梱の静的ドキュメントから読んでディスクに書き出し、次からはディスクから読む"""
+    import calendar_service
+    from config import Config
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.http import HttpRequest
+    path = tmp_path / 'calendar_v3_discovery.json'
+    monkeypatch.setattr(Config, 'CALENDAR_DISCOVERY_FILE', str(path))
+    monkeypatch.setattr(calendar_service, '_calendar_discovery_doc', None)
+    monkeypatch.setattr(calendar_service, '_calendar_discovery_info', {'source': None, 'load_ms': None})
+
+    bundled = calendar_service.load_calendar_discovery()
+    assert calendar_service.calendar_discovery_stats()['source'] == 'bundled'
+    assert bundled['name'] == 'calendar' and bundled['version'] == 'v3'
+    assert json.loads(path.read_text(encoding='utf-8')) == bundled
+    # 2回目以降はメモリ上のものを返す
+    assert calendar_service.load_calendar_discovery() is bundled
+
+    monkeypatch.setattr(calendar_service, '_calendar_discovery_doc', None)
+    from_disk = calendar_service.load_calendar_discovery()
+    assert calendar_service.calendar_discovery_stats()['source'] == 'disk'
+    assert from_disk == bundled
+
+    # 壊れたキャッシュファイルは同梱のドキュメントで置き換える
+    path.write_text('{broken', encoding='utf-8')
+    monkeypatch.setattr(calendar_service, '_calendar_discovery_doc', None)
+    assert calendar_service.load_calendar_discovery() == bundled
+    assert calendar_service.calendar_discovery_stats()['source'] == 'bundled'
+    assert json.loads(path.read_text(encoding='utf-8')) == bundled
+
+    # build_from_document で作った service から events().list のリクエストが組み立てられる
+    service = calendar_service._build_calendar_service(Credentials(token='access'))
+    request = service.events().list(calendarId='primary', timeMin='2025-03-03T00:00:00+09:00', singleEvents=True)
+    assert isinstance(request, HttpRequest)
+    assert request.method == 'GET'
+    assert '/calendars/primary/events' in request.uri and 'singleEvents=true' in request.uri
+
+def test_calendar_service_cache_revalidates_and_invalidates(tmp_path, monkeypatch, oauth_client_env):
+    """構築済みserviceはTTL切れでもトークンが同じなら再利用し、トークンが変われば作り直す"""
+    import calendar_service
+    import db as db_module
+    from google.oauth2.credentials import Credentials
+    from db import DBHelper, register_token_listener
+    from token_store import encode_credentials
+    cache = calendar_service.CalendarServiceCache(max_size=8, ttl_seconds=600)
+    monkeypatch.setattr(calendar_service, 'service_cache', cache)
+    monkeypatch.setattr(db_module, '_token_listeners', [])
+    built = []
+    def build(credentials):
+        built.append(credentials.token)
+        return object()
+    monkeypatch.setattr(calendar_service, '_build_calendar_service', build)
+    db = DBHelper(db_path=str(tmp_path / 'service_cache.db'))
+    def save(token):
+        db.save_google_token('cache-user', encode_credentials(
+            Credentials(token=token, refresh_token='r', expiry=datetime(2099, 1, 1))))
+    save('t1')
+    service = GoogleCalendarService.__new__(GoogleCalendarService)
+    service.db_helper = db
+
+    first = service._get_calendar_service('cache-user')
+    assert service._get_calendar_service('cache-user') is first
+    assert built == ['t1'] and cache.stats()['hits'] == 1
+
+    # TTL切れでもDB上のトークンが同じなら、fingerprint で確認して使い続ける
+    cache.ttl_seconds = 0
+    assert service._get_calendar_service('cache-user') is first
+    assert built == ['t1'] and cache.stats()['revalidations'] == 1
+
+    # 通知なしでトークンが変わった場合（別プロセスでの更新など）は fingerprint の違いで作り直す
+    save('t2')
+    second = service._get_calendar_service('cache-user')
+    assert second is not first and built == ['t1', 't2']
+
+    # register_token_listener 経由の通知では、TTL内でもすぐに捨てる
+    cache.ttl_seconds = 600
+    register_token_listener(cache.invalidate)
+    invalidations = cache.stats()['invalidations']
+    save('t3')
+    assert cache.stats()['invalidations'] == invalidations + 1
+    assert service._get_calendar_service('cache-user') is not second
+    assert built == ['t1', 't2', 't3']
+
+def test_busy_interval_index_multiple_frames():
+    """取得範囲から1度作ったインデックスで、複数日・複数枠の空き時間を求める"""
+    from busy_index import BusyIntervalIndex
+    jst = pytz.timezone('Asia/Tokyo')
+    events = [
+        {'title': '大阪', 'start': '2025-07-10', 'end': '2025-07-12', 'all_day': True},
+        {'title': 'MTG', 'start': '2025-07-10T10:00:00+09:00', 'end': '2025-07-10T11:00:00+09:00'},
+        {'title': '重複', 'start': '2025-07-10T10:30:00+09:00', 'end': '2025-07-10T12:00:00+09:00'},
+        {'title': '夜勤', 'start': '2025-07-10T22:00:00+09:00', 'end': '2025-07-11T09:00:00+09:00'},
+        {'title': '会議', 'start': '2025-07-11T04:30:00Z', 'end': '2025-07-11T05:00:00Z'},
+    ]
+    busy_index = BusyIntervalIndex(events, jst)
+    assert len(busy_index) == 3
+    def frame(day, start, end):
+        return (
+            jst.localize(datetime.strptime(f'2025-07-{day} {start}', '%Y-%m-%d %H:%M')),
+            jst.localize(datetime.strptime(f'2025-07-{day} {end}', '%Y-%m-%d %H:%M')),
+        )
+    slots = busy_index.free_slots_for_frames([frame(10, '08:00', '22:00'), frame(11, '08:00', '22:00')])
+    assert slots[0] == [{'start': '08:00', 'end': '10:00'}, {'start': '12:00', 'end': '22:00'}]
+    assert slots[1] == [{'start': '09:00', 'end': '13:30'}, {'start': '14:00', 'end': '22:00'}]
+    assert busy_index.free_slots(*frame(10, '08:00', '13:00'), min_minutes=90) == [{'start': '08:00', 'end': '10:00'}]
+    service = GoogleCalendarService()
+    assert service.find_free_slots_for_day(*frame(11, '08:00', '12:00'), busy_index) == [{'start': '09:00', 'end': '12:00'}]
+
+def test_bitmap_backend_matches_interval_backend():
+    """bitmap方式でも interval方式と同じ free_slots / raw_free_slots・返答になる（移動時間・必要時間あり）"""
+    pytest.importorskip('numpy')
+    from types import SimpleNamespace
+    from busy_index import BusyIntervalIndex
+    from line_bot_handler import LineBotHandler
+    jst = pytz.timezone('Asia/Tokyo')
+    events = [
+        {'title': 'MTG', 'start': '2025-03-03T10:00:00+09:00', 'end': '2025-03-03T11:00:00+09:00'},
+        {'title': '会食', 'start': '2025-03-03T18:00:00+09:00', 'end': '2025-03-03T20:30:00+09:00'},
+        {'title': '夜勤', 'start': '2025-03-04T21:00:00+09:00', 'end': '2025-03-05T09:30:00+09:00'},
+    ]
+    dates_info = [
+        {'date': '2025-03-03', 'time': '09:00', 'end_time': '21:00'},
+        {'date': '2025-03-04', 'time': '08:00', 'end_time': '22:00'},
+        {'date': '2025-03-05', 'time': '07:00', 'end_time': '12:00'},
+    ]
+    span_start = jst.localize(datetime(2025, 3, 3))
+    span_end = jst.localize(datetime(2025, 3, 6))
+    handler = LineBotHandler.__new__(LineBotHandler)
+    frames = handler._free_slots_by_frame_bitmap(
+        dates_info, BusyIntervalIndex(events, jst), span_start, span_end, travel_time_minutes=30, min_minutes=120
+    )
+    assert [f['start_time'] for f in frames] == ['09:00', '08:00', '08:00']
+    assert frames[0]['free_slots'] == [{'start': '11:30', 'end': '17:30'}]
+    assert frames[0]['raw_free_slots'] == [
+        {'start': '08:30', 'end': '10:00'}, {'start': '11:00', 'end': '18:00'}, {'start': '20:30', 'end': '21:30'}
+    ]
+    assert frames[1]['free_slots'] == [{'start': '08:30', 'end': '20:30'}]
+    assert frames[2]['free_slots'] == []
+    assert frames[2]['raw_free_slots'] == [{'start': '09:30', 'end': '12:30'}]
+
+    # 同じ入力を _handle_availability_check の両方式に通し、返答が一致することを確かめる
+    calendar = GoogleCalendarService.__new__(GoogleCalendarService)
+    calendar.get_events_for_time_range = lambda start, end, line_user_id: [dict(e) for e in events]
+    handler.calendar_service = calendar
+    handler.ai_service = AIService.__new__(AIService)
+    handler.db_helper = SimpleNamespace(user_exists=lambda line_user_id: True)
+    responses = {
+        backend: handler._handle_availability_check(
+            [dict(d) for d in dates_info], 'U1', required_duration_minutes=120, travel_time_minutes=30, backend=backend
+        ).text
+        for backend in ('interval', 'bitmap')
+    }
+    assert responses['bitmap'] == responses['interval']
+    assert '11:30' in responses['interval'] and '17:30' in responses['interval']
+
+@pytest.fixture
+def oauth_client_env(monkeypatch):
+    """credentials.json のない環境で GOOGLE_CLIENT_ID / GOOGLE_CLIENT_SECRET を設定する"""
+    import token_store
+    from config import Config
+    monkeypatch.setattr(Config, 'GOOGLE_CREDENTIALS_FILE', 'missing-credentials.json')
+    monkeypatch.setattr(Config, 'GOOGLE_CLIENT_ID', 'env-cid')
+    monkeypatch.setattr(Config, 'GOOGLE_CLIENT_SECRET', 'env-secret')
+    monkeypatch.setattr(token_store, '_client_info', None)
+
+def test_token_store_roundtrip_and_legacy_migration(tmp_path, oauth_client_env):
+    """Credentials はコンパクトなJSONで保存し、旧形式（pickle）は起動時に移行する"""
+    import pickle
+    from google.oauth2.credentials import Credentials
+    from db import DBHelper
+    from token_store import decode_credentials, encode_credentials, is_current_format, migrate_legacy_tokens
+    credentials = Credentials(
+        token='access', refresh_token='refresh', token_uri='https://oauth2.googleapis.com/token',
+        client_id='cid', client_secret='secret', scopes=['https://www.googleapis.com/auth/calendar'],
+        expiry=datetime(2030, 1, 1, 12, 0, 0),
+    )
+    encoded = encode_credentials(credentials)
+    assert b'secret' not in encoded and is_current_format(encoded)
+    decoded = decode_credentials(memoryview(encoded))
+    assert (decoded.token, decoded.refresh_token, decoded.expiry) == ('access', 'refresh', datetime(2030, 1, 1, 12, 0, 0))
+    assert decoded.scopes == ['https://www.googleapis.com/auth/calendar']
+
+    db = DBHelper(db_path=str(tmp_path / 'tokens.db'))
+    db.save_google_token('U1', pickle.dumps(credentials))
+    db.save_google_token('U2', encoded)
+    assert migrate_legacy_tokens(db) == (1, 0)
+    assert is_current_format(db.get_google_token('U1'))
+    assert decode_credentials(db.get_google_token('U1')).refresh_token == 'refresh'
+
+def test_v1_token_decodes_with_client_env_vars_only(tmp_path, monkeypatch, oauth_client_env):
+    """credentials.json がなくても環境変数のクライアント設定で復元し、どちらもなければ移行しない"""
+    import pickle
+    import token_store
+    from config import Config
+    from google.oauth2.credentials import Credentials
+    from db import DBHelper
+    from token_store import decode_credentials, encode_credentials, is_current_format, migrate_legacy_tokens
+    encoded = encode_credentials(Credentials(token='access', refresh_token='refresh'))
+    decoded = decode_credentials(encoded)
+    assert (decoded.client_id, decoded.client_secret) == ('env-cid', 'env-secret')
+    assert decoded.token_uri == 'https://oauth2.googleapis.com/token'
+
+    monkeypatch.setattr(Config, 'GOOGLE_CLIENT_ID', None)
+    monkeypatch.setattr(Config, 'GOOGLE_CLIENT_SECRET', None)
+    monkeypatch.setattr(token_store, '_client_info', None)
+    with pytest.raises(RuntimeError):
+        decode_credentials(encoded)
+    db = DBHelper(db_path=str(tmp_path / 'no_client.db'))
+    legacy = pickle.dumps(Credentials(token='access', refresh_token='refresh', client_id='cid', client_secret='secret'))
+    db.save_google_token('U1', legacy)
+    assert migrate_legacy_tokens(db) == (0, 0)
+    assert not is_current_format(db.get_google_token('U1'))
+
+def test_token_refresher_refreshes_only_expiring_tokens(tmp_path, oauth_client_env):
+    """期限が window 以内のトークンだけを先行リフレッシュする"""
+    from unittest import mock
+    from google.oauth2.credentials import Credentials
+    from db import DBHelper
+    from token_refresher import TokenRefresher
+    from token_store import decode_credentials, encode_credentials, refresh_stats
+    db = DBHelper(db_path=str(tmp_path / 'refresh.db'))
+    now = datetime.utcnow()
+    def save(user_id, expiry):
+        db.save_google_token(user_id, encode_credentials(Credentials(token='old', refresh_token='r', expiry=expiry)))
+    save('soon', now + timedelta(minutes=5))
+    save('later', now + timedelta(hours=2))
+    def fake_refresh(self, request):
+        self.token = 'new'
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+    refreshed = []
+    refresher = TokenRefresher(db, window_seconds=900, on_refreshed=lambda user_id, *_: refreshed.append(user_id))
+    before = refresh_stats().get('background', 0)
+    with mock.patch.object(Credentials, 'refresh', fake_refresh):
+        assert refresher.scan_once() == 1
+    assert refreshed == ['soon']
+    assert decode_credentials(db.get_google_token('soon')).token == 'new'
+    assert decode_credentials(db.get_google_token('later')).token == 'old'
+    assert refresh_stats()['background'] == before + 1
+
+def test_token_refresher_backs_off_failing_tokens(tmp_path, oauth_client_env):
+    """失敗したトークンは間隔を空けて再試行し、invalid_grant は再認証されるまで対象にしない"""
+    from unittest import mock
+    from google.auth.exceptions import RefreshError
+    from google.oauth2.credentials import Credentials
+    from db import DBHelper
+    from token_refresher import TokenRefresher
+    from token_store import encode_credentials
+    db = DBHelper(db_path=str(tmp_path / 'backoff.db'))
+    now = datetime.utcnow()
+    def save(user_id, token):
+        db.save_google_token(user_id, encode_credentials(
+            Credentials(token=token, refresh_token='r', expiry=now + timedelta(minutes=5))))
+    save('flaky', 'flaky')
+    save('revoked', 'revoked')
+    attempts = []
+    def failing_refresh(self, request):
+        attempts.append(self.token)
+        if self.token.startswith('revoked'):
+            raise RefreshError('invalid_grant: Token has been expired or revoked.')
+        raise RefreshError('temporarily unavailable')
+    refresher = TokenRefresher(db, interval_seconds=300, window_seconds=900)
+    with mock.patch.object(Credentials, 'refresh', failing_refresh):
+        assert refresher.scan_once() == 0
+        assert sorted(attempts) == ['flaky', 'revoked']
+        # 次の走査ではどちらも試さない
+        assert refresher.scan_once() == 0
+        assert len(attempts) == 2
+        assert refresher.stats()['backing_off'] == 1 and refresher.stats()['invalid_grant'] == 1
+        # 一時的な失敗は待ち時間（interval_seconds）が過ぎれば再試行し、次の待ち時間は倍になる
+        assert refresher.due_user_ids(now + timedelta(seconds=301)) == ['flaky']
+        refresher.scan_once(now + timedelta(seconds=301))
+        assert len(attempts) == 3
+        assert refresher.due_user_ids(now + timedelta(seconds=601)) == []
+        assert refresher.due_user_ids(now + timedelta(seconds=901)) == ['flaky']
+        # 再認証でトークンが変われば invalid_grant のユーザーも対象に戻る
+        save('revoked', 'revoked-new')
+        assert 'revoked' in refresher.due_user_ids()
+
+def test_concurrent_token_refreshes_share_one_call(tmp_path, oauth_client_env):
+    """同じユーザーの同時リフレッシュは1回のOAuth呼び出しと1回の保存にまとめる"""
+    import threading
+    import time
+    from unittest import mock
+    from google.oauth2.credentials import Credentials
+    from db import DBHelper
+    from token_store import encode_credentials, refresh_and_save
+    db = DBHelper(db_path=str(tmp_path / 'flight.db'))
+    expired = datetime.utcnow() - timedelta(minutes=1)
+    db.save_google_token('U1', encode_credentials(Credentials(token='old', refresh_token='r', expiry=expired)))
+    calls = []
+    def slow_refresh(self, request):
+        calls.append(1)
+        time.sleep(0.3)
+        self.token = 'new'
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+    results = []
+    def worker():
+        credentials = Credentials(token='old', refresh_token='r', expiry=expired)
+        refresh_and_save(db, 'U1', credentials)
+        results.append(credentials.token)
+    with mock.patch.object(Credentials, 'refresh', slow_refresh):
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 完了後に古いCredentialsで来た呼び出しも、DB上の新しいトークンを使う
+        worker()
+    assert len(calls) == 1
+    assert results == ['new'] * 5
+
+def test_db_helper_uses_connection_per_thread(tmp_path):
+    """スレッドごとに別の接続で読み書きし、入れ子の connection() は同じ接続を使う"""
+    import threading
+    from db import DBHelper
+    db = DBHelper(db_path=str(tmp_path / 'threads.db'))
+    connections = set()
+    errors = []
+    def worker(n):
+        try:
+            for i in range(20):
+                db.save_conversation_message(f'U{n}', 'user', f'message {i}')
+            with db.connection() as conn:
+                with db.connection() as inner:
+                    assert inner is conn
+                connections.add(id(conn))
+            assert len(db.get_conversation_history(f'U{n}', limit=50)) == 20
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(connections) == 4
+    assert db.pool_stats()['connections_opened'] >= 4
+
+def test_postgres_pool_waits_for_free_connection():
+    """上限まで借りられているときは返却を待ち、待ち時間をメトリクスに記録する"""
+    import threading
+    import pytest
+    pytest.importorskip('psycopg2')
+    import db
+    class FakeConnection:
+        closed = 0
+    class FakePool:
+        def getconn(self):
+            return FakeConnection()
+        def putconn(self, conn, close=False):
+            pass
+    pool = db.PostgresPool(FakePool(), maxconn=1, timeout=0.1)
+    first = pool.getconn()
+    with pytest.raises(db.psycopg2.pool.PoolError):
+        pool.getconn()
+    pool.timeout = 2
+    threading.Timer(0.2, pool.putconn, args=(first,)).start()
+    second = pool.getconn()
+    pool.putconn(second, discard=True)
+    stats = pool.stats()
+    assert stats['checkouts'] == 2 and stats['timeouts'] == 1 and stats['discarded'] == 1
+    assert stats['in_use'] == 0 and stats['max_wait_ms'] >= 150
+
+def test_message_unit_of_work_batches_reads_and_writes(tmp_path):
+    """開始時にまとめて読み、書き込みは終了時まで反映しない"""
+    from db import DBHelper
+    db = DBHelper(db_path=str(tmp_path / 'uow.db'))
+    db.save_google_token('U1', b'token')
+    db.save_pending_event('U1', '{"title": "会議"}')
+    for i in range(3):
+        db.save_conversation_message('U1', 'user', f'old {i}')
+    with db.unit_of_work('U1', history_limit=2) as uow:
+        assert uow.user_exists and uow.pending_event == '{"title": "会議"}'
+        assert [m['content'] for m in uow.conversation_history] == ['old 1', 'old 2']
+        uow.delete_pending_event()
+        uow.add_message('user', '明日の空き時間')
+        uow.add_message('assistant', '空いています')
+        assert uow.pending_event is None
+        assert db.get_pending_event('U1') is not None
+    assert db.get_pending_event('U1') is None
+    assert [m['content'] for m in db.get_conversation_history('U1', limit=3)] == ['old 2', '明日の空き時間', '空いています']
+    with db.unit_of_work('unknown') as uow:
+        assert not uow.user_exists and uow.pending_event is None and uow.conversation_history == []
+
+def test_conversation_append_takes_advisory_lock_on_postgres(tmp_path):
+    """PostgreSQLでは会話の追加より先にユーザーごとのアドバイザリロックを取る"""
+    from types import SimpleNamespace
+    import queries
+    from db import DBHelper
+    db = DBHelper(db_path=str(tmp_path / 'lock.db'))
+    db.save_google_token('U1', b'token')
+    assert db._conversation_lock('U1') is None
+    batches = []
+    db._execute_batch = lambda conn, statements: batches.append([q for q, _ in statements])
+    db._conversation_lock = lambda uid: DBHelper._conversation_lock(SimpleNamespace(is_postgres=True), uid)
+    db.save_conversation_message('U1', 'user', 'こんにちは')
+    with db.unit_of_work('U1') as uow:
+        uow.delete_pending_event()
+    with db.unit_of_work('U1') as uow:
+        uow.add_message('user', '明日の空き時間')
+        uow.add_message('assistant', '空いています')
+    assert batches[0] == [queries.LOCK_CONVERSATION_RING, queries.APPEND_CONVERSATION_MESSAGE]
+    assert queries.LOCK_CONVERSATION_RING not in batches[1]
+    assert batches[2][0] is queries.LOCK_CONVERSATION_RING and batches[2].count(queries.LOCK_CONVERSATION_RING) == 1
+
+def test_conversation_ring_keeps_latest_messages_and_migrates(tmp_path):
+    """会話履歴は history_size 件のリングに上書きし、旧テーブルの履歴は初回に移行する"""
+    import sqlite3
+    from db import DBHelper
+    db_path = str(tmp_path / 'ring.db')
+    legacy = sqlite3.connect(db_path)
+    legacy.execute('''
+        CREATE TABLE conversation_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, line_user_id TEXT NOT NULL, role TEXT NOT NULL,
+            content TEXT NOT NULL, created_at TEXT NOT NULL
+        )
+    ''')
+    legacy.executemany(
+        'INSERT INTO conversation_history (line_user_id, role, content, created_at) VALUES (?, ?, ?, ?)',
+        [('U1', 'user', f'legacy {i}', f'2025-01-01T00:00:{i:02d}') for i in range(6)]
+    )
+    legacy.commit()
+    legacy.close()
+    db = DBHelper(db_path=db_path)
+    db.history_size = 4
+    assert [m['content'] for m in db.get_conversation_history('U1', limit=10)][-1] == 'legacy 5'
+    for i in range(7):
+        db.save_conversation_message('U2', 'user', f'm{i}')
+    assert [m['content'] for m in db.get_conversation_history('U2', limit=10)] == ['m3', 'm4', 'm5', 'm6']
+    assert [m['content'] for m in db.get_conversation_history('U2', limit=2)] == ['m5', 'm6']
+    db.clear_old_conversation_history('U2', keep_count=1)
+    assert [m['content'] for m in db.get_conversation_history('U2', limit=10)] == ['m6']
+    # 2回目以降の起動では移行しない
+    DBHelper(db_path=db_path)
+    assert len(db.get_conversation_history('U1', limit=30)) == 6
+
+def test_session_cache_write_through_and_invalidation(tmp_path):
+    """2通目以降はキャッシュから読み、コミットした書き込みは反映、外部からの書き込みでは無効化する"""
+    from db import DBHelper
+    db = DBHelper(db_path=str(tmp_path / 'session.db'))
+    cache = db.session_cache
+    with db.unit_of_work('U1') as uow:
+        assert not uow.user_exists
+    db.save_google_token('U1', b'token')
+    db.save_pending_event('U1', '{"title": "会議"}')
+    with db.unit_of_work('U1') as uow:
+        assert uow.user_exists and uow.pending_event
+        uow.delete_pending_event()
+        uow.add_message('user', 'いいえ')
+    hits = cache.stats()['hits']
+    with db.unit_of_work('U1') as uow:
+        assert uow.user_exists and uow.pending_event is None
+        assert [m['content'] for m in uow.conversation_history] == ['いいえ']
+    assert db.user_exists('U1') and db.get_pending_event('U1') is None
+    assert cache.stats()['hits'] == hits + 3
+    db.save_pending_event('U1', '{"title": "再送"}')
+    assert db.get_pending_event('U1') == '{"title": "再送"}'
+
+def test_session_cache_ttl_and_lru():
+    import time
+    from session_cache import SessionCache
+    cache = SessionCache(max_size=2, ttl_seconds=0.2, history_size=3)
+    for user_id in ('a', 'b', 'c'):
+        cache.put(user_id, True, None, [], cache.generation(user_id))
+    assert cache.get('a') is None and cache.get('c') is not None
+    stale = cache.generation('b')
+    cache.invalidate('b')
+    assert cache.put('b', True, None, [], stale) is None
+    time.sleep(0.25)
+    assert cache.get('c') is None
+    stats = cache.stats()
+    assert stats['evictions'] == 1 and stats['expired'] == 1
+    # 無効化の記録も max_size 人分までで、捨てた記録より前に読み始めた分は保存しない
+    stale = cache.generation('x')
+    for user_id in ('x', 'y', 'z'):
+        cache.invalidate(user_id)
+    assert len(cache._generations) == 2
+    assert cache.put('x', True, None, [], stale) is None
+    assert cache.put('x', True, None, [], cache.generation('x')) is not None
+
+def test_ai_response_cache_skips_repeated_llm_calls(tmp_path):
+    """同じ文・同じ日の問い合わせはLLMを呼ばず、補完処理は毎回行う。
+    日付を指定した入力は会話履歴があっても使い回し、前の発言を参照する入力は履歴が多ければキャッシュしない"""
+    from types import SimpleNamespace
+    from ai_cache import AIResponseCache
+    from db import DBHelper
+    calls = []
+    def create(**kwargs):
+        calls.append(kwargs)
+        content = '{"task_type": "availability_check", "dates": [{"date": "2099-01-05", "time": "09:00", "end_time": "18:00"}]}'
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+    db = DBHelper(db_path=str(tmp_path / 'cache.db'))
+    ai = AIService.__new__(AIService)
+    ai.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    ai.response_cache = AIResponseCache(max_size=8, ttl_seconds=60, max_history=2, store=db)
+    ai.use_intent_rules = False
+    ai.model_router = None
+    first = ai.extract_dates_and_times('1/5 9:00-18:00 空いてる？')
+    first['dates'].append({'date': 'mutated'})
+    second = ai.extract_dates_and_times('１/５　9:00-18:00 空いてる？ ')
+    assert len(calls) == 1
+    assert second['dates'] == [{'date': '2099-01-05', 'time': '09:00', 'end_time': '18:00'}]
+    history = [{'role': 'user', 'content': f'メッセージ{i}'} for i in range(5)]
+    other_history = [{'role': 'user', 'content': f'別の会話{i}'} for i in range(5)]
+    ai.extract_dates_and_times('1/5 9:00-18:00 空いてる？', history)
+    ai.extract_dates_and_times('1/5 9:00-18:00 空いてる？', other_history)
+    assert len(calls) == 1
+    ai.extract_dates_and_times('その日の9:00-18:00は空いてる？', history)
+    ai.extract_dates_and_times('その日の9:00-18:00は空いてる？', history)
+    assert len(calls) == 3
+    assert ai.response_cache.stats()['bypassed'] == 2
+    # DBに保存した応答は別プロセス（新しいキャッシュ）からも使える
+    ai.response_cache = AIResponseCache(max_size=8, ttl_seconds=60, store=db)
+    ai.extract_dates_and_times('1/5 9:00-18:00 空いてる？')
+    assert len(calls) == 3
+    stats = ai.response_cache.stats()
+    assert stats['db_hits'] == 1 and stats['misses'] == 0
+
+def test_intent_rules_parse_common_inputs_without_llm():
+    """定型の入力はルールで解釈し、迷う入力は None（LLMへ）"""
+    from types import SimpleNamespace
+    from intent_rules import match_intent
+    now = pytz.timezone('Asia/Tokyo').localize(datetime(2026, 10, 17, 10, 0))
+    assert match_intent('明日の空き時間', now) == {
+        'task_type': 'availability_check',
+        'dates': [{'date': '2026-10-18', 'time': '08:00', 'end_time': '22:00'}],
+    }
+    assert match_intent('本日の予定は？', now)['task_type'] == 'show_schedule'
+    next_week = match_intent('来週の18時以降空いてる？', now)['dates']
+    assert [d['date'] for d in next_week] == [f'2026-10-{day}' for day in range(19, 26)]
+    assert next_week[0]['time'] == '18:00' and next_week[0]['end_time'] == '23:59'
+    assert match_intent('10/20(火) 10:00〜12:00／14:00-16:00\n4/6 9:00-10:00', now)['dates'] == [
+        {'date': '2026-10-20', 'time': '10:00', 'end_time': '12:00'},
+        {'date': '2026-10-20', 'time': '14:00', 'end_time': '16:00'},
+        {'date': '2027-04-06', 'time': '09:00', 'end_time': '10:00'},
+    ]
+    assert match_intent('4/6 15:00 なみさん', now)['dates'] == [
+        {'date': '2027-04-06', 'time': '15:00', 'end_time': '16:00', 'title': 'なみさん', 'description': ''}
+    ]
+    for text in ('4/6 15:00 なみさん 移動30分', '明日の午後に1時間打ち合わせ', '4/15までの9:00〜18:00が空いている日程出して',
+                 '2/30 10:00-12:00', 'はい', '明日 10:00 会議を追加して', '明日 15:00 歯医者の予約を入れて',
+                 '4/6 10:00-12:00 でお願いします', '5/1 19:00 飲み会を登録'):
+        assert match_intent(text, now) is None
+    # ルールで解釈できればLLMを呼ばない
+    ai = AIService.__new__(AIService)
+    ai.client = SimpleNamespace()
+    ai.response_cache = None
+    ai.use_intent_rules = True
+    ai.model_router = None
+    assert ai.extract_dates_and_times('今日の予定')['task_type'] == 'show_schedule'
+
+def test_date_ranges_from_llm_are_expanded_locally():
+    """LLMが返した範囲指定（ranges）を曜日で絞って日ごとの dates に展開する。今日より前は除く"""
+    import calendar as cal
+    from types import SimpleNamespace
+    today = datetime.now(pytz.timezone('Asia/Tokyo')).date()
+    content = json.dumps({'task_type': 'availability_check', 'ranges': [
+        {'start_date': '2099-04-01', 'end_date': '2099-04-30', 'weekdays': [0, 1, 2, 3, 4], 'time': '10:00', 'end_time': '17:00'},
+        {'start_date': '2000-01-01', 'end_date': (today + timedelta(days=2)).isoformat(), 'weekdays': ['土', '日', '月', '火', '水', '木', '金']},
+    ]})
+    ai = AIService.__new__(AIService)
+    ai.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+        create=lambda **kwargs: SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+    )))
+    ai.response_cache = None
+    ai.use_intent_rules = False
+    ai.model_router = None
+    result = ai.extract_dates_and_times('平日で空いているところを探して')
+    assert 'ranges' not in result
+    april = [d for d in result['dates'] if d['date'].startswith('2099-04')]
+    weekdays_in_april = [day for day in range(1, 31) if cal.weekday(2099, 4, day) < 5]
+    assert [d['date'] for d in april] == [f'2099-04-{day:02d}' for day in weekdays_in_april]
+    assert all(d['time'] == '10:00' and d['end_time'] == '17:00' for d in april)
+    near = [d for d in result['dates'] if not d['date'].startswith('2099')]
+    assert [d['date'] for d in near] == [(today + timedelta(days=i)).isoformat() for i in range(3)]
+    assert near[0]['time'] == '08:00' and near[0]['end_time'] == '22:00'
+    # 予定の確認では過去の期間もそのまま展開する
+    content = json.dumps({'task_type': 'show_schedule', 'ranges': [
+        {'start_date': '2000-01-30', 'end_date': '2000-02-02', 'time': '00:00', 'end_time': '23:59'},
+    ]})
+    past = ai.extract_dates_and_times('2000年1/30〜2/2の予定')
+    assert [d['date'] for d in past['dates']] == ['2000-01-30', '2000-01-31', '2000-02-01', '2000-02-02']
+
+    # 「…まで + 平日」: 締切までの補完でも土日を足さない（ranges でも dates でも）
+    deadline = today + timedelta(days=13)
+    text = f'{deadline.month}/{deadline.day}まで平日の10:00-17:00で空いている日'
+    expected = [(today + timedelta(days=i)).isoformat() for i in range(14) if (today + timedelta(days=i)).weekday() < 5]
+    content = json.dumps({'task_type': 'availability_check', 'ranges': [
+        {'start_date': today.isoformat(), 'end_date': deadline.isoformat(), 'weekdays': [0, 1, 2, 3, 4], 'time': '10:00', 'end_time': '17:00'},
+    ]})
+    assert [d['date'] for d in ai.extract_dates_and_times(text)['dates']] == expected
+    first_weekday = expected[0]
+    content = json.dumps({'task_type': 'availability_check', 'dates': [
+        {'date': first_weekday, 'time': '10:00', 'end_time': '17:00'},
+    ]})
+    result = ai.extract_dates_and_times(text)
+    assert [d['date'] for d in result['dates']] == expected
+    assert all(d['time'] == '10:00' and d['end_time'] == '17:00' for d in result['dates'])
+
+def test_ai_calls_use_strict_json_schema_with_fallback():
+    """JSONスキーマ指定の応答は json.loads だけで読み、使えないときはスキーマなしの応答を補正して読む"""
+    from types import SimpleNamespace
+    import openai
+    requests_seen = []
+    replies = {
+        'dates_and_times': '{"task_type": "show_schedule", "dates": [{"date": "2099-01-05", "time": "00:00", "end_time": "23:59", '
+                           '"title": null, "description": null}], "ranges": [], "required_duration_minutes": null, '
+                           '"travel_time_minutes": null, "location": null}',
+        'event_info': '{"title": "田中さんとMTG", "start_datetime": "2099-01-05T10:00:00", "end_datetime": "2099-01-05T11:00:00", "description": null}',
+    }
+    def create(**kwargs):
+        requests_seen.append(kwargs)
+        if 'response_format' not in kwargs:
+            content = '了解です。\n```json\n{"task_type": "show_schedule", "date": "2099-01-06"}\n```'
+        elif kwargs['response_format']['json_schema']['name'] == 'dates_availability':
+            error = openai.BadRequestError.__new__(openai.BadRequestError)
+            Exception.__init__(error, 'response_format is not supported')
+            raise error
+        else:
+            content = replies[kwargs['response_format']['json_schema']['name']]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+    ai = AIService.__new__(AIService)
+    ai.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    ai.response_cache = None
+    ai.use_intent_rules = False
+    ai.model_router = None
+    result = ai.extract_dates_and_times('あの日の予定を見せて')
+    assert result == {'task_type': 'show_schedule', 'dates': [{'date': '2099-01-05', 'time': '00:00', 'end_time': '23:59'}]}
+    schema = requests_seen[0]['response_format']['json_schema']
+    assert schema['strict'] is True and set(schema['schema']['required']) == set(schema['schema']['properties'])
+    event_info = ai.extract_event_info('田中さんとMTG')
+    assert event_info['title'] == '田中さんとMTG' and 'description' not in event_info
+    parsed, structured = ai._chat_json('gpt-4o', [], 'dates_availability', {}, temperature=0)
+    assert structured is False
+    assert ai._repair_dates_response(parsed) == {'task_type': 'show_schedule', 'dates': [{'date': '2099-01-06'}]}
+
+def test_ai_prompt_prefix_is_static_and_cached_tokens_recorded():
+    """システムプロンプトは毎回同じで、現在日時・履歴・入力は後ろに置く。キャッシュされたトークン数を集計する"""
+    from types import SimpleNamespace
+    from ai_service import ai_usage_stats, DATES_AND_TIMES_PROMPT
+    seen = []
+    def create(**kwargs):
+        seen.append(kwargs['messages'])
+        usage = SimpleNamespace(prompt_tokens=1500, completion_tokens=40,
+                                prompt_tokens_details=SimpleNamespace(cached_tokens=1280 if len(seen) > 1 else 0))
+        content = '{"task_type": "show_schedule", "dates": [{"date": "2099-01-05"}]}'
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+    ai = AIService.__new__(AIService)
+    ai.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    ai.response_cache = None
+    ai.use_intent_rules = False
+    ai.model_router = None
+    before = ai_usage_stats().get('dates_and_times', {'calls': 0, 'cached_tokens': 0})
+    ai.extract_dates_and_times('あの日の予定を見せて')
+    ai.extract_dates_and_times('その次の日の予定', [{'role': 'user', 'content': 'あの日の予定を見せて'}])
+    assert seen[0][0] == seen[1][0] == {'role': 'system', 'content': DATES_AND_TIMES_PROMPT}
+    assert seen[1][1]['content'] == 'あの日の予定を見せて'
+    assert seen[1][-2]['role'] == 'system' and '現在の日時' in seen[1][-2]['content']
+    assert seen[1][-1] == {'role': 'user', 'content': 'その次の日の予定'}
+    after = ai_usage_stats()['dates_and_times']
+    assert after['calls'] - before['calls'] == 2
+    assert after['cached_tokens'] - before['cached_tokens'] == 1280
+
+def test_model_router_escalates_invalid_small_model_answers():
+    """単純な入力は小さいモデルへ送り、妥当性チェックに通らない応答は大きいモデルで解釈し直す"""
+    from types import SimpleNamespace
+    from model_router import ModelRouter, validate_dates_response
+    router = ModelRouter(small_model='small', large_model='large', max_simple_chars=20)
+    assert router.is_simple('金曜の午後の空き時間')
+    assert not router.is_simple('金曜に2時間打ち合わせ 移動30分')
+    assert not router.is_simple('その日の予定')
+    today = datetime(2099, 1, 1).date()
+    assert validate_dates_response({'task_type': 'show_schedule', 'dates': [{'date': '2099-01-02'}]}, today) is None
+    # 過去の予定の確認は正しい応答、過去日の空き確認・予定追加は誤り
+    assert validate_dates_response({'task_type': 'show_schedule', 'dates': [{'date': '2098-12-31'}]}, today) is None
+    assert validate_dates_response({'task_type': 'show_schedule', 'dates': [], 'ranges': [
+        {'start_date': '2098-12-01', 'end_date': '2098-12-31'}]}, today) is None
+    assert validate_dates_response({'task_type': 'availability_check', 'dates': [{'date': '2098-12-31'}]}, today)
+    assert validate_dates_response({'task_type': 'add_event', 'dates': [
+        {'date': '2098-12-31', 'time': '10:00'}]}, today)
+    assert validate_dates_response({'task_type': 'availability_check', 'dates': [], 'ranges': [
+        {'start_date': '2098-12-01', 'end_date': '2098-12-31'}]}, today)
+    assert validate_dates_response({'task_type': 'availability_check', 'dates': [], 'ranges': [
+        {'start_date': '2099-01-05', 'end_date': '2099-01-03'}]}, today)
+    assert validate_dates_response({'task_type': 'add_event', 'dates': [
+        {'date': '2099-01-02', 'time': '15:00', 'end_time': '14:00'}]}, today)
+    answers = {
+        'small': '{"task_type": "availability_check", "dates": [{"date": "2000-01-01", "time": "13:00", "end_time": "18:00"}]}',
+        'large': '{"task_type": "availability_check", "dates": [{"date": "2099-01-09", "time": "13:00", "end_time": "18:00"}]}',
+    }
+    models = []
+    def create(**kwargs):
+        models.append(kwargs['model'])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answers[kwargs['model']]))])
+    ai = AIService.__new__(AIService)
+    ai.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    ai.response_cache = None
+    ai.use_intent_rules = False
+    ai.model_router = router
+    result = ai.extract_dates_and_times('金曜の午後の空き時間')
+    assert models == ['small', 'large']
+    assert result['dates'][0]['date'] == '2099-01-09'
+    answers['small'] = answers['large']
+    ai.extract_dates_and_times('土曜の午後の空き時間')
+    ai.extract_dates_and_times('金曜に2時間打ち合わせ 移動30分')
+    assert models[2:] == ['small', 'large']
+    stats = router.stats()
+    assert stats['small']['calls'] == 2 and stats['large']['calls'] == 2
+    assert stats['escalations'] == 1 and stats['escalation_rate'] == 0.5
+    assert stats['escalation_reasons'] == {'過去の日付': 1}
+
+def test_event_addition_uses_one_combined_extraction(monkeypatch):
+    """予定追加のメッセージは extract_dates_and_times の1回のLLM呼び出しで、タイトル・日時をまとめて得る"""
+    from types import SimpleNamespace
+    from config import Config
+    from line_bot_handler import LineBotHandler
+    monkeypatch.setattr(Config, 'LINE_CHANNEL_ACCESS_TOKEN', 'token')
+    monkeypatch.setattr(Config, 'LINE_CHANNEL_SECRET', 'secret')
+    day = datetime.now(pytz.timezone('Asia/Tokyo')).date() + timedelta(days=30)
+    calls = []
+    def create(**kwargs):
+        calls.append(kwargs)
+        content = json.dumps({'task_type': 'add_event', 'dates': [{
+            'date': day.isoformat(), 'time': '10:00', 'end_time': '11:00', 'title': 'MTG', 'description': '新作アプリの件'}]})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+    ai = AIService.__new__(AIService)
+    ai.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    ai.response_cache = None
+    ai.use_intent_rules = False
+    ai.model_router = None
+    added = []
+    def add_events_batch(events, line_user_id=None):
+        added.extend(events)
+        return len(events), 0, []
+    handler = LineBotHandler.__new__(LineBotHandler)
+    handler.ai_service = ai
+    handler.calendar_service = SimpleNamespace(
+        get_events_for_time_range=lambda start, end, line_user_id: [],
+        add_events_batch=add_events_batch,
+    )
+    handler.jst = pytz.timezone('Asia/Tokyo')
+    messages = []
+    uow = SimpleNamespace(
+        user_exists=True, pending_event=None, conversation_history=[],
+        add_message=lambda role, content: messages.append((role, content)),
+    )
+    response = handler._handle_message(f'{day.month}/{day.day} 10:00 田中さんとMTG 新作アプリの件', 'U1', uow)
+    assert len(calls) == 1
+    assert len(added) == 1
+    assert added[0]['title'] == '田中さんとMTG' and added[0]['description'] == '新作アプリの件'
+    assert added[0]['start_datetime'].isoformat() == f'{day.isoformat()}T10:00:00+09:00'
+    assert added[0]['end_datetime'].isoformat() == f'{day.isoformat()}T11:00:00+09:00'
+    assert '予定を追加しました' in response.text
+    assert messages[-1] == ('assistant', response.text)
+
+def test_query_placeholders_translated_for_postgres():
+    """? は文字列リテラルの外だけ変換し、PREPARE 用には $n、psycopg2 用には %s にする"""
+    import pytest
+    from queries import Query, QUERIES, SAVE_GOOGLE_TOKEN
+    query = Query('test_placeholders', "SELECT '?' || note FROM t WHERE a=? AND b LIKE '50%' AND c=?")
+    assert query.param_count == 2
+    assert query.postgres == "SELECT '?' || note FROM t WHERE a=%s AND b LIKE '50%%' AND c=%s"
+    assert query.prepare_sql == "PREPARE q_test_placeholders AS SELECT '?' || note FROM t WHERE a=$1 AND b LIKE '50%' AND c=$2"
+    assert query.execute_sql == "EXECUTE q_test_placeholders (%s, %s)"
+    assert SAVE_GOOGLE_TOKEN.param_count == 4
+    with pytest.raises(ValueError):
+        Query('test_placeholders', 'SELECT 1')
+    del QUERIES['test_placeholders']
+
+def test_keyed_work_queue_preserves_order_per_user():
+    """同じユーザーのジョブは投入順に処理される"""
+    from work_queue import KeyedWorkQueue
+    work_queue = KeyedWorkQueue(num_workers=3, max_queue_size=50, name='test')
+    processed = {'u1': [], 'u2': []}
+    for i in range(10):
+        for user_id in ('u1', 'u2'):
+            assert work_queue.submit(user_id, processed[user_id].append, i)
+    work_queue.shutdown(timeout=5)
+    assert processed['u1'] == list(range(10))
+    assert processed['u2'] == list(range(10))
+    stats = work_queue.stats()
+    assert stats['processed'] == 20 and stats['depth'] == 0
+
+def test_keyed_work_queue_waits_then_rejects_when_full():
+    """満杯のキューは submit_timeout まで空きを待ち、空かなければ False を返して rejected に数える"""
+    import threading
+    import time
+    from work_queue import KeyedWorkQueue
+    release = threading.Event()
+    work_queue = KeyedWorkQueue(num_workers=1, max_queue_size=1, name='test-full', submit_timeout=0.05)
+    processed = []
+    assert work_queue.submit('u1', lambda: release.wait(5))
+    time.sleep(0.05)
+    assert work_queue.submit('u1', processed.append, 1)
+    started = time.monotonic()
+    assert not work_queue.submit('u1', processed.append, 2)
+    assert time.monotonic() - started >= 0.05
+    assert work_queue.stats()['rejected'] == 1
+    release.set()
+    work_queue.shutdown(timeout=5)
+    assert processed == [1]
+
+def test_daily_agenda_fan_out_timeouts_and_failures():
+    """並列送信で、失敗・タイムアウトのユーザーがいても他のユーザーは処理される"""
+    import time
+    from send_daily_agenda import _fan_out
+    def task(user_id, timed_out):
+        if user_id == 'slow':
+            time.sleep(2)
+            return 'timeout' if timed_out.is_set() else 'sent'
+        if user_id == 'broken':
+            raise RuntimeError('LINE API error')
+        return 'sent'
+    results = _fan_out(['u1', 'slow', 'broken', 'u2'], task, workers=4, user_timeout=1)
+    assert {user_id: outcome for user_id, (outcome, _) in results.items()} == {
+        'u1': 'sent', 'slow': 'timeout', 'broken': 'failed', 'u2': 'sent'
+    }
+
+def test_daily_agenda_groups_identical_messages_into_multicast():
+    """同じ本文はまとめて multicast、個別の本文と multicast 失敗分は push で送る"""
+    from send_daily_agenda import _send_grouped
+    from work_queue import RateLimiter
+    class FakeLineApi:
+        def __init__(self):
+            self.multicasts = []
+            self.pushes = []
+        def multicast(self, to, message):
+            if message.text == 'broken':
+                raise RuntimeError('multicast error')
+            self.multicasts.append((list(to), message.text))
+        def push_message(self, to, message):
+            self.pushes.append((to, message.text))
+    api = FakeLineApi()
+    messages = {'u1': '予定なし', 'u2': '予定なし', 'u3': '予定なし', 'u4': '会議あり', 'u5': 'broken', 'u6': 'broken'}
+    outcomes, multicast_calls, push_calls = _send_grouped(messages, api, RateLimiter(0), workers=2, user_timeout=5)
+    assert api.multicasts == [(['u1', 'u2', 'u3'], '予定なし')]
+    assert sorted(api.pushes) == [('u4', '会議あり'), ('u5', 'broken'), ('u6', 'broken')]
+    assert multicast_calls == 2 and push_calls == 3
+    assert set(outcomes.values()) == {'sent'} and len(outcomes) == 6
+
+def test_rate_limiter_spaces_calls():
+    import time
+    from work_queue import RateLimiter
+    limiter = RateLimiter(rate=20, burst=1)
+    started = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - started >= 0.18
+
 def test_full_flow():
     ai = AIService()
     from calendar_service import GoogleCalendarService
@@ -0,0 +1,164 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+
+from google.auth.exceptions import RefreshError
+from token_store import decode_credentials, refresh_and_save, token_expiry, token_fingerprint
+
+logger = logging.getLogger("token_refresher")
+
+
+class TokenRefresher:
+    """期限が近いGoogleアクセストークンを、ユーザーがメッセージを送る前にバックグラウンドでリフレッシュする
+
+    interval_seconds ごとに users を走査し、window_seconds 以内に期限が切れるトークンを
+    最大 max_workers 並列でリフレッシュする。リクエスト処理中のリフレッシュは token_store.refresh_stats() の
+    'request' として数えられるので、先行リフレッシュが効いているかはそちらで確認できる。
+
+    リフレッシュに失敗したユーザーは、次の試行まで interval_seconds から倍々に（最大 max_backoff_seconds）間隔を空ける。
+    リフレッシュトークン自体が無効（invalid_grant）なら、再認証でDB上のトークンが変わるまで対象にしない。
+    """
+
+    def __init__(self, db_helper, interval_seconds=300, window_seconds=900, max_workers=4, on_refreshed=None,
+                 max_backoff_seconds=6 * 3600):
+        self.db_helper = db_helper
+        self.interval_seconds = interval_seconds
+        self.window = timedelta(seconds=window_seconds)
+        self.max_workers = max(1, max_workers)
+        self.on_refreshed = on_refreshed
+        self.max_backoff = timedelta(seconds=max_backoff_seconds)
+        # line_user_id -> {'count', 'next_attempt', 'invalid_grant', 'fingerprint'}
+        self._failures = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.last_scan_at = None
+        self.last_scan_ms = None
+
+    def start(self):
+        """走査スレッドを起動します（複数回呼んでも1度だけ起動）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="token-refresher", daemon=True)
+            self._thread.start()
+        logger.info(f"トークン先行リフレッシュ開始: interval={self.interval_seconds}s, window={self.window}, workers={self.max_workers}")
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.scan_once()
+            except Exception as e:
+                logger.error(f"トークン先行リフレッシュの走査でエラー: {e}")
+            self._stop.wait(self.interval_seconds)
+
+    def due_user_ids(self, now=None):
+        """window 以内に期限が切れる（または切れている）トークンのユーザーID一覧"""
+        now = now or datetime.utcnow()
+        deadline = now + self.window
+        due = []
+        for line_user_id, token_data in self.db_helper.get_all_google_tokens():
+            expiry = token_expiry(token_data)
+            if expiry is not None and expiry <= deadline and not self._backing_off(line_user_id, token_data, now):
+                due.append(line_user_id)
+        return due
+
+    def _backing_off(self, line_user_id, token_data, now):
+        """前回の失敗から間隔を空けている最中か（トークンが変わっていれば失敗の記録を消す）"""
+        with self._lock:
+            failure = self._failures.get(line_user_id)
+            if failure is None:
+                return False
+            if failure['fingerprint'] != token_fingerprint(token_data):
+                # 再認証・リクエスト処理中のリフレッシュなどでトークンが更新された
+                del self._failures[line_user_id]
+                return False
+            return failure['invalid_grant'] or now < failure['next_attempt']
+
+    def _record_failure(self, line_user_id, token_data, error, now):
+        invalid_grant = isinstance(error, RefreshError) and 'invalid_grant' in str(error)
+        with self._lock:
+            self.failed += 1
+            count = self._failures.get(line_user_id, {}).get('count', 0) + 1
+            backoff = min(timedelta(seconds=self.interval_seconds * 2 ** (count - 1)), self.max_backoff)
+            self._failures[line_user_id] = {
+                'count': count,
+                'next_attempt': now + backoff,
+                'invalid_grant': invalid_grant,
+                'fingerprint': token_fingerprint(token_data),
+            }
+        if invalid_grant:
+            logger.error(f"リフレッシュトークンが無効なため、再認証まで先行リフレッシュしません: user={line_user_id}: {error}")
+        else:
+            logger.error(f"トークン先行リフレッシュ失敗（{count}回目、{backoff}後に再試行）: user={line_user_id}: {error}")
+
+    def scan_once(self, now=None):
+        """1回分の走査とリフレッシュを行い、リフレッシュできた件数を返します"""
+        started = time.monotonic()
+        now = now or datetime.utcnow()
+        due = self.due_user_ids(now)
+        refreshed = 0
+        if due:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="token-refresh") as executor:
+                results = executor.map(lambda line_user_id: self._refresh_user(line_user_id, now), due)
+                refreshed = sum(1 for ok in results if ok)
+        with self._lock:
+            self.scans += 1
+            self.last_scan_at = datetime.utcnow().isoformat()
+            self.last_scan_ms = round((time.monotonic() - started) * 1000, 1)
+        if due:
+            logger.info(f"トークン先行リフレッシュ: 対象={len(due)}件, 成功={refreshed}件")
+        return refreshed
+
+    def _refresh_user(self, line_user_id, now=None):
+        token_data = None
+        try:
+            # 走査からの間に他の経路でリフレッシュされていれば何もしない
+            token_data = self.db_helper.get_google_token(line_user_id)
+            if not token_data:
+                return False
+            credentials = decode_credentials(token_data)
+            if not credentials.refresh_token:
+                return False
+            if credentials.expiry is not None and credentials.expiry > datetime.utcnow() + self.window:
+                return False
+            token_data = refresh_and_save(self.db_helper, line_user_id, credentials, source='background')
+            if self.on_refreshed:
+                self.on_refreshed(line_user_id, token_data, credentials)
+            with self._lock:
+                self.refreshed += 1
+                self._failures.pop(line_user_id, None)
+            return True
+        except Exception as e:
+            if token_data:
+                self._record_failure(line_user_id, token_data, e, now or datetime.utcnow())
+            else:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"トークン先行リフレッシュ失敗: user={line_user_id}: {e}")
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._thread is not None and self._thread.is_alive(),
+                'interval_seconds': self.interval_seconds,
+                'window_seconds': int(self.window.total_seconds()),
+                'scans': self.scans,
+                'refreshed': self.refreshed,
+                'failed': self.failed,
+                'backing_off': sum(1 for f in self._failures.values() if not f['invalid_grant']),
+                'invalid_grant': sum(1 for f in self._failures.values() if f['invalid_grant']),
+                'last_scan_at': self.last_scan_at,
+                'last_scan_ms': self.last_scan_ms,
+            }
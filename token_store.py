@@ -0,0 +1,288 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from config import Config
+from work_queue import SingleFlight
+
+logger = logging.getLogger("token_store")
+
+# users.google_token に保存する形式のバージョン
+# v1: {"v": 1, "token": ..., "refresh_token": ..., "expiry": "YYYY-MM-DDTHH:MM:SSZ", "scopes": [...]}
+# client_id / client_secret / token_uri は保存せず、credentials.json（OAuthクライアント設定）
+# または GOOGLE_CLIENT_ID / GOOGLE_CLIENT_SECRET 環境変数から補う
+TOKEN_FORMAT_VERSION = 1
+DEFAULT_TOKEN_URI = 'https://oauth2.googleapis.com/token'
+EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_client_info = None
+_client_info_lock = threading.Lock()
+
+
+def _client_secrets_file():
+    credentials_file = Config.GOOGLE_CREDENTIALS_FILE
+    # GOOGLE_CREDENTIALS_FILE にJSON本体が入る環境では、app.pyが credentials.json を書き出す
+    if credentials_file.strip().startswith('{'):
+        return 'credentials.json'
+    return credentials_file
+
+
+def load_client_info():
+    """OAuthクライアントの client_id / client_secret / token_uri を返します（1度だけ読み込み）
+
+    credentials.json がなければ GOOGLE_CLIENT_ID / GOOGLE_CLIENT_SECRET 環境変数を使う
+    （GitHub Actions の daily_agenda など credentials.json を置かない環境）。
+    どちらからも取れなければ RuntimeError（client_id のない Credentials はリフレッシュできないため）。
+    """
+    global _client_info
+    if _client_info is not None:
+        return _client_info
+    with _client_info_lock:
+        if _client_info is not None:
+            return _client_info
+        info = {'client_id': None, 'client_secret': None, 'token_uri': DEFAULT_TOKEN_URI}
+        path = _client_secrets_file()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    secrets = json.load(f)
+                client = secrets.get('web') or secrets.get('installed') or {}
+                info['client_id'] = client.get('client_id')
+                info['client_secret'] = client.get('client_secret')
+                info['token_uri'] = client.get('token_uri') or DEFAULT_TOKEN_URI
+            except Exception as e:
+                logger.error(f"OAuthクライアント設定の読み込みに失敗: {path}: {e}")
+        if not (info['client_id'] and info['client_secret']) and Config.GOOGLE_CLIENT_ID and Config.GOOGLE_CLIENT_SECRET:
+            info['client_id'] = Config.GOOGLE_CLIENT_ID
+            info['client_secret'] = Config.GOOGLE_CLIENT_SECRET
+        if not (info['client_id'] and info['client_secret']):
+            raise RuntimeError(
+                f"OAuthクライアント設定が見つかりません: {path} も GOOGLE_CLIENT_ID / GOOGLE_CLIENT_SECRET もありません"
+            )
+        _client_info = info
+        return info
+
+
+def _to_bytes(token_data):
+    if isinstance(token_data, bytes):
+        return token_data
+    if isinstance(token_data, bytearray):
+        return bytes(token_data)
+    if hasattr(token_data, 'tobytes'):
+        # PostgreSQL の BYTEA は memoryview で返る
+        return token_data.tobytes()
+    if isinstance(token_data, str):
+        return token_data.encode('utf-8')
+    return bytes(token_data)
+
+
+def token_fingerprint(token_data):
+    """DBに保存されたトークンの変更検知用ハッシュ（キャッシュの再検証・再認証の判定で共通に使う）"""
+    if token_data is None:
+        return None
+    return hashlib.sha1(_to_bytes(token_data)).hexdigest()
+
+
+def encode_credentials(credentials):
+    """Credentials を保存用のコンパクトなJSON（bytes）にします"""
+    expiry = credentials.expiry.strftime(EXPIRY_FORMAT) if credentials.expiry else None
+    payload = {
+        'v': TOKEN_FORMAT_VERSION,
+        'token': credentials.token,
+        'refresh_token': credentials.refresh_token,
+        'expiry': expiry,
+        'scopes': list(credentials.scopes) if credentials.scopes else None,
+    }
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+def is_current_format(token_data):
+    """token_data が現在のバージョンの形式で保存されているか"""
+    try:
+        data = json.loads(_to_bytes(token_data).decode('utf-8'))
+        return isinstance(data, dict) and data.get('v') == TOKEN_FORMAT_VERSION
+    except (ValueError, UnicodeDecodeError, TypeError):
+        return False
+
+
+def decode_credentials(token_data):
+    """保存済みトークンを Credentials に戻します
+
+    現在の形式のほか、移行前の形式（pickle した Credentials・authorized_user 形式のJSON）も読める。
+    """
+    raw = _to_bytes(token_data)
+    if raw[:1] == b'{':
+        data = json.loads(raw.decode('utf-8'))
+        if data.get('v') == TOKEN_FORMAT_VERSION:
+            client = load_client_info()
+            expiry = datetime.strptime(data['expiry'], EXPIRY_FORMAT) if data.get('expiry') else None
+            return Credentials(
+                token=data.get('token'),
+                refresh_token=data.get('refresh_token'),
+                token_uri=client['token_uri'],
+                client_id=client['client_id'],
+                client_secret=client['client_secret'],
+                scopes=data.get('scopes'),
+                expiry=expiry,
+            )
+        return Credentials.from_authorized_user_info(data)
+    # 旧形式: pickle した Credentials
+    return pickle.loads(raw)
+
+
+def token_expiry(token_data):
+    """保存済みトークンのアクセストークン期限（naive UTC）を返します。わからなければ None"""
+    try:
+        raw = _to_bytes(token_data)
+        if raw[:1] == b'{':
+            data = json.loads(raw.decode('utf-8'))
+            if data.get('v') == TOKEN_FORMAT_VERSION:
+                return datetime.strptime(data['expiry'], EXPIRY_FORMAT) if data.get('expiry') else None
+        return decode_credentials(raw).expiry
+    except Exception:
+        return None
+
+
+_refresh_counts = {}
+_refresh_counts_lock = threading.Lock()
+
+
+# ユーザーごとのリフレッシュを1本にまとめる（同時に来た呼び出しは実行中のリフレッシュ結果を共有）
+_refresh_flight = SingleFlight()
+# DB上のトークンがこの秒数以上有効なら、リフレッシュせずにそれを使う
+REUSE_MIN_REMAINING_SECONDS = 60
+
+
+def refresh_and_save(db_helper, line_user_id, credentials, source='request'):
+    """アクセストークンをリフレッシュしてDBに保存し、保存したトークン（bytes）を返します
+
+    同じユーザーのリフレッシュが実行中ならその結果を共有し、別の経路で既に更新済みなら
+    DB上のトークンをそのまま使う（どちらの場合も credentials を更新後の内容に揃える）。
+    source はリフレッシュした経路（'request': リクエスト処理中 / 'background': 先行リフレッシュ）で、
+    経路ごとの回数を refresh_stats() で確認できる。
+    """
+    (token_data, reused), shared = _refresh_flight.do(
+        line_user_id, lambda: _refresh_once(db_helper, line_user_id, credentials, source)
+    )
+    if shared or reused:
+        refreshed = decode_credentials(token_data)
+        credentials.token = refreshed.token
+        credentials.expiry = refreshed.expiry
+        _count_refresh('shared' if shared else 'reused')
+    return token_data
+
+
+def _refresh_once(db_helper, line_user_id, credentials, source):
+    current = db_helper.get_google_token(line_user_id)
+    if current:
+        expiry = token_expiry(current)
+        fresh_until = datetime.utcnow() + timedelta(seconds=REUSE_MIN_REMAINING_SECONDS)
+        if expiry is not None and expiry > fresh_until and (credentials.expiry is None or expiry > credentials.expiry):
+            return _to_bytes(current), True
+    try:
+        credentials.refresh(Request())
+    except Exception:
+        _count_refresh(f'{source}_failed')
+        raise
+    token_data = encode_credentials(credentials)
+    db_helper.save_google_token(line_user_id, token_data)
+    _count_refresh(source)
+    return token_data, False
+
+
+def _count_refresh(key):
+    with _refresh_counts_lock:
+        _refresh_counts[key] = _refresh_counts.get(key, 0) + 1
+
+
+def refresh_stats():
+    with _refresh_counts_lock:
+        return dict(_refresh_counts)
+
+
+def migrate_legacy_tokens(db_helper):
+    """旧形式で保存されているトークンを現在の形式に書き換えます。(移行件数, 失敗件数) を返す"""
+    migrated = 0
+    failed = 0
+    try:
+        # 移行後の形式は client_id / client_secret を持たないので、補えない環境では移行しない
+        load_client_info()
+    except RuntimeError as e:
+        logger.error(f"トークン形式の移行をスキップ: {e}")
+        return migrated, failed
+    for line_user_id in db_helper.get_all_user_ids():
+        token_data = db_helper.get_google_token(line_user_id)
+        if not token_data or is_current_format(token_data):
+            continue
+        try:
+            credentials = decode_credentials(token_data)
+            db_helper.save_google_token(line_user_id, encode_credentials(credentials))
+            migrated += 1
+        except Exception as e:
+            failed += 1
+            logger.error(f"トークン形式の移行に失敗: user={line_user_id}: {e}")
+    if migrated or failed:
+        logger.info(f"トークン形式の移行完了: 移行={migrated}件, 失敗={failed}件")
+    return migrated, failed
+
+
+class CredentialsCache:
+    """デコード済み Credentials をユーザーごとに保持するキャッシュ
+
+    DB上のトークンのハッシュ（fingerprint）が一致し、かつアクセストークンの期限まで
+    expiry_margin_seconds 以上残っている間だけ返す。期限が近いものは捨ててリフレッシュさせる。
+    """
+
+    def __init__(self, max_size=1024, expiry_margin_seconds=60):
+        self.max_size = max_size
+        self.expiry_margin = timedelta(seconds=expiry_margin_seconds)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, line_user_id, fingerprint):
+        with self._lock:
+            entry = self._entries.get(line_user_id)
+            if entry is None or entry[0] != fingerprint:
+                self.misses += 1
+                return None
+            credentials = entry[1]
+            if credentials.expiry is not None and credentials.expiry - self.expiry_margin <= datetime.utcnow():
+                del self._entries[line_user_id]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(line_user_id)
+            self.hits += 1
+            return credentials
+
+    def put(self, line_user_id, fingerprint, credentials):
+        with self._lock:
+            self._entries[line_user_id] = (fingerprint, credentials)
+            self._entries.move_to_end(line_user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, line_user_id):
+        with self._lock:
+            self._entries.pop(line_user_id, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,209 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+
+logger = logging.getLogger("work_queue")
+
+
+def percentile(values, pct):
+    """values の pct パーセンタイル（最近傍）。空なら 0.0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class RateLimiter:
+    """トークンバケット方式のレート制限（毎秒 rate 回、burst 回までは連続で許可）
+
+    複数スレッドから acquire() を呼ぶと、上限を超えた分は待たされる。rate が0以下なら制限しない。
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(1.0, self.rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら、後から来た呼び出しはその完了を待って同じ結果（例外）を受け取る"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """func() を実行して (結果, 他の呼び出しの結果を共有したか) を返します"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+        try:
+            call['result'] = func()
+            return call['result'], False
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['done'].set()
+
+
+class KeyedWorkQueue:
+    """キー（LINEユーザーID）ごとの順序を保ったまま、固定数のワーカーでジョブを処理するキュー
+
+    同じキーのジョブは常に同じワーカーに振り分けるため、ユーザー単位では投入順に直列実行される。
+    キューは有界で、満杯のときは submit_timeout 秒まで空きを待ち、それでも空かなければ submit() が False を返す
+    （呼び出し側でフォールバックする。順序が崩れるのでその場で処理はしない）。
+    """
+
+    def __init__(self, num_workers=4, max_queue_size=100, name="webhook", latency_window=500, submit_timeout=0):
+        self.name = name
+        self.submit_timeout = submit_timeout
+        self.num_workers = max(1, int(num_workers))
+        # 全体の上限をワーカー数で割り、各ワーカーのキューを有界にする
+        per_worker_size = max(1, -(-int(max_queue_size) // self.num_workers))
+        self._queues = [queue.Queue(maxsize=per_worker_size) for _ in range(self.num_workers)]
+        self._threads = []
+        self._started = False
+        self._lock = threading.Lock()
+
+        # メトリクス
+        self._enqueued = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._wait_times = deque(maxlen=latency_window)
+        self._run_times = deque(maxlen=latency_window)
+        self._max_wait = 0.0
+
+    def start(self):
+        """ワーカースレッドを起動します（複数回呼んでも1度だけ起動）"""
+        with self._lock:
+            if self._started:
+                return
+            for i, q in enumerate(self._queues):
+                thread = threading.Thread(target=self._worker_loop, args=(q,), name=f"{self.name}-worker-{i}")
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+        logger.info(f"[DEBUG] {self.name}キュー起動: workers={self.num_workers}, queue_size={self._queues[0].maxsize}x{self.num_workers}")
+
+    def _worker_index(self, key):
+        if key is None:
+            key = ""
+        return zlib.crc32(str(key).encode("utf-8")) % self.num_workers
+
+    def submit(self, key, func, *args, **kwargs):
+        """ジョブを投入します。submit_timeout 秒待ってもキューが満杯の場合はFalseを返します"""
+        if not self._started:
+            self.start()
+        q = self._queues[self._worker_index(key)]
+        try:
+            if self.submit_timeout > 0:
+                q.put((time.monotonic(), func, args, kwargs), timeout=self.submit_timeout)
+            else:
+                q.put_nowait((time.monotonic(), func, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            logger.warning(f"[WARNING] {self.name}キューが満杯です: key={key}")
+            return False
+        with self._lock:
+            self._enqueued += 1
+        return True
+
+    def _worker_loop(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                break
+            enqueued_at, func, args, kwargs = item
+            started_at = time.monotonic()
+            wait = started_at - enqueued_at
+            try:
+                func(*args, **kwargs)
+                failed = False
+            except Exception as e:
+                failed = True
+                logger.error(f"[ERROR] {self.name}キューのジョブでエラー: {e}")
+                import traceback
+                traceback.print_exc()
+            finally:
+                run = time.monotonic() - started_at
+                with self._lock:
+                    if failed:
+                        self._failed += 1
+                    else:
+                        self._processed += 1
+                    self._wait_times.append(wait)
+                    self._run_times.append(run)
+                    self._max_wait = max(self._max_wait, wait)
+                q.task_done()
+
+    def depth(self):
+        """現在キューに積まれているジョブ数"""
+        return sum(q.qsize() for q in self._queues)
+
+    def shutdown(self, timeout=None):
+        """投入済みのジョブを処理し終えてからワーカーを停止します"""
+        if not self._started:
+            return
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        with self._lock:
+            self._threads = []
+            self._started = False
+
+    def stats(self):
+        """キュー深さ・待ち時間・処理時間などのメトリクスを返します（秒はミリ秒に換算）"""
+        with self._lock:
+            wait_times = list(self._wait_times)
+            run_times = list(self._run_times)
+            stats = {
+                "workers": self.num_workers,
+                "depth": self.depth(),
+                "depth_by_worker": [q.qsize() for q in self._queues],
+                "capacity": sum(q.maxsize for q in self._queues),
+                "enqueued": self._enqueued,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "max_wait_ms": round(self._max_wait * 1000, 1),
+            }
+        stats["wait_ms_p50"] = round(percentile(wait_times, 50) * 1000, 1)
+        stats["wait_ms_p95"] = round(percentile(wait_times, 95) * 1000, 1)
+        stats["run_ms_p50"] = round(percentile(run_times, 50) * 1000, 1)
+        stats["run_ms_p95"] = round(percentile(run_times, 95) * 1000, 1)
+        return stats